@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""Build fingerprinted copies of the static assets.
+
+python assets.py
+
+Every file in static/js and static/css is minified (unless it already is)
+and written to static/dist/ with a hash of its contents in its name.
+static/dist/manifest.json maps the names the templates use to the hashed
+names so url('static', ...) points browsers at files they may cache
+forever.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+
+
+STATIC_DIR = 'static'
+DIST = 'dist'
+MANIFEST = 'manifest.json'
+ASSET_DIRS = ('js', 'css')
+
+# Fingerprinted files never change so browsers may keep them for a year
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Let the front server send the bytes instead of Python
+# 'x-sendfile' for Apache mod_xsendfile or lighttpd
+# 'x-accel-redirect' for nginx (with an internal location at SENDFILE_PREFIX)
+SENDFILE = os.environ.get('FFRK_SENDFILE', '').lower()
+SENDFILE_PREFIX = os.environ.get('FFRK_SENDFILE_PREFIX', '/_static/')
+
+# (mtime, manifest)
+_manifest = (None, {})
+
+# A slash after one of these (or at the start) begins a regex literal
+REGEX_PRECEDERS = '(,=:[!&|?{};+-*%<>~^'
+
+
+def minify_js(text):
+    """Remove comments and indentation from JavaScript.
+
+    This keeps every line break so automatic semicolon insertion still
+    does the same thing; strings and regex literals are left alone.
+    """
+    out = []
+    i = 0
+    n = len(text)
+    last = ''
+    while i < n:
+        c = text[i]
+        if c in '\'"`':
+            j = i + 1
+            while j < n and text[j] != c:
+                j += 2 if text[j] == '\\' else 1
+            out.append(text[i:j + 1])
+            i = j + 1
+            last = c
+        elif text.startswith('//', i):
+            j = text.find('\n', i)
+            i = n if j == -1 else j
+        elif text.startswith('/*', i):
+            j = text.find('*/', i + 2)
+            i = n if j == -1 else j + 2
+            out.append(' ')
+        elif c == '/' and (not last or last in REGEX_PRECEDERS or
+                           re.search(r'\breturn\s*$', ''.join(out[-8:]))):
+            j = i + 1
+            in_class = False
+            while j < n and (text[j] != '/' or in_class):
+                if text[j] == '\\':
+                    j += 1
+                elif text[j] == '[':
+                    in_class = True
+                elif text[j] == ']':
+                    in_class = False
+                j += 1
+            out.append(text[i:j + 1])
+            i = j + 1
+            last = '/'
+        else:
+            out.append(c)
+            i += 1
+            if not c.isspace():
+                last = c
+
+    lines = (line.strip() for line in ''.join(out).splitlines())
+    lines = (re.sub(r'[ \t]+', ' ', line) for line in lines if line)
+    return '\n'.join(lines) + '\n'
+
+
+def minify_css(text):
+    """Remove comments and needless whitespace from CSS."""
+    text = re.sub(r'/\*.*?\*/', '', text, flags=re.S)
+    text = re.sub(r'\s+', ' ', text)
+    text = re.sub(r'\s*([{};,>])\s*', r'\1', text)
+    text = re.sub(r':\s+', ':', text)
+    return text.replace(';}', '}').strip() + '\n'
+
+
+MINIFIERS = {
+    'js': minify_js,
+    'css': minify_css,
+}
+
+
+def fingerprint(filepath, body):
+    """Return filepath with a hash of body before its extension."""
+    root, ext = os.path.splitext(filepath)
+    return '{}.{}{}'.format(root, hashlib.sha1(body).hexdigest()[:10], ext)
+
+
+def build(static_dir=STATIC_DIR):
+    """Write the fingerprinted assets and their manifest.
+
+    Returns the manifest {filepath: fingerprinted filepath}.
+    """
+    dist_dir = os.path.join(static_dir, DIST)
+    manifest = {}
+    for asset_dir in ASSET_DIRS:
+        for filename in sorted(os.listdir(os.path.join(static_dir, asset_dir))):
+            filepath = '{}/{}'.format(asset_dir, filename)
+            realpath = os.path.realpath(os.path.join(static_dir, filepath))
+            if not os.path.isfile(realpath):
+                continue
+            with open(realpath, 'rb') as infile:
+                body = infile.read()
+
+            # base.min.js is a symlink to base.js so minify it here
+            minifier = MINIFIERS.get(asset_dir)
+            if '.min.' not in os.path.basename(realpath) and minifier:
+                body = minifier(body.decode('utf-8')).encode('utf-8')
+
+            hashed = '{}/{}'.format(DIST, fingerprint(filepath, body))
+            outpath = os.path.join(static_dir, hashed)
+            if not os.path.isdir(os.path.dirname(outpath)):
+                os.makedirs(os.path.dirname(outpath))
+            if not os.path.exists(outpath):
+                with open(outpath, 'wb') as outfile:
+                    outfile.write(body)
+            manifest[filepath] = hashed
+            logging.info('{} -> {} ({} bytes)'.format(
+                filepath, hashed, len(body)))
+
+    # Old fingerprinted files are kept for pages rendered before this build
+    manifest_path = os.path.join(dist_dir, MANIFEST)
+    tmppath = '{}.{}.tmp'.format(manifest_path, os.getpid())
+    with open(tmppath, 'w') as outfile:
+        json.dump(manifest, outfile, indent=2, sort_keys=True)
+    os.rename(tmppath, manifest_path)
+    return manifest
+
+
+def get_manifest(static_dir=STATIC_DIR):
+    """Return the manifest of the last build or {} if there is none."""
+    global _manifest
+    manifest_path = os.path.join(static_dir, DIST, MANIFEST)
+    try:
+        mtime = os.stat(manifest_path).st_mtime
+    except OSError:
+        return {}
+    if _manifest[0] != mtime:
+        try:
+            with open(manifest_path) as infile:
+                _manifest = (mtime, json.load(infile))
+        except (IOError, OSError, ValueError) as e:
+            logging.error('Unable to read {}: {}'.format(manifest_path, e))
+            return {}
+    return _manifest[1]
+
+
+def get_asset(filepath):
+    """Return the fingerprinted filepath of an asset (or filepath)."""
+    return get_manifest().get(filepath, filepath)
+
+
+def is_fingerprinted(filepath):
+    return filepath.startswith('{}/'.format(DIST))
+
+
+def get_sendfile_header(filepath, static_dir=STATIC_DIR):
+    """Return a 2-tuple (header, value) which makes the front server send
+    this file or None if SENDFILE is off.
+    """
+    if SENDFILE == 'x-sendfile':
+        return ('X-Sendfile',
+                os.path.abspath(os.path.join(static_dir, filepath)))
+    if SENDFILE == 'x-accel-redirect':
+        return ('X-Accel-Redirect',
+                '{}/{}'.format(SENDFILE_PREFIX.rstrip('/'), filepath))
+    return None
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    build(sys.argv[1] if len(sys.argv) > 1 else STATIC_DIR)
+
+
+### EOF ###
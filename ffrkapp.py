@@ -4,15 +4,19 @@ import json
 import os
 import sys
 import logging
+import mimetypes
+
+import arrow
 
 from bottle import Bottle, redirect, request, response, TEMPLATE_PATH, error,\
-    abort, static_file, BaseRequest, jinja2_view as view, Jinja2Template
+    abort, static_file, BaseRequest, jinja2_view as view, Jinja2Template,\
+    HTTPResponse, http_date, parse_date
 from bottle.ext import sqlalchemy
-from sqlalchemy import tuple_, func
 
-from time import time
 
+import assets
 import models.models as models
+from models import ingest
 
 
 ### BOTTLE INIT START ###
@@ -31,9 +35,19 @@ def error404(e):
     return {'error': e.body}
 
 
-Jinja2Template.defaults['url'] = app.get_url
-Jinja2Template.defaults['get_active_events'] = models.get_active_events
-Jinja2Template.defaults['get_content_dates'] = models.get_content_dates
+def get_url(routename, **kargs):
+    """Return app.get_url() but with static files fingerprinted.
+    See assets.build().
+    """
+    if routename == 'static' and 'filepath' in kargs:
+        kargs['filepath'] = assets.get_asset(kargs['filepath'])
+    return app.get_url(routename, **kargs)
+
+
+Jinja2Template.defaults['url'] = get_url
+# These are cached since every page (even an error page) renders them
+Jinja2Template.defaults['get_active_events'] = models.get_nav_active_events
+Jinja2Template.defaults['get_content_dates'] = models.get_nav_content_dates
 ### BOTTLE INIT END ###
 
 
@@ -41,6 +55,110 @@ def minify_json(data):
     """Return a json string as small as possible."""
     return json.dumps(data, default=models.default_encode, separators=(',',':'))
 
+def get_fields():
+    """Return the field names of the comma separated fields parameter
+    or None if it is absent.
+    """
+    fields = request.GET.get('fields')
+    if not fields:
+        return None
+    return tuple(f.strip() for f in fields.split(',') if f.strip())
+
+def get_gzip_etag(etag):
+    """Return the ETag of the gzipped body of a data version ETag."""
+    return '{}-gzip"'.format(etag[:-1])
+
+def check_data_version():
+    """Set the ETag and Last-Modified headers from the data version.
+
+    Raise a 304 Not Modified if the client already has this version so
+    the caller does not run its queries at all.
+    The data only changes when /post imports something.
+    The gzipped body has its own ETag (See send_json()) and either one
+    matches If-None-Match.
+    """
+    version, last_modified = models.get_data_version()
+    if version is None:
+        return
+    etag = '"{}"'.format(version)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        # Ask browsers to revalidate (which is cheap) instead of guessing
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding',
+    }
+    for k, v in headers.items():
+        response.set_header(k, v)
+
+    if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+    if if_none_match is not None:
+        etags = (etag, get_gzip_etag(etag))
+        for tag in if_none_match.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == '*' or tag in etags:
+                # Echo the representation the client has
+                if tag != '*':
+                    headers['ETag'] = tag
+                raise HTTPResponse(status=304, **headers)
+        return
+
+    if_modified_since = parse_date(
+        request.environ.get('HTTP_IF_MODIFIED_SINCE', '').split(';')[0])
+    if if_modified_since is not None and if_modified_since >= last_modified:
+        raise HTTPResponse(status=304, **headers)
+
+
+def accepts_gzip():
+    """Return True if the Accept-Encoding header allows gzip."""
+    accept_encoding = request.environ.get('HTTP_ACCEPT_ENCODING', '')
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        if params[0].strip().lower() not in ('gzip', 'x-gzip', '*'):
+            continue
+        q = 1.0
+        for param in params[1:]:
+            k, _, v = param.partition('=')
+            if k.strip().lower() == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        return q > 0
+    return False
+
+
+def send_json(body, gzipped=None):
+    """Return a JSON string (gzipped if the client accepts it).
+
+    gzipped is an optional callable returning an already compressed body
+    (or None). Otherwise the compressed body is cached per data version and
+    URL so it is only compressed once.
+    """
+    response.set_header('Vary', 'Accept-Encoding')
+    if len(body) < models.COMPRESS_MIN_SIZE or not accepts_gzip():
+        return body
+
+    ret = None
+    if gzipped is not None:
+        ret = gzipped()
+    if ret is None:
+        version = models.get_data_version()[0]
+        key = None
+        if version is not None:
+            key = (version, request.path, request.query_string)
+        ret = models.get_gzip(key, body)
+    if ret is None:
+        return body
+    response.set_header('Content-Encoding', 'gzip')
+    etag = response.get_header('ETag')
+    if etag is not None:
+        response.set_header('ETag', get_gzip_etag(etag))
+    return ret
+
+
 def save_json(data, filepath='/tmp/ffrk.json', min=False):
     logging.debug('Writing {}'.format(filepath))
     if min:
@@ -59,6 +177,8 @@ def dff(filepath):
 @app.get('/static/<filepath:path>', name='static')
 def statics(filepath):
     root = 'static'
+    if assets.is_fingerprinted(filepath):
+        return send_static(filepath, root, assets.IMMUTABLE_CACHE_CONTROL)
     for ext in ('js', 'css'):
         if filepath.endswith('.{}'.format(ext)):
             root = os.path.join(root, ext)
@@ -73,9 +193,29 @@ def statics(filepath):
         if filepath.startswith('{}/'.format(subfolder)):
             filepath = filepath[len('{}/'.format(subfolder)):]
     '''
-    logging.warning('Serving "{}" from the backend'.format(
+    logging.debug('Serving "{}" from the backend'.format(
         os.path.join(os.getcwd(), root, filepath)))
-    return static_file(filepath, root=root)
+    return send_static(filepath, root)
+
+
+def send_static(filepath, root, cache_control=None):
+    """Return a static file (or let the front server send it)."""
+    path = os.path.abspath(os.path.join(root, filepath))
+    sendfile = assets.get_sendfile_header(
+        os.path.relpath(path, assets.STATIC_DIR))
+    if sendfile is not None:
+        if not path.startswith(os.path.abspath(root) + os.sep) or\
+           not os.path.isfile(path):
+            abort(404, 'File does not exist.')
+        resp = HTTPResponse('')
+        resp.set_header(*sendfile)
+        resp.content_type = mimetypes.guess_type(filepath)[0] or\
+            'application/octet-stream'
+    else:
+        resp = static_file(filepath, root=root)
+    if cache_control is not None and resp.status_code in (200, 206, 304):
+        resp.set_header('Cache-Control', cache_control)
+    return resp
 
 
 @app.get('/robots.txt')
@@ -147,7 +287,19 @@ def home(category=None):
             break
     if not columns:
         abort(404, 'Unknown category "{}"'.format(category))
-    context = {'rarity': rarity, 'category': category, 'columns': columns}
+    context = {
+        'rarity': rarity,
+        'category': category,
+        'columns': columns,
+        'data_url': '{}?category={}&rarity={}&fields={}'.format(
+            app.get_url('json'), category, rarity,
+            ','.join(c for c, t in columns)),
+        'side_pagination': 'client',
+    }
+    if category in ('log', 'logs'):
+        # There are too many logs to send them all at once
+        context['data_url'] = app.get_url('json_logs')
+        context['side_pagination'] = 'server'
 
     try:
         return context
@@ -166,7 +318,7 @@ def character():
     context = {
         'o': models.Character,
         'data_url': '{}?category=character'.format(app.get_url('json')),
-        'realms': [(0, 'No RS')] + models.get_realms(),
+        'realms': [(0, 'No RS')] + models.get_nav_realms(),
     }
     return context
 
@@ -187,64 +339,16 @@ def ability():
 @app.get('/abilities.json', name='json_abilities')
 @app.get('/json/abilities')
 def json_ability():
-    """Get JSON for abilities and materials."""
-
+    """Get JSON for the ability grid.
+    See models.matrix.build_ability_matrix() for the format.
+    """
+    check_data_version()
     response.content_type = 'application/json; charset=UTF8'
 
-    with models.session_scope() as session:
-        # Get the first object per models.Ability
-        q = session.query(models.Ability)\
-                   .order_by(models.Ability.name)\
-                   .group_by(models.Ability.name)
-        abilities = q.all()
-
-        # These are the our internal ability_ids for the next query
-        ability_ids = (i.id for i in abilities)
-
-        # Get all of the models.AbilityCost per ability
-        q = session.query(models.AbilityCost)\
-                   .filter(models.AbilityCost.ability_id.in_(ability_ids))
-        ability_costs = q.all()
-
-        # Get all of the materials
-        q = session.query(models.Material)
-        materials = q.all()
-
-        session.expunge_all()
-
-    # Clean up the data
-    abilities = (
-        {
-            'id': a.id,
-            'name': a.name,
-            'rarity': a.rarity,
-            'search_id': a.search_id,
-        } for a in abilities
-    )
-
-    ability_costs = (
-        {
-            'ability_id': ac.ability_id,
-            'material_id': ac.material_id,
-        } for ac in ability_costs
-    )
-
-    materials = (
-        {
-            'id': m.id,
-            'name': m.name.split()[-2],
-            'rarity': m.rarity
-        } for m in materials
-    )
-
-    ret = {
-        'abilities': abilities,
-        'ability_costs': ability_costs,
-        'materials': materials,
-    }
-
+    # This is only rebuilt when the data version changes
+    ret = models.get_ability_matrix()
     if ret:
-        return minify_json(ret)
+        return send_json(ret)
 
     response.status = 404
     return minify_json({'success':False, 'error':'No results found'})
@@ -296,6 +400,7 @@ def dungeons():
 @app.get('/json/dungeons')
 def json_dungeons():
     """Get JSON for dungeon listings."""
+    check_data_version()
     response.content_type = 'application/json; charset=UTF8'
 
     content = request.GET.get('content')
@@ -329,7 +434,28 @@ def json_dungeons():
         outlist.append(row)
 
     if outlist:
-        return minify_json(outlist)
+        return send_json(minify_json(outlist))
+
+    response.status = 404
+    return minify_json({'success':False, 'error':'No results found'})
+
+
+@app.get('/weaknesses.json', name='json_weaknesses')
+@app.get('/json/weaknesses')
+def json_weaknesses():
+    """Get JSON for the enemy weakness (resistance) matrix.
+
+    Every attribute is a column and every param_id a row so this may be
+    joined to the enemy table by search_id.
+    See models.enemy.build_weakness_matrix() for the format.
+    """
+    check_data_version()
+    response.content_type = 'application/json; charset=UTF8'
+
+    # This is only rebuilt when the data version changes
+    ret = models.get_weakness_matrix()
+    if ret:
+        return send_json(ret)
 
     response.status = 404
     return minify_json({'success':False, 'error':'No results found'})
@@ -338,18 +464,32 @@ def json_dungeons():
 @app.get('/json/<id:int>', name='json_id')
 def get_json_by_id(id):
     """Get JSON for an object (or all similar objects)."""
+    check_data_version()
     response.content_type = 'application/json; charset=UTF8'
 
     all = request.GET.get('all', False)
     enemy = request.GET.get('enemy', False)
+    fields = get_fields()
+    if fields:
+        # Select only these columns instead of loading whole objects
+        try:
+            r = models.load_fields_by_id(id, fields, all=all, enemy=enemy)
+        except ValueError as e:
+            response.status = 400
+            return minify_json({'success':False, 'error':str(e)})
+        if r:
+            return send_json(minify_json(r))
+        response.status = 404
+        return minify_json({'success':False, 'error':'No results found'})
+
     r = models.get_by_id(id, all=all, enemy=enemy)
 
     if r:
         if hasattr(r, 'jsonify'):
             # This is a single object
-            return r.jsonify()
+            return send_json(r.jsonify())
         # We have a list of objects
-        return minify_json([i.dict() for i in r])
+        return send_json(minify_json(type(r[0]).dicts(r)))
 
     response.status = 404
     return minify_json({'success':False, 'error':'No results found'})
@@ -358,6 +498,7 @@ def get_json_by_id(id):
 @app.get('/json', name='json')
 def get_json():
     """Get JSON for a category (table)."""
+    check_data_version()
     response.content_type = 'application/json; charset=UTF8'
 
     category = request.GET.get('category', None) or\
@@ -367,139 +508,92 @@ def get_json():
         return minify_json({'success':False, 'error':'Unknown category'})
     category = category.lower()
 
-    rarity = request.GET.get('rarity', 'all').lower()
-    with models.session_scope() as session:
-        q = None
-        # category, model, order_by, group_by, rarity, limit, filter
-        for c, m, o, g, r, l, f in (
-            (('material', 'materials'),
-             models.Material, models.Material.id, models.Material.id,
-             False, None, None),
-            (('ability', 'abilities'),
-             models.Ability, models.Ability.name, models.Ability.name,
-             False, None, None),
-            (('enemy', 'enemies'),
-             models.Enemy, models.Enemy.name, models.Enemy.enemy_id,
-             True, None, None),
-             #'name', True, None, None),
-             #'enemy_id', True, None, None),
-             #'param_id', True, None, None),
-             # TODO 2015-05-18
-             # Filter out blank names (or group such that the non-blanks win)
-            (('relic', 'relics'),
-             models.Relic, models.Relic.name, models.Relic.name,
-             False, None, None),
-            (('world', 'worlds'),
-             models.World, models.World.id, models.World.id,
-             True, None, None),
-            (('dungeon', 'dungeons'),
-             models.Dungeon, models.Dungeon.id, models.Dungeon.id,
-             True, None, models.Dungeon.world_id),
-            # TODO 2015-05-07
-            # Enhance server-side pagination for Log
-            # request.GET.get('offset', 0)
-            # request.GET.get('limit', 25)
-            (('log', 'logs'),
-             models.Log, models.Log.timestamp.desc(), models.Log.id,
-             True, 100, None),
-            (('character', 'characters'),
-             models.Character, models.Character.name, models.Character.buddy_id,
-             True, None, models.Character.level),
-            (('quest', 'quests'),
-             models.Quest, models.Quest.id, models.Quest.id,
-             True, None, None),
-        ):
-            if category in c:
-                q = session.query(m).order_by(o).group_by(g).limit(l)
-                #q = session.query(models.Relic).filter(models.Relic.series_id.notlike(1)).group_by('name').order_by('name')
-                if r:
-                    rarity = 'all'
-                break
-        if q is None:
-            response.status = 404
-            return minify_json({'success':False, 'error':'Unknown category'})
-        if rarity != 'all':
-            # Some tables do not have a rarity column
-            q = q.filter_by(rarity=rarity)
-        filter = request.GET.get('filter')
-        if filter is not None and f is not None:
-            # Filter Character by level
-            if 'character' in c:
-                q = q.filter(f <= filter)
-            else:
-                q = q.filter(f == filter)
-        elif 'character' in c:
-            # If we are not filtering Character by level
-            # Then we want to return one row per buddy_id corresponding
-            # to the highest level
-            t = tuple_(models.Character.buddy_id, models.Character.level)
-            sq = session.query(models.Character.buddy_id,
-                               func.max(models.Character.level))\
-                        .group_by(models.Character.buddy_id)
-            q = q.filter(t.in_(sq))
-        elif 'enemy' in c:
-            # We want to ensure that the "main" param_id is returned
-            #q = q.filter(models.Enemy.name != '')
-            # This fails for "Sinspawn Gui" (4100101)
-
-            # This fails for "Angler Whelk" (4060291)
-            t = tuple_(models.Enemy.enemy_id, models.Enemy.param_id)
-            sq = session.query(models.Enemy.enemy_id,
-                               func.min(models.Enemy.param_id))\
-                        .group_by(models.Enemy.enemy_id)
-            q = q.filter(t.in_(sq))
-        q = q.all()
-        if q:
-            return minify_json([i.dict() for i in q])
+    if models.get_category(category) is None:
         response.status = 404
-        return minify_json({'success':False, 'error':'No results found'})
+        return minify_json({'success':False, 'error':'Unknown category'})
+
+    # The snapshot is only rebuilt after an importer writes new rows
+    # See models.snapshot.rebuild_on_import()
+    rarity = request.GET.get('rarity', 'all').lower()
+    filter = request.GET.get('filter')
+    fields = get_fields()
+    # fields are only the columns the table shows (plus id and search_id)
+    try:
+        ret = models.get_snapshot(category, rarity, filter, fields)
+    except ValueError as e:
+        response.status = 400
+        return minify_json({'success':False, 'error':str(e)})
+    if ret:
+        return send_json(ret, lambda: models.get_snapshot_gzip(
+            category, rarity, filter, fields))
+    response.status = 404
+    return minify_json({'success':False, 'error':'No results found'})
+
 
+@app.get('/logs.json', name='json_logs')
+@app.get('/json/logs')
+def json_logs():
+    """Get one page of JSON for the log table.
+
+    Corresponds with bootstrap-table server side pagination.
+    Pass before_id (the last id on the previous page) instead of offset
+    when paging forward so deep pages stay as cheap as the first one.
+    Logs are always newest first and at most models.log.LOG_MAX_PAGE_SIZE per
+    page so the table offers neither sorting nor "All" (See table.html).
+    """
+    check_data_version()
+    response.content_type = 'application/json; charset=UTF8'
 
-@app.post('/post', method='POST')
+    try:
+        before_id = request.GET.get('before_id') or None
+        if before_id is not None:
+            before_id = int(before_id)
+        offset = max(0, int(request.GET.get('offset', 0)))
+        limit = int(request.GET.get('limit', models.LOG_PAGE_SIZE))
+        since, until = (
+            arrow.get(request.GET[k]).to('utc').naive
+            if request.GET.get(k) else None
+            for k in ('since', 'until'))
+    except (ValueError, TypeError, arrow.parser.ParserError) as e:
+        response.status = 400
+        return minify_json({'success':False, 'error':str(e)})
+
+    total, logs = models.get_logs(
+        before_id=before_id, offset=offset, limit=limit,
+        search=request.GET.getunicode('search') or None,
+        since=since, until=until)
+    return send_json(
+        minify_json({'total': total, 'rows': models.Log.dicts(logs)}))
+
+
+@app.post('/post', name='post')
 def post():
-    """Parse a new FFRK response (intercepted from a client).
+    """Queue a new FFRK response (intercepted from a client).
 
     This is basically the same thing as ffrk_mitm.response() except that
     here we pick the proper function from the 'action' key instead of
     flow.request.path.
+    The payload is only validated here and imported by a worker
+    (See models.ingest) so respond with 202 and a ticket for url('post_status').
+    Content we imported recently is dropped with a 200 instead.
     """
     #abort(401, '401 Unauthorized')
     response.content_type = 'application/json; charset=UTF8'
     try:
         data = request.json
-        if data is None:
-            response.status = 501
-            return minify_json({'success':False, 'error':'No data'})
-
-        action = data.get('action')
-        if action is None:
+        try:
+            ticket = ingest.enqueue(data)
+        except ValueError as e:
             response.status = 501
-            return minify_json({'success':False, 'error':'Unknown action'})
-
-        filepath = os.path.join(
-            os.environ.get('OPENSHIFT_DATA_DIR', '/tmp'),
-            'post',
-            '{}-{:0.0f}.json'.format(
-                action.lstrip('/').replace('/', '_'),
-                time()*1000000
-            )
-        )
-        #save_json(data, filepath=filepath, min=True)
-        #del (data['action'])
-        for a, m in (
-                ('get_battle_init_data', models.import_battle),
-                ('/dff/world/battles', models.import_battle_list),
-                ('/dff/world/dungeons', models.import_world),
-                ('win_battle', models.import_win_battle),
-        ):
-            if action == a:
-                if m(data=data, filepath=filepath):
-                    return minify_json({'success': True})
-                else:
-                    response.status = 501
-                    return minify_json({'success':False, 'error':'Bad data'})
-        response.status = 501
-        return minify_json({'success':False, 'error':'Unknown action'})
+            return minify_json({'success':False, 'error':str(e)})
+        if ticket is None:
+            # We already imported this content
+            return minify_json({'success': True, 'duplicate': True})
+        status_url = app.get_url('post_status', ticket=ticket)
+        response.status = 202
+        response.set_header('Location', status_url)
+        return minify_json(
+            {'success': True, 'ticket': ticket, 'status_url': status_url})
     except Exception as e:
         logging.error(e)
         logging.error('exc_info=True', exc_info=True)
@@ -512,4 +606,16 @@ def post():
         )
 
 
+@app.get('/post/<ticket:re:[0-9a-f]+>', name='post_status')
+def post_status(ticket):
+    """Get the outcome of a queued /post."""
+    response.content_type = 'application/json; charset=UTF8'
+    response.set_header('Cache-Control', 'no-cache')
+    status = ingest.get_status(ticket)
+    if status is None:
+        response.status = 404
+        return minify_json({'success':False, 'error':'Unknown ticket'})
+    return minify_json(status)
+
+
 ### EOF ###
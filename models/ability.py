@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 from sqlalchemy.dialects.mysql import TINYINT, SMALLINT
 from sqlalchemy.orm import relationship, backref
 
@@ -40,6 +40,9 @@ class AbilityCost(BetterBase):
 
 class Ability(BetterBase):
     __tablename__ = 'ability'
+    __table_args__ = (
+        Index('ix_ability_ability_id_grade', 'ability_id', 'grade'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     ability_id = Column(Integer, nullable=False)
     name = Column(String(length=32), nullable=False)
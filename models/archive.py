@@ -0,0 +1,344 @@
+from __future__ import absolute_import
+
+import argparse
+import fcntl
+import gzip
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import arrow
+
+
+ARCHIVE_DIR = os.path.join(
+    os.environ.get('OPENSHIFT_DATA_DIR', '/tmp'), 'archive')
+
+# Payloads are appended to the active segment, which is sealed (renamed after
+# its first ticket) once it is this big (in bytes) or this old (in seconds)
+# and then compressed by compact().
+SEGMENT_SIZE = int(os.environ.get('FFRK_ARCHIVE_SEGMENT_SIZE',
+                                  64 * 1024 * 1024))
+SEGMENT_AGE = 24 * 3600
+
+# Segments are compressed once so they can afford the slowest level
+ARCHIVE_COMPRESS_LEVEL = 9
+
+ACTIVE = 'active.jsonl'
+INDEX = 'index.json'
+LOCK = 'archive.lock'
+COMPACT_LOCK = 'compact.lock'
+
+# Log the progress of replay() every this many payloads
+REPLAY_PROGRESS = 1000
+
+
+def get_path(filename):
+    return os.path.join(ARCHIVE_DIR, filename)
+
+
+@contextmanager
+def archive_lock(filename=LOCK, blocking=True):
+    '''
+    Hold an exclusive lock shared by every process using the archive.
+
+    Yields False (and holds nothing) if blocking is False and another
+    process has the lock.
+    '''
+    if not os.path.isdir(ARCHIVE_DIR):
+        os.makedirs(ARCHIVE_DIR)
+    with open(get_path(filename), 'a') as lockfile:
+        flags = fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lockfile, flags)
+        except (IOError, OSError):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def read_first(filepath):
+    '''
+    Return the first record of an uncompressed segment or None.
+    '''
+    try:
+        with open(filepath) as infile:
+            return json.loads(infile.readline())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def seal_active():
+    '''
+    Rename the active segment after its first ticket so the next payload
+    starts a new one. The caller must hold archive_lock().
+    '''
+    filepath = get_path(ACTIVE)
+    first = read_first(filepath)
+    if first is None:
+        return None
+    filename = '{}.jsonl'.format(first['ticket'])
+    os.rename(filepath, get_path(filename))
+    logging.info('Sealed archive segment {}'.format(filename))
+    return filename
+
+
+def append(action, data, ticket, timestamp=None):
+    '''
+    Append a /post payload to the archive.
+
+    A record is a single line of JSON written with one write() while holding
+    the lock so concurrent processes never interleave.
+    '''
+    if timestamp is None:
+        timestamp = time.time()
+    record = json.dumps(
+        {'ticket': ticket, 'time': round(timestamp, 3), 'action': action,
+         'data': data}, separators=(',',':'))
+    record = '{}\n'.format(record)
+    with archive_lock():
+        filepath = get_path(ACTIVE)
+        try:
+            size = os.path.getsize(filepath)
+        except OSError:
+            size = 0
+        if size and size + len(record) > SEGMENT_SIZE:
+            seal_active()
+        with open(filepath, 'a') as outfile:
+            outfile.write(record)
+
+
+def load_index():
+    '''
+    Return a dict of segment filename to its index entry (See compress()).
+    '''
+    try:
+        with open(get_path(INDEX)) as infile:
+            return json.load(infile)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def compress(filename):
+    '''
+    Compress a sealed segment and add it to the index.
+
+    Returns the index entry: the first and last time in the segment and the
+    number of records per action.
+    '''
+    filepath = get_path(filename)
+    gz_filename = '{}.gz'.format(filename)
+    tmppath = '{}.{}.tmp'.format(get_path(gz_filename), os.getpid())
+    entry = {'first': None, 'last': None, 'records': 0, 'actions': {}}
+    with open(filepath) as infile, gzip.open(
+            tmppath, 'wt', compresslevel=ARCHIVE_COMPRESS_LEVEL) as outfile:
+        for line in infile:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                logging.warning('Dropped a partial record from {}'.format(
+                    filename))
+                continue
+            outfile.write(line)
+            t = record['time']
+            if entry['first'] is None or t < entry['first']:
+                entry['first'] = t
+            if entry['last'] is None or t > entry['last']:
+                entry['last'] = t
+            entry['records'] += 1
+            entry['actions'][record['action']] =\
+                entry['actions'].get(record['action'], 0) + 1
+    os.rename(tmppath, get_path(gz_filename))
+
+    with archive_lock():
+        index = load_index()
+        index[gz_filename] = entry
+        tmppath = '{}.{}.tmp'.format(get_path(INDEX), os.getpid())
+        with open(tmppath, 'w') as outfile:
+            json.dump(index, outfile, sort_keys=True, indent=1)
+        os.rename(tmppath, get_path(INDEX))
+    os.remove(filepath)
+    logging.info('Compressed archive segment {} ({} record(s))'.format(
+        filename, entry['records']))
+    return entry
+
+
+def list_segments():
+    '''
+    Return the filenames of every segment, oldest first, with the active
+    segment last.
+    '''
+    try:
+        filenames = os.listdir(ARCHIVE_DIR)
+    except OSError:
+        return []
+    segments = sorted(f for f in filenames
+                      if f.endswith(('.jsonl', '.jsonl.gz')) and f != ACTIVE)
+    if ACTIVE in filenames:
+        segments.append(ACTIVE)
+    return segments
+
+
+def compact(max_age=SEGMENT_AGE):
+    '''
+    Seal the active segment if its first record is older than max_age seconds
+    and compress every sealed segment.
+
+    Only one process compacts at a time; the others return None right away.
+    Returns the number of segments compressed.
+    '''
+    with archive_lock(COMPACT_LOCK, blocking=False) as locked:
+        if not locked:
+            return None
+        with archive_lock():
+            first = read_first(get_path(ACTIVE))
+            if first is not None and first['time'] < time.time() - max_age:
+                seal_active()
+        count = 0
+        for filename in list_segments():
+            if filename.endswith('.jsonl') and filename != ACTIVE:
+                compress(filename)
+                count += 1
+        return count
+
+
+def iter_records(actions=None, since=None, until=None):
+    '''
+    Yield the 2-tuples (segment, record) of the archive oldest first.
+
+    actions, since and until (unix times) filter the records; the index lets
+    us skip compressed segments without opening them.
+    Segments are not compressed while this runs.
+    '''
+    with archive_lock(COMPACT_LOCK):
+        index = load_index()
+        for filename in list_segments():
+            entry = index.get(filename)
+            if entry is not None and (
+                    (since is not None and entry['last'] < since) or
+                    (until is not None and entry['first'] > until) or
+                    (actions and not set(actions) & set(entry['actions']))):
+                continue
+            opener = gzip.open if filename.endswith('.gz') else open
+            try:
+                infile = opener(get_path(filename), 'rt')
+            except (IOError, OSError):
+                continue
+            with infile:
+                for line in infile:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A record still being written
+                        continue
+                    if actions and record['action'] not in actions:
+                        continue
+                    if since is not None and record['time'] < since:
+                        continue
+                    if until is not None and record['time'] > until:
+                        continue
+                    yield filename, record
+
+
+def replay(actions=None, since=None, until=None, dry_run=False):
+    '''
+    Import the archived payloads again, in the order they were posted.
+
+    Returns a 2-tuple of the number of payloads imported and failed.
+    '''
+    # ingest archives every payload it queues
+    from .ingest import IMPORTERS, get_stage
+
+    imported = failed = 0
+    start = time.time()
+    for filename, record in iter_records(actions, since, until):
+        stage = get_stage(record['action'])
+        if stage is None:
+            logging.warning('No importer for {} {}'.format(
+                record['action'], record['ticket']))
+            failed += 1
+            continue
+        if dry_run:
+            imported += 1
+            continue
+        importer = IMPORTERS[stage][1]
+        filepath = '{}#{}'.format(get_path(filename), record['ticket'])
+        try:
+            success = importer(data=record['data'], filepath=filepath)
+        except Exception as e:
+            logging.error('Unable to import {}: {}'.format(filepath, e))
+            logging.error('exc_info=True', exc_info=True)
+            success = False
+        if success:
+            imported += 1
+        else:
+            failed += 1
+        if (imported + failed) % REPLAY_PROGRESS == 0:
+            logging.info('Replayed {} payload(s) ({:.1f}/s)'.format(
+                imported + failed,
+                (imported + failed) / max(time.time() - start, 0.001)))
+    logging.info('Replayed {} payload(s), {} failed, in {:.1f}s'.format(
+        imported + failed, failed, time.time() - start))
+    return imported, failed
+
+
+def parse_time(value):
+    return arrow.get(value).float_timestamp
+
+
+def main(argv=None):
+    '''
+    Manage the archive of /post payloads.
+
+    python -m models.archive list
+    python -m models.archive compact
+    python -m models.archive replay [--action ACTION] [--since T] [--until T]
+    '''
+    parser = argparse.ArgumentParser(
+        description=main.__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=('list', 'compact', 'replay'))
+    parser.add_argument('--action', action='append', dest='actions',
+                        help='Only replay this action (repeatable)')
+    parser.add_argument('--since', type=parse_time,
+                        help='Only replay payloads posted at or after this')
+    parser.add_argument('--until', type=parse_time,
+                        help='Only replay payloads posted at or before this')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Count the payloads replay would import')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'list':
+        index = load_index()
+        for filename in list_segments():
+            entry = index.get(filename)
+            size = os.path.getsize(get_path(filename))
+            if entry is None:
+                print('{}\t{} bytes (not compressed)'.format(filename, size))
+                continue
+            print('{}\t{} bytes\t{} record(s)\t{} - {}\t{}'.format(
+                filename, size, entry['records'],
+                arrow.get(entry['first']), arrow.get(entry['last']),
+                ', '.join('{}={}'.format(k, v)
+                          for k, v in sorted(entry['actions'].items()))))
+    elif args.command == 'compact':
+        compact()
+    else:
+        imported, failed = replay(args.actions, args.since, args.until,
+                                  args.dry_run)
+        if failed:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+
+### EOF ###
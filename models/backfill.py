@@ -0,0 +1,492 @@
+from __future__ import absolute_import
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from itertools import chain
+
+from .base import engine, session_scope
+from . import archive, models
+from .bulk import chunks
+from .condition import Condition
+from .drop import Drop
+from .enemy import Attribute
+from .material import Material
+
+
+# Log the progress of run() at most this often (in seconds)
+PROGRESS_INTERVAL = 10
+
+# Rows of these kinds are only ever created, never updated, so payloads only
+# share them if the row does not exist before the backfill starts.
+CREATE_ONLY = ('drop', 'material', 'attribute', 'condition')
+
+# The keys of a payload are the rows it writes (or whose state decides what
+# it writes). Payloads which share a key are imported by the same worker in
+# the order they were captured (See partition()). ('id', search_id) stands for an object and
+# everything hanging off it (See models.search.SEARCH_MODELS).
+
+def keys_party(data):
+    for e in data.get('equipments', ()):
+        yield 'id', e['equipment_id']
+    for m in data.get('materials', ()):
+        yield 'material', m['id']
+    for c in data.get('buddies', ()):
+        yield 'id', c['buddy_id']
+
+
+def keys_dff(data):
+    for c in data['buddy']:
+        yield 'id', c['buddy_id']
+
+
+def keys_recipes(data):
+    for grades in data['recipe'].values():
+        for a in grades.values():
+            yield 'id', a['ability_id']
+
+
+def keys_quests(data):
+    for quest in data['quests']:
+        yield 'id', quest['id']
+        for prize in quest['prizes']:
+            yield 'drop', prize['id']
+
+
+def keys_world(data):
+    yield 'id', data['world']['id']
+    for dungeon in data.get('dungeons', []):
+        yield 'id', dungeon['id']
+        for prizes in dungeon['prizes'].values():
+            for prize in prizes:
+                yield 'drop', prize['id']
+
+
+def keys_battle_list(data):
+    for battle in data['battles']:
+        yield 'id', battle['id']
+
+
+def keys_battle(data):
+    battle = data['battle']
+    yield 'id', battle['battle_id']
+    for round in battle['rounds']:
+        for enemy in round['enemy']:
+            for e in enemy['children']:
+                for drop in e['drop_item_list']:
+                    if drop.get('item_id') is not None:
+                        yield 'drop', drop['item_id']
+                params = e['params']
+                if isinstance(params, dict):
+                    params = (params, )
+                for p in params:
+                    yield 'id', p['id']
+                    for a in p['def_attributes']:
+                        yield 'attribute', (int(a['attribute_id']),
+                                            int(a['factor']))
+
+
+def keys_win_battle(data):
+    yield 'id', data['battle_id']
+    score = data['result']['score']
+    for s in score['general'] + score['specific']:
+        yield 'condition', (s['title'], s['id'], s['code_name'])
+
+
+# Stages of (action, importer, keys)
+# A stage starts once every payload of the stages before it was imported so
+# it may read what they wrote (ie: recipes need the materials of the party
+# and the enemies of a battle need the battle).
+STAGES = (
+    (
+        ('/dff/party/list', models.import_party, keys_party),
+        ('/dff/', models.import_dff, keys_dff),
+    ),
+    (
+        ('/dff/ability/get_generation_recipes', models.import_recipes,
+         keys_recipes),
+        ('/dff/ability/get_upgrade_recipes', models.import_recipes,
+         keys_recipes),
+        ('/dff/quest/list', models.import_quests, keys_quests),
+    ),
+    (
+        ('/dff/world/dungeons', models.import_world, keys_world),
+    ),
+    (
+        ('/dff/world/battles', models.import_battle_list, keys_battle_list),
+    ),
+    (
+        ('get_battle_init_data', models.import_battle, keys_battle),
+        ('/dff/battle/get_battle_init_data', models.import_battle,
+         keys_battle),
+    ),
+    (
+        ('win_battle', models.import_win_battle, keys_win_battle),
+        ('/dff/battle/win', models.import_win_battle, keys_win_battle),
+        ('/dff/event/wday/9/win_battle', models.import_win_battle,
+         keys_win_battle),
+    ),
+)
+
+# action: (stage, importer, keys)
+ACTIONS = dict((action, (i, importer, keys))
+               for i, stage in enumerate(STAGES)
+               for action, importer, keys in stage)
+
+
+def get_existing_keys(keys):
+    '''
+    Return the subset of the CREATE_ONLY keys whose rows already exist.
+    '''
+    values = dict((kind, set()) for kind in CREATE_ONLY)
+    for kind, value in keys:
+        if kind in values:
+            values[kind].add(value)
+
+    ret = set()
+    with session_scope() as session:
+        for kind, column in (('drop', Drop.id), ('material', Material.id)):
+            for chunk in chunks(values[kind]):
+                ret.update((kind, i) for (i, ) in
+                           session.query(column).filter(column.in_(chunk)))
+        # There are only a few dozen of these
+        ret.update(('attribute', tuple(row)) for row in session.query(
+            Attribute.attribute_id, Attribute.factor))
+        ret.update(('condition', tuple(row)) for row in session.query(
+            Condition.title, Condition.condition_id, Condition.code_name))
+    return ret
+
+
+def strongly_connected(graph):
+    '''
+    Yield the strongly connected components (as sets) of graph, a dict of
+    node to the set of nodes it points to.
+
+    This is Tarjan's algorithm without recursion.
+    '''
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph.get(root, ())))]
+        while work:
+            node, children = work[-1]
+            for child in children:
+                if child not in index:
+                    index[child] = low[child] = len(index)
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(graph.get(child, ()))))
+                    break
+                elif child in on_stack:
+                    low[node] = min(low[node], index[child])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                if low[node] == index[node]:
+                    component = set()
+                    while True:
+                        n = stack.pop()
+                        on_stack.discard(n)
+                        component.add(n)
+                        if n == node:
+                            break
+                    yield component
+
+
+def partition(items, existing=frozenset()):
+    '''
+    Return the waves of partitions of items, a list of 3-tuples (action,
+    ref, keys) in capture order. A partition is a list of 2-tuples (action,
+    ref) and a wave is a list of partitions which may run at the same time.
+
+    Items which share a key are in the same partition in the same order
+    except for CREATE_ONLY keys. One of those (unless it is in existing) is created by the first
+    item with it, as in a serial replay, so the partitions of the other
+    items with it wait for that partition in a later wave instead.
+    '''
+    parent = list(range(len(items)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        a, b = find(i), find(j)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    owners = {}
+    for i, (action, ref, keys) in enumerate(items):
+        for key in keys:
+            if key in existing:
+                continue
+            owner = owners.setdefault(key, i)
+            if key[0] not in CREATE_ONLY:
+                union(owner, i)
+
+    def get_dependencies():
+        deps = dict((find(i), set()) for i in range(len(items)))
+        for i, (action, ref, keys) in enumerate(items):
+            for key in keys:
+                if key[0] in CREATE_ONLY and key in owners:
+                    owner = find(owners[key])
+                    if owner != find(i):
+                        deps[find(i)].add(owner)
+        return deps
+
+    # Partitions waiting for each other have to be one partition
+    deps = get_dependencies()
+    merged = False
+    for component in strongly_connected(deps):
+        component = list(component)
+        for i in component[1:]:
+            union(component[0], i)
+            merged = True
+    if merged:
+        deps = get_dependencies()
+
+    # The wave of a partition is the length of its longest chain of
+    # dependencies
+    waves = {}
+    for root in sorted(deps):
+        stack = [root]
+        while stack:
+            i = stack[-1]
+            if i in waves:
+                stack.pop()
+                continue
+            pending = [d for d in deps[i] if d not in waves]
+            if pending:
+                stack.extend(pending)
+                continue
+            waves[i] = max([waves[d] for d in deps[i]] or [-1]) + 1
+            stack.pop()
+
+    partitions = {}
+    for i, (action, ref, keys) in enumerate(items):
+        partitions.setdefault(find(i), []).append((action, ref))
+    ret = [[] for i in range(max(waves.values()) + 1 if waves else 0)]
+    for i in sorted(partitions):
+        ret[waves[i]].append(partitions[i])
+    return ret
+
+
+def plan(payloads):
+    '''
+    Return a list (one per stage) of the waves of partitions (See
+    partition()) of payloads, an iterable of 3-tuples (action, data, ref) in the order
+    they were captured. ref is what load() reads the payload from.
+    '''
+    stages = [[] for stage in STAGES]
+    for action, data, ref in payloads:
+        row = ACTIONS.get(action)
+        if row is None:
+            logging.warning('No importer for {} {}'.format(action, ref))
+            continue
+        stage, importer, get_keys = row
+        try:
+            keys = set(get_keys(data))
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            # Let the importer complain about it on its own
+            logging.debug('No keys for {}: {}'.format(ref, e))
+            keys = set()
+        stages[stage].append((action, ref, keys))
+
+    existing = get_existing_keys(
+        key for items in stages for action, ref, keys in items
+        for key in keys)
+    return [partition(items, existing) for items in stages]
+
+
+def load(ref):
+    '''
+    Return the 2-tuple (data, filepath) to pass to an importer for a ref:
+    the path of a JSON file or a 2-tuple (spool path, offset).
+    '''
+    if not isinstance(ref, (tuple, list)):
+        return None, ref
+    filepath, offset = ref
+    with open(filepath, 'rb') as infile:
+        infile.seek(offset)
+        record = json.loads(infile.readline().decode('utf-8'))
+    return record['data'], '{}#{}'.format(filepath, record['ticket'])
+
+
+def import_partition(partition):
+    '''
+    Import the payloads of a partition in order.
+
+    Returns a 2-tuple of the number of payloads imported and failed.
+    '''
+    imported = failed = 0
+    for action, ref in partition:
+        importer = ACTIONS[action][1]
+        try:
+            data, filepath = load(ref)
+            success = importer(data=data, filepath=filepath)
+        except Exception as e:
+            logging.error('Unable to import {}: {}'.format(ref, e))
+            logging.error('exc_info=True', exc_info=True)
+            success = False
+        if success:
+            imported += 1
+        else:
+            failed += 1
+    return imported, failed
+
+
+def init_worker():
+    # Never share the parent's database connections
+    engine.dispose()
+
+
+def run(stages, workers=1):
+    '''
+    Import planned payloads (See plan()) one stage (and wave) at a time
+    with the partitions of a wave spread over workers processes.
+
+    The rows written are the same as with workers=1 (a serial replay) but
+    the Log (and other autoincrement ids) may be numbered in another order.
+    Returns a 2-tuple of the number of payloads imported and failed.
+    '''
+    total = sum(len(p) for waves in stages for partitions in waves
+                for p in partitions)
+    imported = failed = 0
+    start = last = time.time()
+    pool = None
+    if workers > 1:
+        pool = multiprocessing.Pool(workers, init_worker)
+    try:
+        for i, waves in enumerate(stages):
+            if not waves:
+                continue
+            stage_start = time.time()
+            for partitions in waves:
+                if pool is None:
+                    results = map(import_partition, partitions)
+                else:
+                    # Small chunks so the progress keeps moving
+                    results = pool.imap_unordered(
+                        import_partition, partitions,
+                        max(1, min(64, len(partitions) // (workers * 8))))
+                for ok, bad in results:
+                    imported += ok
+                    failed += bad
+                    if time.time() - last >= PROGRESS_INTERVAL:
+                        last = time.time()
+                        logging.info(
+                            '{}/{} payload(s), {:.1f}/s, {} failed'.format(
+                                imported + failed, total,
+                                (imported + failed) / (last - start), failed))
+            logging.info(
+                'Stage {} ({}): {} partition(s) in {} wave(s), {:.1f}s'.format(
+                    i, ', '.join(a for a, importer, keys in STAGES[i]),
+                    sum(len(partitions) for partitions in waves), len(waves),
+                    time.time() - stage_start))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    seconds = time.time() - start
+    logging.info('Imported {} payload(s), {} failed, in {:.1f}s ({:.1f}/s)'
+                 .format(imported, failed, seconds,
+                         (imported + failed) / max(seconds, 0.001)))
+    return imported, failed
+
+
+def iter_files(paths, action=None):
+    '''
+    Yield the 3-tuples (action, data, filepath) of captured JSON files.
+
+    Directories are walked in sorted order. The action of a file is its
+    "action" key (as sent to /post) or else action.
+    '''
+    for path in paths:
+        if os.path.isdir(path):
+            filepaths = sorted(
+                os.path.join(root, f)
+                for root, dirs, files in os.walk(path)
+                for f in files if f.endswith('.json'))
+        else:
+            filepaths = (path, )
+        for filepath in filepaths:
+            try:
+                with open(filepath) as infile:
+                    data = json.load(infile)
+            except (IOError, OSError, ValueError) as e:
+                logging.error('Unable to read {}: {}'.format(filepath, e))
+                continue
+            yield data.get('action', action), data, filepath
+
+
+def iter_archive(spool, actions=None, since=None, until=None):
+    '''
+    Yield the 3-tuples (action, data, ref) of archived payloads.
+
+    Each record is copied to spool (a binary file) so the workers can read
+    it back without decompressing the archive again.
+    '''
+    for filename, record in archive.iter_records(actions, since, until):
+        offset = spool.tell()
+        spool.write(json.dumps(record, separators=(',',':')).encode('utf-8'))
+        spool.write(b'\n')
+        yield record['action'], record['data'], (spool.name, offset)
+
+
+def main(argv=None):
+    '''
+    Rebuild the database from captured payloads.
+
+    python -m models.backfill [--workers N] [--archive] [PATH ...]
+    '''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('paths', nargs='*',
+                        help='JSON files or directories of them')
+    parser.add_argument('--action',
+                        help='Action of the files without an "action" key')
+    parser.add_argument('--archive', action='store_true',
+                        help='Import the /post archive (See models.archive)')
+    parser.add_argument('--since', type=archive.parse_time,
+                        help='Only archived payloads posted at or after this')
+    parser.add_argument('--until', type=archive.parse_time,
+                        help='Only archived payloads posted at or before this')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='Number of worker processes (1 for serial)')
+    args = parser.parse_args(argv)
+    if not args.paths and not args.archive:
+        parser.error('Nothing to import')
+
+    logging.basicConfig(level=logging.INFO)
+    with tempfile.NamedTemporaryFile(suffix='.jsonl') as spool:
+        payloads = iter_files(args.paths, args.action)
+        if args.archive:
+            payloads = chain(payloads, iter_archive(
+                spool, since=args.since, until=args.until))
+        stages = plan(payloads)
+        spool.flush()
+        imported, failed = run(stages, max(1, args.workers))
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
+
+
+### EOF ###
@@ -2,6 +2,7 @@ import decimal
 import os
 import json
 import logging
+import operator
 import time
 import traceback
 import types
@@ -10,8 +11,9 @@ import arrow
 
 from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.engine import Engine
+from sqlalchemy.types import DateTime
 from sqlalchemy.ext.declarative import declarative_base as real_declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -65,16 +67,29 @@ class BetterBase(object):
     _main_panels = None
     # Will be an iterable of dicts representing this object on its main page.
 
+    _main_panels_expire_at = None
+    # Set by generate_main_panels() to the unix time its panels go stale
+    # (ie: an event it shows closes) even if the data does not change.
+
     def generate_main_panels(self):
         self._main_panels = []
 
     @property
     def main_panels(self):
-        if self._main_panels is None:
+        # The object may live in models.cache.object_cache for a while
+        if self._main_panels is None or (
+                self._main_panels_expire_at is not None and
+                time.time() >= self._main_panels_expire_at):
+            self._main_panels_expire_at = None
             self.generate_main_panels()
 
         return self._main_panels
 
+    main_load_options = None
+    # Will be an iterable of query options which load everything
+    # generate_main_panels() uses so get_by_id() does not have to fall back to
+    # subqueryload('*') (which loads far more and still misses nested objects).
+
     extra_tabs = []
     # Will be an iterable of dicts representing different pages used to display
     # objects similar to this object but differing slightly
@@ -84,13 +99,26 @@ class BetterBase(object):
     # Will be an an iterable of tuples (key, attributes/properties)
     # to add to the dict representation.
 
+    @classmethod
+    def load_additional_columns(cls, objs):
+        '''
+        Load whatever additional_columns needs for many objects at once
+        before they are serialized with dict().
+        '''
+        pass
+
     def __repr__(self):
         return u'{}({})'.format(self.__class__.__name__, self.columns)
 
+    _serializer = None
+    # Set by compile_serializer() when the mapper is configured
+
     def dict(self):
         '''
         Transform the model into a dictionary.
         '''
+        if self._serializer is not None:
+            return self._serializer()
         ret = dict((c, getattr(self, c)) for c in self.columns)
         if self.search_id is not None:
             ret['search_id'] = self.search_id
@@ -98,6 +126,14 @@ class BetterBase(object):
             ret[k] = v
         return ret
 
+    @classmethod
+    def dicts(cls, objs):
+        '''
+        Transform many objects of this class into a list of dictionaries.
+        '''
+        cls.load_additional_columns(objs)
+        return [o.dict() for o in objs]
+
     def jsonify(self):
         '''
         Transform the model into JSON.
@@ -106,6 +142,75 @@ class BetterBase(object):
                           default=default_encode, separators=(',',':'))
 
 
+def encode_datetime(value):
+    '''
+    Return an Arrow or a (naive UTC) datetime the way default_encode() would.
+    '''
+    if value is None:
+        return None
+    if isinstance(value, arrow.arrow.Arrow):
+        return value.for_json()
+    return arrow.get(value).for_json()
+
+
+@event.listens_for(BetterBase, 'mapper_configured', propagate=True)
+def compile_serializer(mapper, cls):
+    '''
+    Make cls.dict() a tight loop over values we worked out once per class
+    instead of walking the table columns and properties for every object.
+
+    Datetimes are encoded here so default_encode() is not called for them.
+    '''
+    names = tuple(c.name for c in cls.__table__.columns)
+    encoders = tuple(
+        (i, encode_datetime) for i, c in enumerate(cls.__table__.columns)
+        if isinstance(getattr(c.type, 'impl', c.type), DateTime)
+    )
+    # Loaded column values are in the instance __dict__ which is much faster
+    # than going through the instrumented attributes
+    itemgetter = operator.itemgetter(*names)
+    getter = operator.attrgetter(*names)
+    if len(names) == 1:
+        itemgetter = lambda d, getter=itemgetter: (getter(d), )
+        getter = lambda obj, getter=getter: (getter(obj), )
+
+    # These are either properties or plain class attributes
+    search_id = getattr(cls, 'search_id', None)
+    if isinstance(search_id, property):
+        search_id = search_id.fget
+    elif search_id is not None:
+        search_id = lambda obj, value=search_id: value
+    additional_columns = getattr(cls, 'additional_columns', ())
+    if isinstance(additional_columns, property):
+        additional_columns = additional_columns.fget
+    elif additional_columns:
+        additional_columns = lambda obj, value=additional_columns: value
+    else:
+        additional_columns = None
+
+    def serializer(obj):
+        try:
+            values = itemgetter(obj.__dict__)
+        except KeyError:
+            # Expired or deferred so let SQLAlchemy load it
+            values = getter(obj)
+        if encoders:
+            values = list(values)
+            for i, encode in encoders:
+                values[i] = encode(values[i])
+        ret = dict(zip(names, values))
+        if search_id is not None:
+            value = search_id(obj)
+            if value is not None:
+                ret['search_id'] = value
+        if additional_columns is not None:
+            for k, v in additional_columns(obj):
+                ret[k] = v
+        return ret
+
+    cls._serializer = serializer
+
+
 def default_encode(obj):
     if isinstance(obj, decimal.Decimal):
         return u'{:.2f}'.format(self._value)
@@ -1,11 +1,11 @@
 from __future__ import absolute_import
 
 from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Table
-from sqlalchemy.dialects.mysql import TINYINT, SMALLINT, BIGINT
-from sqlalchemy.orm import relationship
+from sqlalchemy.dialects.mysql import TINYINT, BIGINT
+from sqlalchemy.orm import relationship, joinedload, subqueryload
 
-from .base import BetterBase, session_scope
-from .condition import SpecificCondition
+from .base import BetterBase
+from .condition import load_specific_conditions
 
 
 enemy_table = Table('enemy_table', BetterBase.metadata,
@@ -31,14 +31,24 @@ class Battle(BetterBase):
     # TODO 2015-05-19
     #messages = a many-to-many backref
 
+    _specific_conditions = None
+    # Set by load_specific_conditions()
+
+    # Dungeon and World are joined to the Battle, then one query each for the
+    # enemies and the drops (with their Drop and Enemy joined)
+    # The specific_conditions are one more query when the panels are made.
+    main_load_options = (
+        joinedload('dungeon').joinedload('world'),
+        subqueryload('enemies'),
+        subqueryload('drops').joinedload('drop'),
+        subqueryload('drops').joinedload('enemy'),
+    )
+
     @property
     def specific_conditions(self):
-        conditions = ()
-        with session_scope() as session:
-            conditions = session.query(SpecificCondition).filter(
-                SpecificCondition.battle_id == self.id).all()
-            session.expunge_all()
-        return conditions
+        if self._specific_conditions is None:
+            load_specific_conditions(battles=(self, ))
+        return self._specific_conditions
 
     def generate_main_panels(self):
         main_stats = []
@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+
+from itertools import islice
+
+from sqlalchemy.dialects import mysql
+
+
+# Keep IN lists and multi-row INSERTs well below max_allowed_packet
+BATCH_SIZE = 500
+
+
+def chunks(iterable, size=BATCH_SIZE):
+    '''
+    Yield lists of at most size items of iterable.
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def load_existing(session, column, values, key=None):
+    '''
+    Return a dict {key(obj): obj} of the objects whose column is in values.
+
+    This is one IN query per BATCH_SIZE values instead of one query per
+    value. key defaults to the value of column so the dict can be looked up
+    by the values themselves; pass a function to key by several columns
+    (ie: Enemy by param_id and lv).
+    '''
+    model = column.class_
+    if key is None:
+        key = lambda obj: getattr(obj, column.key)
+    ret = {}
+    for chunk in chunks(set(v for v in values if v is not None)):
+        for obj in session.query(model).filter(column.in_(chunk)):
+            ret.setdefault(key(obj), obj)
+    return ret
+
+
+def get_insert_row(obj):
+    '''
+    Return a dict of the column values of an object (which was never added
+    to a session) for a core INSERT, without its autoincrement primary key.
+    '''
+    return dict((c.name, getattr(obj, c.key)) for c in obj.__table__.columns
+                if not (c.primary_key and c.autoincrement is True))
+
+
+def insert_new(session, table, rows, key):
+    '''
+    Insert rows (dicts) with one multi-row INSERT per BATCH_SIZE rows.
+
+    key is a column of a unique constraint of table. On MySQL a row which is
+    already there (ie: two workers imported the same payload at once) is
+    left alone with ON DUPLICATE KEY UPDATE key = key instead of failing the
+    import.
+    '''
+    for chunk in chunks(rows):
+        if session.bind.dialect.name == 'mysql':
+            statement = mysql.insert(table).values(chunk)
+            statement = statement.on_duplicate_key_update(
+                {key: statement.inserted[key]})
+        else:
+            statement = table.insert().values(chunk)
+        session.execute(statement)
+
+
+### EOF ###
@@ -0,0 +1,205 @@
+from __future__ import absolute_import
+
+import binascii
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''
+    A bounded least recently used cache with a time to live per entry.
+
+    Keep count of hits, misses and evictions so we know if it is worth it.
+    '''
+    def __init__(self, max_size=512, ttl=3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                created, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if time.time() - created > self.ttl:
+                self.misses += 1
+                self.evictions += 1
+                return default
+            # Move the key to the (most recently used) end
+            self._data[key] = (created, value)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def evict(self, match):
+        '''
+        Remove every key where match(key) is True.
+        '''
+        with self._lock:
+            keys = [k for k in self._data if match(k)]
+            for k in keys:
+                del self._data[k]
+            self.evictions += len(keys)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self.evictions += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'ttl': self.ttl,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+# get_by_id() results keyed by (id, all, enemy)
+# Every process has its own copy. evict_ids() records the ids it evicts in
+# the journal so the other processes (ie: the web workers when an ingest
+# worker imports) evict them too (See sync_evictions()).
+object_cache = LRUCache(max_size=512, ttl=3600)
+
+EVICTIONS_PATH = os.path.join(
+    os.environ.get('OPENSHIFT_DATA_DIR', '/tmp'), 'object_evictions')
+
+# Start a new journal once it is this big (in bytes)
+EVICTIONS_MAX_SIZE = 1024 * 1024
+
+# The journal starts with a random token (one per journal) and then has one
+# line of space separated ids per evict_ids()
+TOKEN_SIZE = 16
+
+# How far this process has read the journal
+_journal = {
+    'stat': None,
+    'token': None,
+    'offset': 0,
+}
+_journal_lock = threading.Lock()
+
+
+def new_journal():
+    '''
+    Replace the journal with an empty one. The caller must hold its lock.
+    '''
+    token = binascii.hexlify(os.urandom(TOKEN_SIZE // 2)).decode('ascii')
+    tmppath = '{}.{}.tmp'.format(EVICTIONS_PATH, os.getpid())
+    with open(tmppath, 'w') as outfile:
+        outfile.write('{}\n'.format(token))
+    os.rename(tmppath, EVICTIONS_PATH)
+
+
+def record_evictions(ids):
+    '''
+    Append ids to the journal (See sync_evictions()).
+    '''
+    line = '{}\n'.format(' '.join(str(i) for i in sorted(ids)))
+    with open('{}.lock'.format(EVICTIONS_PATH), 'a') as lockfile:
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            try:
+                size = os.path.getsize(EVICTIONS_PATH)
+            except OSError:
+                size = 0
+            if size == 0 or size + len(line) > EVICTIONS_MAX_SIZE:
+                new_journal()
+            with open(EVICTIONS_PATH, 'a') as outfile:
+                outfile.write(line)
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def sync_evictions():
+    '''
+    Evict the ids other processes recorded since we last looked.
+
+    get_by_id() calls this before every lookup; when the journal did not
+    change it is a single stat(). If a new journal replaced the one we were
+    reading we may have missed some ids so everything is evicted.
+    '''
+    try:
+        st = os.stat(EVICTIONS_PATH)
+    except OSError:
+        # Whatever we cached so far predates the first journal
+        with _journal_lock:
+            if _journal['token'] is None:
+                _journal['token'] = ''
+        return
+    stat = (st.st_ino, st.st_size)
+    with _journal_lock:
+        if stat == _journal['stat']:
+            return
+        try:
+            with open(EVICTIONS_PATH) as infile:
+                token = infile.readline().strip()
+                if token != _journal['token']:
+                    if _journal['token'] is not None:
+                        object_cache.clear()
+                        logging.debug('Evicted every cached object')
+                    # Everything before now was already evicted (or never
+                    # cached by this new process)
+                    infile.seek(0, os.SEEK_END)
+                    _journal.update(token=token, offset=infile.tell())
+                infile.seek(_journal['offset'])
+                chunk = infile.read()
+        except (IOError, OSError):
+            return
+        # Leave a line still being written for next time
+        chunk = chunk[:chunk.rfind('\n') + 1]
+        _journal['offset'] += len(chunk)
+        _journal['stat'] = stat
+    ids = set(int(i) for i in chunk.split())
+    if ids:
+        evict_local(ids)
+
+
+def evict_local(ids):
+    evicted = object_cache.evict(lambda key: key[0] in ids)
+    if evicted:
+        logging.debug('Evicted {} cached object(s) for {}'.format(
+            evicted, sorted(ids)))
+
+
+def evict_ids(*ids):
+    '''
+    Remove the get_by_id() results of these ids in every process.
+    Importers call this for every id they touch (after they commit).
+    '''
+    ids = set(int(i) for i in ids if i is not None)
+    if not ids:
+        return
+    evict_local(ids)
+    try:
+        record_evictions(ids)
+    except (IOError, OSError) as e:
+        # The other processes still miss them after the ttl
+        logging.error('Unable to record the evicted ids: {}'.format(e))
+
+
+### EOF ###
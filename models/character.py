@@ -6,7 +6,7 @@ import sys
 
 from contextlib import contextmanager
 
-from sqlalchemy import Column, Integer, String, or_
+from sqlalchemy import Column, Integer, String, Index, or_
 from sqlalchemy.dialects.mysql import TINYINT, SMALLINT
 
 from .base import BetterBase, session_scope
@@ -206,6 +206,9 @@ class CharacterAbility(BetterBase):
 
 class Character(BetterBase):
     __tablename__ = 'character'
+    __table_args__ = (
+        Index('ix_character_buddy_id_level', 'buddy_id', 'level'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     buddy_id = Column(Integer, nullable=False)
     name = Column(String(length=32), nullable=False)
@@ -264,6 +267,34 @@ class Character(BetterBase):
         ('series_spd', 'RS SPD'),
     )
 
+    _equips = None
+    _abilities = None
+    # Set by load_additional_columns()
+
+    @classmethod
+    def load_additional_columns(cls, objs):
+        '''
+        Load the CharacterEquip and CharacterAbility of every buddy_id in objs
+        in two queries.
+        '''
+        objs = [o for o in objs if o._equips is None or o._abilities is None]
+        buddy_ids = set(o.buddy_id for o in objs)
+        if not buddy_ids:
+            return
+        equips = {}
+        abilities = {}
+        with session_scope() as session:
+            for equip in session.query(CharacterEquip).filter(
+                    CharacterEquip.buddy_id.in_(buddy_ids)):
+                equips.setdefault(equip.buddy_id, []).append(equip)
+            for ability in session.query(CharacterAbility).filter(
+                    CharacterAbility.buddy_id.in_(buddy_ids)):
+                abilities.setdefault(ability.buddy_id, []).append(ability)
+            session.expunge_all()
+        for o in objs:
+            o._equips = equips.get(o.buddy_id, [])
+            o._abilities = abilities.get(o.buddy_id, [])
+
     @property
     def additional_columns(self):
         return (
@@ -370,20 +401,14 @@ class Character(BetterBase):
         )
 
     def get_abilities(self):
-        abilities = ()
-        with session_scope() as session:
-            abilities = session.query(CharacterAbility).filter(
-                CharacterAbility.buddy_id == self.buddy_id).all()
-            session.expunge_all()
-        return abilities
+        if self._abilities is None:
+            self.load_additional_columns((self, ))
+        return self._abilities
 
     def get_equips(self):
-        equips = ()
-        with session_scope() as session:
-            equips = session.query(CharacterEquip).filter(
-                CharacterEquip.buddy_id == self.buddy_id).all()
-            session.expunge_all()
-        return equips
+        if self._equips is None:
+            self.load_additional_columns((self, ))
+        return self._equips
 
     def __init__(self, **kwargs):
         self.defense = kwargs['def']
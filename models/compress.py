@@ -0,0 +1,52 @@
+from __future__ import absolute_import
+
+import gzip
+import io
+
+from .cache import LRUCache
+
+
+# Do not bother compressing anything smaller than this (in bytes)
+COMPRESS_MIN_SIZE = 1024
+
+# zlib compression levels
+# Snapshots are compressed once per import so they can afford the slowest
+# level; everything else is compressed once per data version and URL.
+COMPRESS_LEVEL = 6
+COMPRESS_LEVEL_SNAPSHOT = 9
+
+# Compressed responses keyed by (data version, path, query string)
+compressed_cache = LRUCache(max_size=128, ttl=3600)
+
+
+def gzip_bytes(body, level=COMPRESS_LEVEL):
+    '''
+    Return body gzipped.
+
+    The gzip header mtime is zero so the same body always compresses to the
+    same bytes.
+    '''
+    if not isinstance(body, bytes):
+        body = body.encode('utf-8')
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=level,
+                       mtime=0) as outfile:
+        outfile.write(body)
+    return buf.getvalue()
+
+
+def get_gzip(key, body):
+    '''
+    Return body gzipped, compressing it only the first time we see key.
+    A key of None is never cached.
+    '''
+    if key is None:
+        return gzip_bytes(body)
+    ret = compressed_cache.get(key)
+    if ret is None:
+        ret = gzip_bytes(body)
+        compressed_cache.set(key, ret)
+    return ret
+
+
+### EOF ###
@@ -1,14 +1,19 @@
 from __future__ import absolute_import
 
-from sqlalchemy import Column, Integer, String, ForeignKey, Table
+from sqlalchemy import Column, Integer, String, ForeignKey, Table, Index
 from sqlalchemy.dialects.mysql import SMALLINT, BIGINT
 from sqlalchemy.orm import relationship, backref
 
-from .base import BetterBase
+from .base import BetterBase, session_scope
 
 
 class SpecificCondition(BetterBase):
     __tablename__ = 'specific_condition'
+    __table_args__ = (
+        # import_world() relies on this to skip conditions we already have
+        Index('uq_specific_condition_dungeon_id_battle_id_title',
+              'dungeon_id', 'battle_id', 'title', unique=True),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     #battle_id = Column(Integer, ForeignKey('battle.id'), nullable=False)
     battle_id = Column(BIGINT, nullable=False)
@@ -38,6 +43,50 @@ class SpecificCondition(BetterBase):
     #    return self.title
 
 
+def load_specific_conditions(dungeons=(), battles=()):
+    '''
+    Attach the SpecificCondition objects of many Dungeon and/or Battle
+    objects with one query each.
+
+    Battles are looked up by (dungeon_id, battle_id) so both queries use
+    uq_specific_condition_dungeon_id_battle_id_title.
+    Sets obj._specific_conditions which obj.specific_conditions returns.
+    '''
+    dungeons = list(dungeons)
+    battles = list(battles)
+    by_dungeon = dict((d.id, []) for d in dungeons)
+    by_battle = dict(((b.dungeon_id, b.id), []) for b in battles)
+    if not by_dungeon and not by_battle:
+        return
+
+    dungeon_conditions = battle_conditions = ()
+    with session_scope() as session:
+        if by_dungeon:
+            dungeon_conditions = session.query(SpecificCondition)\
+                .filter(SpecificCondition.dungeon_id.in_(by_dungeon.keys()))\
+                .order_by(SpecificCondition.id).all()
+        if by_battle:
+            battle_conditions = session.query(SpecificCondition)\
+                .filter(SpecificCondition.dungeon_id.in_(
+                            set(k[0] for k in by_battle)),
+                        SpecificCondition.battle_id.in_(
+                            set(k[1] for k in by_battle)))\
+                .order_by(SpecificCondition.id).all()
+        session.expunge_all()
+    for condition in dungeon_conditions:
+        by_dungeon[condition.dungeon_id].append(condition)
+    for condition in battle_conditions:
+        # The IN lists also match other pairs of their ids
+        key = (condition.dungeon_id, condition.battle_id)
+        if key in by_battle:
+            by_battle[key].append(condition)
+
+    for dungeon in dungeons:
+        dungeon._specific_conditions = by_dungeon[dungeon.id]
+    for battle in battles:
+        battle._specific_conditions = by_battle[(battle.dungeon_id, battle.id)]
+
+
 condition_table = Table('condition_table', BetterBase.metadata,
                     Column('battle_id', BIGINT,
                            ForeignKey('battle.id'), nullable=False),
@@ -2,12 +2,19 @@ from __future__ import absolute_import
 
 import logging
 
-from sqlalchemy import Column, Integer, String, ForeignKey
+import arrow
+
+from sqlalchemy import Column, Integer, String, ForeignKey, or_
 from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.dialects.mysql import BIGINT
 
 from .base import BetterBase, session_scope
+from .battle import Battle
+from .dungeon import Dungeon
+from .enemy import Enemy
 from .log import Log
+from .world import World
 
 
 class DropAssociation(BetterBase):
@@ -60,6 +67,48 @@ class Drop(BetterBase):
                 session.commit()
 
 
+def get_drop_locations(drop_id, exclude_expired=False, now=None):
+    '''
+    Return a list of 4-tuples (enemy, battle, dungeon, world) where drop_id
+    drops in one query.
+
+    battle.dungeon and dungeon.world are set so str(battle) does not query.
+    With exclude_expired events we are kept out of (at the optional now kwarg
+    datetime) are left out.
+    '''
+    locations = []
+    with session_scope() as session:
+        q = session.query(Enemy, Battle, Dungeon, World)\
+                   .select_from(DropAssociation)\
+                   .join(Enemy, DropAssociation.enemy_id == Enemy.id)\
+                   .join(Battle, DropAssociation.battle_id == Battle.id)\
+                   .join(Dungeon, Battle.dungeon_id == Dungeon.id)\
+                   .join(World, Dungeon.world_id == World.id)\
+                   .filter(DropAssociation.drop_id == drop_id)\
+                   .order_by(World.id, Dungeon.id, Battle.id, Enemy.id)
+        if exclude_expired:
+            if now is None:
+                now = arrow.now()
+            q = q.filter(or_(World.world_type != 2, World.kept_out_at > now))
+        for enemy, battle, dungeon, world in q:
+            set_committed_value(battle, 'dungeon', dungeon)
+            set_committed_value(dungeon, 'world', world)
+            locations.append((enemy, battle, dungeon, world))
+        session.expunge_all()
+    return locations
+
+
+def get_locations_expiry(locations):
+    '''
+    Return the unix time the first event of get_drop_locations() keeps us
+    out (and so leaves exclude_expired) or None if there are no events.
+    '''
+    times = [world.kept_out_at.float_timestamp
+             for enemy, battle, dungeon, world in locations
+             if world.world_type == 2]
+    return min(times) if times else None
+
+
 def populate_drop_names():
     '''
     Get Drop() objects with no name and attempts to populate the name.
@@ -10,7 +10,7 @@ from sqlalchemy.dialects.mysql import TINYINT, SMALLINT
 from sqlalchemy.orm import relationship, subqueryload, load_only
 
 from .base import BetterBase, session_scope
-from .condition import SpecificCondition
+from .condition import load_specific_conditions
 from .world import World
 
 
@@ -34,7 +34,7 @@ class Dungeon(BetterBase):
     background_image_path = Column(String(length=96), nullable=False)
     prologue_image_path = Column(String(length=96), nullable=False)
     epilogue_image_path = Column(String(length=96), nullable=False)
-    opened_at = Column(ArrowType, nullable=False)
+    opened_at = Column(ArrowType, nullable=False, index=True)
     # Dungeons_1.opened_at = 2014-05-01T06:00:00+00:00
     # Dungeons_2.opened_at = 2014-01-01T06:00:00+00:00
     # Dungeons_3.opened_at = 2014-09-17T03:00:00+00:00
@@ -44,6 +44,9 @@ class Dungeon(BetterBase):
 
     battles = relationship('Battle', backref='dungeon')
 
+    _specific_conditions = None
+    # Set by load_specific_conditions()
+
     frontend_columns = (
         ('challenge_level', 'Difficulty'),
         ('name', 'Name'),
@@ -81,12 +84,9 @@ class Dungeon(BetterBase):
             conditions.append(
                 'We are missing some conditions for this dungeon.')
         '''
-        conditions = ()
-        with session_scope() as session:
-            conditions = session.query(SpecificCondition).filter(
-                SpecificCondition.dungeon_id == self.id).all()
-            session.expunge_all()
-        return conditions
+        if self._specific_conditions is None:
+            load_specific_conditions(dungeons=(self, ))
+        return self._specific_conditions
 
     def generate_main_panels(self):
         main_stats = []
@@ -155,9 +155,9 @@ class Dungeon(BetterBase):
         self._main_panels.append(
             {
                 'title': 'Prizes',
-                'items': ('<a href="/{}">{}</a>'.format(prize.search_id, prize)
+                'items': ['<a href="/{}">{}</a>'.format(prize.search_id, prize)
                           if prize.drop_type != 'COMMON' else
-                          '{}'.format(prize) for prize in self.prizes),
+                          '{}'.format(prize) for prize in self.prizes],
                 # Maybe make the items accordian expand or at least group
                 # visually by prize.drop_type
                 'footer': 'The "Completion Reward" may be obtained multiple times.',
@@ -290,20 +290,18 @@ def get_content_dates(event=None):
     '''
     dates = ()
     with session_scope() as session:
-        world_query = session.query(World)
+        # Only select the ids in a subquery instead of loading every World
+        world_ids = session.query(World.id)
         if event:
-            worlds = world_query.filter(World.world_type == 2)
+            world_ids = world_ids.filter(World.world_type == 2)
         else:
-            worlds = world_query.filter(World.world_type == 1)
-        world_ids = (i.id for i in worlds)
-        dungeons = session.query(Dungeon)\
+            world_ids = world_ids.filter(World.world_type == 1)
+        dungeons = session.query(Dungeon.opened_at)\
                           .filter(Dungeon.world_id.in_(world_ids))\
-                          .options(load_only(Dungeon.opened_at))\
                           .order_by(Dungeon.opened_at)\
                           .group_by(Dungeon.opened_at).all()
         # List not generator because I need the length
         dates = [d.opened_at for d in dungeons]
-        session.expunge_all()
     return dates
 
 
@@ -332,6 +330,7 @@ def get_dungeons(content=None, event=None, world_id=None):
                        .filter(Dungeon.world_id == world_id)\
                        .order_by(Dungeon.challenge_level, Dungeon.id).all()
             session.expunge_all()
+        load_specific_conditions(dungeons=dungeons)
         return dungeons
 
     if content == 'all':
@@ -379,6 +378,7 @@ def get_dungeons(content=None, event=None, world_id=None):
                 Dungeon.opened_at >= opened_at)\
                 .order_by(Dungeon.challenge_level, Dungeon.id).all()
         session.expunge_all()
+    load_specific_conditions(dungeons=dungeons)
     return dungeons
 
 
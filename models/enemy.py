@@ -1,10 +1,14 @@
 from __future__ import absolute_import
 
-from sqlalchemy import Column, Integer, String, ForeignKey
+import json
+import threading
+
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 from sqlalchemy.dialects.mysql import TINYINT, SMALLINT
-from sqlalchemy.orm import relationship, subqueryload
+from sqlalchemy.orm import relationship, joinedload, lazyload
 
-from .base import BetterBase, session_scope
+from .base import BetterBase, default_encode, session_scope
+from .version import get_data_version
 
 
 ATTRIBUTE_ID = {
@@ -73,7 +77,10 @@ def get_factor(attribute_id, factor):
 class AttributeAssociation(BetterBase):
     __tablename__ = 'attribute_table'
     attribute_id = Column(Integer, ForeignKey('attribute.id'), primary_key=True)
-    param_id = Column(Integer, primary_key=True, autoincrement=False)
+    # The primary key starts with attribute_id so it does not help
+    # load_attributes() which looks rows up by param_id
+    param_id = Column(Integer, primary_key=True, autoincrement=False,
+                      index=True)
     # Not a ForeignKey('enemy.param_id') because enemy.param_id is not unique
 
     attribute = relationship('Attribute')
@@ -120,12 +127,37 @@ def populate_attribute_names():
                     'Attribute({}) still has no name.'.format(attribute))
 
 
+def load_attributes(param_ids=None):
+    '''
+    Return a dict {param_id: [AttributeAssociation, ...]} for these param_ids
+    (or every param_id) in one query.
+    '''
+    if param_ids is not None:
+        param_ids = set(param_ids)
+        if not param_ids:
+            return {}
+    ret = {}
+    with session_scope() as session:
+        q = session.query(AttributeAssociation)\
+                   .options(joinedload(AttributeAssociation.attribute))
+        if param_ids is not None:
+            q = q.filter(AttributeAssociation.param_id.in_(param_ids))
+        for aa in q:
+            ret.setdefault(aa.param_id, []).append(aa)
+        session.expunge_all()
+    return ret
+
+
 class Enemy(BetterBase):
     __tablename__ = 'enemy'
+    # import_battle() looks enemies up by param_id and lv
+    __table_args__ = (
+        Index('ix_enemy_param_id_lv', 'param_id', 'lv'),
+    )
     # id is our database unique primary_key (for different stats/levels)
     id = Column(Integer, primary_key=True, autoincrement=True)
     # Vargas and Ipooh have the same enemy_id
-    enemy_id = Column(Integer, nullable=False)
+    enemy_id = Column(Integer, nullable=False, index=True)
     # param_id is the unique id per enemy
     # Dullahan has multiple param_ids for the different resistances
     param_id = Column(Integer, nullable=False)
@@ -160,6 +192,10 @@ class Enemy(BetterBase):
         ('event_id', 'Event ID'),
     )
 
+    # generate_main_panels() only uses columns and load_attributes() so do not
+    # let get_by_id() load every battle, drop and dungeon of this enemy
+    main_load_options = (lazyload('*'), )
+
     @property
     def search_id(self):
         # enemy_id 4xxxxx may have the same id as the elite dungeon it is in
@@ -168,14 +204,7 @@ class Enemy(BetterBase):
         return self.param_id
 
     def get_attributes(self):
-        aas = []
-        with session_scope() as session:
-            aas = session.query(AttributeAssociation)\
-                        .filter(AttributeAssociation.param_id == self.param_id)\
-                        .options(subqueryload(AttributeAssociation.attribute))\
-                        .all()
-            session.expunge_all()
-        return aas
+        return load_attributes((self.param_id, )).get(self.param_id, [])
 
     def generate_main_panels(self):
         self._main_panels = [
@@ -196,8 +225,9 @@ class Enemy(BetterBase):
             params = q.all()
             session.expunge_all()
 
+        attributes = load_attributes(param.param_id for param in params)
         for param in params:
-            aas = param.get_attributes()
+            aas = attributes.get(param.param_id, [])
             self._main_panels.append(
                 {
                     'title': 'Resistances',
@@ -293,6 +323,74 @@ class Enemy(BetterBase):
         return u'{} ({})'.format(self.name, self.lv)
 
 
+# (data version, JSON string) of get_weakness_matrix()
+_weaknesses = (None, None)
+_weaknesses_lock = threading.Lock()
+
+
+def build_weakness_matrix():
+    '''
+    Return a dict of the attributes (columns) and one row per param_id with
+    its factor per attribute_id for the enemy table.
+
+    This is two queries no matter how many enemies there are.
+    '''
+    with session_scope() as session:
+        params = session.query(Enemy.param_id, Enemy.enemy_id, Enemy.name,
+                               Enemy.is_sp_enemy)\
+                        .group_by(Enemy.param_id)\
+                        .order_by(Enemy.name, Enemy.param_id).all()
+    attributes = load_attributes()
+
+    attribute_ids = set()
+    rows = []
+    for param in params:
+        row = {
+            'param_id': param.param_id,
+            'enemy_id': param.enemy_id,
+            'name': param.name,
+            'is_sp_enemy': param.is_sp_enemy,
+            'search_id': param.param_id,
+        }
+        for aa in attributes.get(param.param_id, ()):
+            attribute_id = int(aa.attribute.attribute_id)
+            attribute_ids.add(attribute_id)
+            row[str(attribute_id)] = get_factor(
+                attribute_id, aa.attribute.factor)
+        rows.append(row)
+
+    return {
+        'attributes': [
+            {'id': i, 'name': ATTRIBUTE_ID.get(i, str(i))}
+            for i in sorted(attribute_ids)
+        ],
+        'rows': rows,
+    }
+
+
+def get_weakness_matrix():
+    '''
+    Return the weakness matrix (See build_weakness_matrix()) as a JSON
+    string (or None if there are no enemies).
+
+    This is only rebuilt once per data version.
+    '''
+    global _weaknesses
+    version = get_data_version()[0]
+    if version is not None and _weaknesses[0] == version:
+        return _weaknesses[1]
+    with _weaknesses_lock:
+        if version is not None and _weaknesses[0] == version:
+            return _weaknesses[1]
+        matrix = build_weakness_matrix()
+        body = None
+        if matrix['rows']:
+            body = json.dumps(matrix, default=default_encode,
+                              separators=(',',':'))
+        _weaknesses = (version, body)
+    return body
+
+
 '''
 class EnemyAbility(BetterBase):
     __tablename__ = 'enemy_ability'
@@ -0,0 +1,557 @@
+from __future__ import absolute_import
+
+import argparse
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import time
+from contextlib import contextmanager
+
+from .base import engine, session_scope
+from .battle import Battle
+from . import archive, backfill, models
+from .seen import canonical_hash, is_seen, mark_seen, expire_seen
+
+
+QUEUE_DIR = os.path.join(
+    os.environ.get('OPENSHIFT_DATA_DIR', '/tmp'), 'queue')
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+LOCK = 'ingest.lock'
+CLAIM_LOCK = 'claim.lock'
+
+# Seconds an idle worker sleeps before looking at the queue again
+POLL_INTERVAL = 1.0
+
+# Keep the outcome of a ticket for a week
+STATUS_TTL = 7 * 24 * 3600
+
+# A payload running for longer than this belonged to a dead worker
+RUNNING_TIMEOUT = 600
+
+# Seconds between the housekeeping (and the restart of dead workers) of
+# the worker pool
+MAINTENANCE_INTERVAL = 60
+
+# The fingerprint of a payload is only what its importer reads to decide
+# whether there is anything new, so a resend with a different timestamp or
+# other stats of a known enemy is still recognized.
+
+def fingerprint_world(data):
+    return [data['world']['id'], sorted(
+        [dungeon['id'], dungeon.get('total_stamina', 0),
+         sorted([specific['battle_id'], specific['title']]
+                for capture in dungeon['captures']
+                for specific in capture['sp_scores']),
+         sorted([prize_type, prize['id']]
+                for prize_type, prizes in dungeon['prizes'].items()
+                for prize in prizes)]
+        for dungeon in data.get('dungeons', []))]
+
+
+def fingerprint_battle_list(data):
+    return sorted(battle['id'] for battle in data['battles'])
+
+
+def fingerprint_battle(data):
+    battle = data['battle']
+    event = battle.get('event')
+    if isinstance(event, dict):
+        event = [event.get('event_id'), event.get('event_type')]
+    params = set()
+    for round in battle['rounds']:
+        for enemy in round['enemy']:
+            for e in enemy['children']:
+                drops = tuple(sorted(
+                    drop['item_id'] for drop in e['drop_item_list']
+                    if drop.get('item_id') is not None))
+                ps = e['params']
+                if isinstance(ps, dict):
+                    ps = (ps, )
+                for p in ps:
+                    attributes = tuple(sorted(
+                        (int(a['attribute_id']), int(a['factor']))
+                        for a in p['def_attributes']))
+                    params.add((p['id'], p['lv'], enemy['is_sp_enemy'],
+                                attributes, drops))
+    return [battle['battle_id'], event, sorted(params)]
+
+
+def fingerprint_win_battle(data):
+    score = data['result']['score']
+    return [data['battle_id'], sorted(
+        [s['id'], s['title'], s['code_name']]
+        for s in score['general'] + score['specific'])]
+
+
+def has_battle(data):
+    '''
+    Return True if we have the Battle of a get_battle_init_data payload.
+
+    import_battle() still imports the enemies without it but it can not link
+    them (or their drops) to the battle, so the payload must not be marked
+    seen until it is imported again once the battle list arrived.
+    '''
+    ret = False
+    with session_scope() as session:
+        ret = session.query(Battle.id)\
+                     .filter(Battle.id == data['battle']['battle_id'])\
+                     .first() is not None
+    return ret
+
+
+# action, importer, required keys, fingerprint, complete
+# complete (if any) tells before the import whether the importer is able to
+# import all of a payload; if not the payload is not marked seen.
+# The order is the order a client sees them in and a worker never starts a
+# payload while an older payload of an earlier action is queued or running
+# (ie: the battles of a dungeon are imported before their enemies).
+IMPORTERS = (
+    ('/dff/world/dungeons', models.import_world, ('world', ),
+     fingerprint_world, None),
+    ('/dff/world/battles', models.import_battle_list, ('battles', ),
+     fingerprint_battle_list, None),
+    ('get_battle_init_data', models.import_battle, ('battle', ),
+     fingerprint_battle, has_battle),
+    ('win_battle', models.import_win_battle, ('battle_id', 'result'),
+     fingerprint_win_battle, None),
+)
+
+
+def get_stage(action):
+    '''
+    Return the index of action in IMPORTERS or None if it is unknown.
+    '''
+    for i, row in enumerate(IMPORTERS):
+        if action == row[0]:
+            return i
+    return None
+
+
+def get_hashes(data, stage):
+    '''
+    Return the hashes of a payload: the hash of all of it and the hash of
+    its fingerprint (if the importer understands it).
+    '''
+    action, importer, required, fingerprint, complete = IMPORTERS[stage]
+    hashes = [canonical_hash(data)]
+    try:
+        hashes.append(canonical_hash([action, fingerprint(data)]))
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        # Let the importer complain about it
+        logging.debug('No fingerprint for {}: {}'.format(action, e))
+    return hashes
+
+
+def validate(data):
+    '''
+    Return the stage (See get_stage()) of a /post payload.
+
+    This only checks what we need to pick an importer so it is cheap enough
+    to run inside the request. Raises ValueError for a bad payload.
+    '''
+    if not isinstance(data, dict):
+        raise ValueError('No data')
+    stage = get_stage(data.get('action'))
+    if stage is None:
+        raise ValueError('Unknown action')
+    for key in IMPORTERS[stage][2]:
+        if key not in data:
+            raise ValueError('Missing "{}"'.format(key))
+    return stage
+
+
+def get_path(state, filename):
+    return os.path.join(QUEUE_DIR, state, filename)
+
+
+@contextmanager
+def ingest_lock(filename=LOCK, exclusive=False, blocking=True):
+    '''
+    Hold a lock on the queue.
+
+    Every process importing from the queue holds a shared LOCK, so whoever
+    gets it exclusively knows nothing else is importing. claim() holds
+    CLAIM_LOCK exclusively.
+    Yields False (and holds nothing) if blocking is False and another
+    process has the lock.
+    '''
+    if not os.path.isdir(QUEUE_DIR):
+        os.makedirs(QUEUE_DIR)
+    with open(os.path.join(QUEUE_DIR, filename), 'a') as lockfile:
+        flags = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(lockfile, flags)
+        except (IOError, OSError):
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+def parse_filename(filename):
+    '''
+    Return the 2-tuple (ticket, stage) of a queued payload's filename.
+    '''
+    ticket, stage = os.path.splitext(filename)[0].rsplit('_', 1)
+    return ticket, int(stage)
+
+
+def list_queue(state):
+    '''
+    Return the sorted (oldest first) filenames in a queue directory.
+    '''
+    try:
+        filenames = os.listdir(os.path.join(QUEUE_DIR, state))
+    except OSError:
+        return []
+    return sorted(f for f in filenames if f.endswith('.json'))
+
+
+def write_atomic(filepath, body):
+    '''
+    Write body to filepath so readers never see a partial file.
+    '''
+    if not os.path.isdir(os.path.dirname(filepath)):
+        os.makedirs(os.path.dirname(filepath))
+    tmppath = '{}.{}.tmp'.format(filepath, os.getpid())
+    with open(tmppath, 'w') as outfile:
+        outfile.write(body)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.rename(tmppath, filepath)
+
+
+def enqueue(data):
+    '''
+    Validate a /post payload and add it to the queue.
+
+    Returns its ticket (tickets sort in the order they were queued) or None
+    if we imported the same content recently (See models.seen).
+    Raises ValueError for a bad payload.
+
+    Every queued payload is also kept in models.archive.
+    '''
+    stage = validate(data)
+    if is_seen(get_hashes(data, stage)):
+        return None
+    now = time.time()
+    ticket = '{:016x}{:08x}'.format(
+        int(now * 1000000), random.getrandbits(32))
+    write_atomic(get_path(PENDING, '{}_{}.json'.format(ticket, stage)),
+                 json.dumps(data, separators=(',',':')))
+    try:
+        archive.append(IMPORTERS[stage][0], data, ticket, now)
+    except (IOError, OSError) as e:
+        # The payload is queued anyway
+        logging.error('Unable to archive {}: {}'.format(ticket, e))
+    return ticket
+
+
+def get_status(ticket):
+    '''
+    Return a dict of the status of a ticket or None if it is unknown.
+
+    status is one of queued, running, done or failed.
+    '''
+    try:
+        with open(get_path(DONE, '{}.json'.format(ticket))) as infile:
+            return json.load(infile)
+    except (IOError, OSError, ValueError):
+        pass
+    prefix = '{}_'.format(ticket)
+    for state, status in ((RUNNING, 'running'), (PENDING, 'queued')):
+        for filename in list_queue(state):
+            if filename.startswith(prefix):
+                return {'ticket': ticket, 'status': status}
+    return None
+
+
+# {filename: keys} of the queued payloads (See get_keys())
+_keys = {}
+
+
+def get_keys(state, filename):
+    '''
+    Return the frozenset of keys of a queued payload: the rows it writes
+    (See models.backfill, without the CREATE_ONLY rows which exist) or None
+    if we can not tell.
+
+    Raises IOError/OSError if the payload is gone.
+    '''
+    keys = _keys.get(filename)
+    if keys is not None or filename in _keys:
+        return keys
+    with open(get_path(state, filename)) as infile:
+        body = infile.read()
+    action = IMPORTERS[parse_filename(filename)[1]][0]
+    try:
+        keys = frozenset(backfill.ACTIONS[action][2](json.loads(body)))
+    except (KeyError, TypeError, ValueError, AttributeError) as e:
+        # Let the importer complain about it
+        logging.debug('No keys for {}: {}'.format(filename, e))
+        keys = None
+    else:
+        # Nearly every battle shares the attributes and drops we already
+        # have; rows of these kinds are never written again once they exist
+        keys = keys - backfill.get_existing_keys(keys)
+    _keys[filename] = keys
+    return keys
+
+
+def claim():
+    '''
+    Move the oldest payload we are allowed to start from pending to running.
+
+    A payload waits while an older payload of an earlier action is queued
+    or running (ie: the battles of a dungeon are imported before their
+    enemies) and while a running or older waiting payload shares one of its
+    keys (See get_keys()), so two workers never create the same row.
+    A payload without keys runs alone.
+    Returns the filename or None if there is nothing to do.
+    '''
+    with ingest_lock(CLAIM_LOCK, exclusive=True):
+        running = list_queue(RUNNING)
+        pending = list_queue(PENDING)
+        for filename in set(_keys) - set(running) - set(pending):
+            del _keys[filename]
+
+        taken = set()
+        alone = False
+        for filename in running:
+            try:
+                keys = get_keys(RUNNING, filename)
+            except (IOError, OSError):
+                # Finished meanwhile
+                continue
+            if keys is None:
+                alone = True
+            else:
+                taken.update(keys)
+
+        queue = [(f, RUNNING) for f in running] +\
+                [(f, PENDING) for f in pending]
+        lowest = len(IMPORTERS)
+        for filename, state in sorted(queue):
+            stage = parse_filename(filename)[1]
+            blocked = stage > lowest
+            lowest = min(lowest, stage)
+            if state == RUNNING:
+                continue
+            try:
+                keys = get_keys(PENDING, filename)
+            except (IOError, OSError) as e:
+                logging.warning('Unable to read {}: {}'.format(filename, e))
+                continue
+            if alone:
+                return None
+            if keys is None:
+                if blocked or running:
+                    # Nothing newer passes it either
+                    return None
+            elif blocked or keys & taken:
+                # Newer payloads sharing its keys wait for it too
+                taken.update(keys)
+                continue
+            if not os.path.isdir(os.path.join(QUEUE_DIR, RUNNING)):
+                os.makedirs(os.path.join(QUEUE_DIR, RUNNING))
+            os.rename(get_path(PENDING, filename),
+                      get_path(RUNNING, filename))
+            # The mtime is when we started (See requeue_running())
+            os.utime(get_path(RUNNING, filename), None)
+            return filename
+    return None
+
+
+def process(filename):
+    '''
+    Import a claimed payload and record its outcome.
+
+    Returns None if the payload is gone (requeue_running() gave it to
+    another worker).
+    '''
+    ticket, stage = parse_filename(filename)
+    action, importer, required, fingerprint, complete = IMPORTERS[stage]
+    filepath = get_path(RUNNING, filename)
+    try:
+        infile = open(filepath)
+    except (IOError, OSError) as e:
+        logging.warning('Lost {}: {}'.format(filename, e))
+        return None
+    status = {'ticket': ticket, 'action': action, 'status': 'failed'}
+    start = time.time()
+    try:
+        with infile:
+            data = json.load(infile)
+        # Before the importer changes data
+        hashes = get_hashes(data, stage)
+        is_complete = complete is None or complete(data)
+        if is_seen(hashes):
+            # A resend of a payload imported while this one was queued
+            status['status'] = 'done'
+            status['duplicate'] = True
+        elif importer(data=data, filepath=filepath):
+            status['status'] = 'done'
+            if is_complete:
+                mark_seen(action, hashes)
+            else:
+                # Accept the same payload again (See has_battle())
+                status['partial'] = True
+        else:
+            status['error'] = 'Bad data'
+    except Exception as e:
+        logging.error('Unable to import {}: {}'.format(filename, e))
+        logging.error('exc_info=True', exc_info=True)
+        status['error'] = '{}: {}'.format(str(e.__class__), str(e))
+    status['finished_at'] = int(time.time())
+    status['seconds'] = round(time.time() - start, 3)
+    write_atomic(get_path(DONE, '{}.json'.format(ticket)), json.dumps(status))
+    try:
+        os.remove(filepath)
+    except OSError as e:
+        logging.warning('Lost {}: {}'.format(filename, e))
+    return status
+
+
+def requeue_running(timeout=RUNNING_TIMEOUT):
+    '''
+    Move payloads a dead worker left running (for more than timeout seconds)
+    back to pending.
+    '''
+    cutoff = time.time() - timeout
+    for filename in list_queue(RUNNING):
+        filepath = get_path(RUNNING, filename)
+        if not os.path.isdir(os.path.join(QUEUE_DIR, PENDING)):
+            os.makedirs(os.path.join(QUEUE_DIR, PENDING))
+        try:
+            if os.stat(filepath).st_mtime < cutoff:
+                os.rename(filepath, get_path(PENDING, filename))
+                logging.warning('Requeued {}'.format(filename))
+        except OSError:
+            pass
+
+
+def expire_statuses(ttl=STATUS_TTL):
+    '''
+    Remove the outcomes of tickets that finished more than ttl seconds ago.
+    '''
+    cutoff = time.time() - ttl
+    for filename in list_queue(DONE):
+        filepath = get_path(DONE, filename)
+        try:
+            if os.stat(filepath).st_mtime < cutoff:
+                os.remove(filepath)
+        except OSError:
+            pass
+
+
+def drain():
+    '''
+    Import queued payloads until there are none we may start.
+
+    Returns the number of payloads imported.
+    '''
+    count = 0
+    while True:
+        filename = claim()
+        if filename is None:
+            return count
+        process(filename)
+        count += 1
+
+
+def work(poll_interval=POLL_INTERVAL):
+    '''
+    Drain the queue forever (in a worker process).
+    '''
+    # Never share the parent's database connections
+    engine.dispose()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    while True:
+        try:
+            count = drain()
+        except Exception as e:
+            # A worker outlives a bad payload or a lost database
+            logging.error('Unable to drain the queue: {}'.format(e))
+            logging.error('exc_info=True', exc_info=True)
+            count = 0
+        if not count:
+            time.sleep(poll_interval)
+
+
+def start_worker():
+    worker = multiprocessing.Process(target=work)
+    worker.start()
+    return worker
+
+
+def housekeeping():
+    requeue_running()
+    expire_statuses()
+    expire_seen()
+    archive.compact()
+
+
+def main(argv=None):
+    '''
+    Import the payloads /post queued.
+
+    python -m models.ingest [--workers N] [--once]
+    '''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--workers', type=int, default=2,
+                        help='Number of worker processes (default: 2)')
+    parser.add_argument('--once', action='store_true',
+                        help='Drain the queue in this process and exit')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if not args.once:
+        with ingest_lock(exclusive=True, blocking=False) as alone:
+            if alone:
+                # No other process (ie: a --once run) is importing so
+                # whatever is running belonged to a dead worker
+                requeue_running(timeout=0)
+    with ingest_lock():
+        housekeeping()
+        if args.once:
+            logging.info('Imported {} payload(s)'.format(drain()))
+            return
+
+        workers = [start_worker() for i in range(max(1, args.workers))]
+        stopping = []
+
+        def stop(signum, frame):
+            stopping.append(signum)
+            for worker in workers:
+                worker.terminate()
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while not stopping:
+            for worker in workers:
+                worker.join(MAINTENANCE_INTERVAL / len(workers))
+            for i, worker in enumerate(workers):
+                if not worker.is_alive() and not stopping:
+                    logging.error('Worker {} exited with {}, restarting'
+                                  .format(worker.pid, worker.exitcode))
+                    workers[i] = start_worker()
+            housekeeping()
+        for worker in workers:
+            worker.join()
+
+
+if __name__ == '__main__':
+    main()
+
+
+### EOF ###
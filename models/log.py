@@ -1,21 +1,25 @@
 from __future__ import absolute_import
 
 import logging
-import sys
+import os
 
 import arrow
 
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import Column, Integer, String, event, func
+from sqlalchemy.orm.attributes import instance_state
 from sqlalchemy.types import TIMESTAMP
 
-from .base import BetterBase
+from .base import BetterBase, session_scope, create_session
+from .bulk import chunks
+from .cache import LRUCache
 
 
 class Log(BetterBase):
     __tablename__ = 'log'
     id = Column(Integer, primary_key=True, autoincrement=True)
     timestamp = Column(TIMESTAMP,
-                       default=arrow.arrow.datetime.utcnow, nullable=False)
+                       default=arrow.arrow.datetime.utcnow, nullable=False,
+                       index=True)
     log = Column(String(length=256), nullable=False)
     # I want a way to reference the objects in this log but that is not too easy
 
@@ -26,16 +30,115 @@ class Log(BetterBase):
 
     search_id = None
 
-    def __init__(self, **kwargs):
-        super(Log, self).__init__(**kwargs)
-        try:
-            logging.info(self.log)
-        except (UnicodeEncodeError, ):
-            logging.critical(UnicodeEncodeError)
-
     def __repr__(self):
         #return '{} {}'.format(self.timestamp, self.log)
         return '{} {}'.format(self.timestamp, self.log.encode(errors='ignore'))
 
 
+# A session keeps its new Log rows in session.info[LOG_BUFFER] and writes
+# them with one multi-row INSERT when it commits instead of one INSERT each.
+# A huge import writes them every LOG_FLUSH_SIZE rows instead of holding
+# them all until the end.
+LOG_BUFFER = 'log_buffer'
+LOG_FLUSH_SIZE = int(os.environ.get('FFRK_LOG_FLUSH_SIZE', 500))
+
+
+@event.listens_for(create_session, 'before_flush')
+def buffer_logs(session, flush_context, instances):
+    '''
+    Move the new Log objects of a session into its buffer before they are
+    flushed one by one.
+    '''
+    logs = [obj for obj in session.new if isinstance(obj, Log)]
+    if not logs:
+        return
+    logs.sort(key=lambda obj: instance_state(obj).insert_order)
+    buffer = session.info.setdefault(LOG_BUFFER, [])
+    now = arrow.arrow.datetime.utcnow()
+    for log in logs:
+        session.expunge(log)
+        buffer.append({'timestamp': log.timestamp or now, 'log': log.log})
+    if len(buffer) >= LOG_FLUSH_SIZE:
+        write_logs(session)
+
+
+@event.listens_for(create_session, 'before_commit')
+def commit_logs(session):
+    # Buffer whatever was added since the last flush
+    session.flush()
+    write_logs(session)
+
+
+@event.listens_for(create_session, 'after_transaction_end')
+def discard_logs(session, transaction):
+    # Anything left was rolled back
+    if transaction.parent is None:
+        session.info.pop(LOG_BUFFER, None)
+
+
+def write_logs(session):
+    '''
+    Insert the buffered Log rows of a session (in the order they were
+    created), log them and empty its buffer.
+    '''
+    rows = session.info.pop(LOG_BUFFER, None)
+    if not rows:
+        return
+    for chunk in chunks(rows, LOG_FLUSH_SIZE):
+        session.execute(Log.__table__.insert().values(chunk))
+    try:
+        logging.info('\n'.join(row['log'] for row in rows))
+    except (UnicodeEncodeError, ):
+        logging.critical(UnicodeEncodeError)
+
+
+# get_logs() totals keyed by (newest Log.id, search, since, until)
+# COUNT(*) over millions of rows is the slow part and it only changes with
+# a new Log
+_log_totals = LRUCache(max_size=64, ttl=3600)
+
+LOG_PAGE_SIZE = 25
+LOG_MAX_PAGE_SIZE = 100
+
+
+def get_logs(before_id=None, offset=0, limit=LOG_PAGE_SIZE, search=None,
+             since=None, until=None):
+    '''
+    Return a 2-tuple (total, logs) of the newest Log objects matching the
+    optional search text and [since, until) datetime range.
+
+    Page with before_id (the id of the last Log on the previous page) so a
+    deep page is an index range scan like the first one; offset is only a
+    fallback for jumping to an arbitrary page.
+    '''
+    limit = max(1, min(int(limit), LOG_MAX_PAGE_SIZE))
+    total = 0
+    logs = []
+    with session_scope() as session:
+        q = session.query(Log)
+        if search:
+            pattern = search.replace('\\', '\\\\')\
+                            .replace('%', '\\%').replace('_', '\\_')
+            q = q.filter(Log.log.like(u'%{}%'.format(pattern), escape='\\'))
+        if since is not None:
+            q = q.filter(Log.timestamp >= since)
+        if until is not None:
+            q = q.filter(Log.timestamp < until)
+
+        key = (session.query(func.max(Log.id)).scalar(), search, since, until)
+        total = _log_totals.get(key)
+        if total is None:
+            total = q.order_by(None).count()
+            _log_totals.set(key, total)
+
+        q = q.order_by(Log.id.desc())
+        if before_id is not None:
+            q = q.filter(Log.id < before_id)
+        elif offset:
+            q = q.offset(offset)
+        logs = q.limit(limit).all()
+        session.expunge_all()
+    return total, logs
+
+
 ### EOF ###
@@ -2,10 +2,9 @@ from __future__ import absolute_import
 
 from sqlalchemy import Column, Integer, String
 from sqlalchemy.dialects.mysql import TINYINT, SMALLINT
-from sqlalchemy.orm import subqueryload
 
-from .base import BetterBase, session_scope
-from .drop import DropAssociation
+from .base import BetterBase
+from .drop import get_drop_locations, get_locations_expiry
 
 
 class Material(BetterBase):
@@ -59,17 +58,15 @@ class Material(BetterBase):
             )
 
         # This is repeated in Relic.main_panels
-        # This queries drop_table, enemy, world, dungeon, battle
-        # TODO 2015-05-11
-        # Filter out (expired?) events
+        # This queries drop_table, enemy, world, dungeon, battle at once
         drop_locations = []
-        with session_scope() as session:
-            drops = session.query(DropAssociation).filter_by(
-                drop_id=self.search_id).options(subqueryload('enemy')).all()
-            for drop in drops:
-                drop_locations.append(
-                    '<a href="/{}">{}</a>'.format(
-                        drop.enemy.search_id, str(drop)))
+        locations = get_drop_locations(self.search_id, exclude_expired=True)
+        for enemy, battle, dungeon, world in locations:
+            drop_locations.append(
+                '<a href="/{}">{} from {} in {}</a>'.format(
+                    enemy.search_id, self.name, enemy, battle))
+        # Leave out the next event to close once it does
+        self._main_panels_expire_at = get_locations_expiry(locations)
 
         self._main_panels = (
             {
@@ -86,7 +83,7 @@ class Material(BetterBase):
                 'title': 'Drop Locations',
                 'items': drop_locations,
                 'footer': 'These locations are not all inclusive and the drop ra\
-tes may vary.',
+tes may vary.<br>Expired events are not shown.',
             },
         )
 
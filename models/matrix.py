@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+
+import json
+import threading
+
+from .base import session_scope
+from .ability import Ability, AbilityCost
+from .material import Material
+from .version import get_data_version
+
+
+# (data version, JSON string)
+_matrix = (None, None)
+_lock = threading.Lock()
+
+
+def build_ability_matrix():
+    '''
+    Return a dict of the ability grid (which abilities use a pair of orbs).
+
+    Everything is referenced by its index to keep the payload small:
+        materials: [[id, name, rarity], ...]
+        abilities: [[name, rarity, search_id], ...]
+        grids: {rarity: {
+            materials: [material index, ...],
+            cells: [[row, column, [ability index, ...]], ...],
+        }}
+    Only cells with row <= column (the grid is symmetric) and at least one
+    ability are sent; row and column are positions in grids[r].materials.
+    The diagonal holds every ability which uses that material.
+    '''
+    with session_scope() as session:
+        # Get the first object per Ability
+        abilities = session.query(Ability.id, Ability.name, Ability.rarity,
+                                  Ability.ability_id)\
+                           .order_by(Ability.name)\
+                           .group_by(Ability.name).all()
+        ability_costs = session.query(AbilityCost.ability_id,
+                                      AbilityCost.material_id)\
+                               .filter(AbilityCost.ability_id.in_(
+                                   [a.id for a in abilities])).all()
+        materials = session.query(Material.id, Material.name,
+                                  Material.rarity)\
+                           .order_by(Material.id).all()
+
+    costs = {}
+    for ability_id, material_id in ability_costs:
+        costs.setdefault(ability_id, set()).add(material_id)
+
+    grids = {}
+    for i, m in enumerate(materials):
+        grid = grids.setdefault(m.rarity, {'materials': [], 'positions': {}})
+        grid['positions'][m.id] = len(grid['materials'])
+        grid['materials'].append(i)
+
+    for grid in grids.values():
+        grid['cells'] = {}
+    for i, a in enumerate(abilities):
+        grid = grids.get(a.rarity)
+        if grid is None:
+            continue
+        # Some 4* abilities require 5* materials
+        # ie: Phoenix and Major Fire Orb
+        # Those materials are not in this grid
+        positions = sorted(grid['positions'][m] for m in costs.get(a.id, ())
+                           if m in grid['positions'])
+        for j, row in enumerate(positions):
+            for column in positions[j:]:
+                grid['cells'].setdefault((row, column), []).append(i)
+
+    return {
+        'materials': [[m.id, m.name.split()[-2], m.rarity] for m in materials],
+        'abilities': [[a.name, a.rarity, a.ability_id] for a in abilities],
+        'grids': dict(
+            (rarity, {
+                'materials': grid['materials'],
+                'cells': [[r, c, ids] for (r, c), ids in
+                          sorted(grid['cells'].items())],
+            }) for rarity, grid in grids.items()
+        ),
+    }
+
+
+def get_ability_matrix():
+    '''
+    Return the ability grid as a JSON string (or None if there are no
+    abilities).
+
+    This is only rebuilt once per data version.
+    '''
+    global _matrix
+    version = get_data_version()[0]
+    if version is not None and _matrix[0] == version:
+        return _matrix[1]
+    with _lock:
+        if version is not None and _matrix[0] == version:
+            return _matrix[1]
+        matrix = build_ability_matrix()
+        body = None
+        if matrix['abilities']:
+            body = json.dumps(matrix, separators=(',',':'))
+        _matrix = (version, body)
+    return body
+
+
+### EOF ###
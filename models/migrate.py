@@ -0,0 +1,167 @@
+from __future__ import absolute_import
+
+import argparse
+import logging
+import sys
+
+from sqlalchemy import inspect, text, func
+from sqlalchemy.exc import IntegrityError
+
+from .base import BetterBase, engine, make_tables, create_session
+# Import every model so BetterBase.metadata knows about every table
+from . import models
+from .ability import Ability
+from .character import Character
+from .condition import SpecificCondition
+from .dungeon import Dungeon
+from .enemy import Enemy, AttributeAssociation
+from .prize import Prize
+from .relic import Relic
+
+
+# Indexes which were made unique under a new name: {new name: old name}
+# The old index is dropped once the new one exists.
+REPLACED_INDEXES = {
+    'uq_prize_drop_id_prize_type_dungeon_id':
+        'ix_prize_drop_id_prize_type_dungeon_id',
+    'uq_specific_condition_dungeon_id_battle_id_title':
+        'ix_specific_condition_dungeon_id_battle_id_title',
+}
+
+
+def get_hot_queries(session):
+    '''
+    Return a list of 2-tuples (name, query) of the lookups the importers and
+    readers run most often. Each one must be answered through an index.
+
+    The values do not need to exist; they only have to be of the right type.
+    '''
+    return [
+        ('enemy by param_id and lv', session.query(Enemy).filter_by(
+            param_id=1, lv=1)),
+        ('enemy by enemy_id', session.query(Enemy).filter(
+            Enemy.enemy_id == 1)),
+        ('relic by equipment_id, level and rarity', session.query(Relic).filter(
+            Relic.equipment_id == 1, Relic.level == 1, Relic.rarity == 1)),
+        ('character by buddy_id and level', session.query(Character).filter(
+            Character.buddy_id == 1, Character.level == 1)),
+        ('specific condition by dungeon_id, battle_id and title',
+         session.query(SpecificCondition).filter(
+             SpecificCondition.battle_id == 1,
+             SpecificCondition.dungeon_id == 1,
+             SpecificCondition.title == '')),
+        # load_specific_conditions() for the dungeon and battle pages
+        ('specific conditions by dungeon_id',
+         session.query(SpecificCondition).filter(
+             SpecificCondition.dungeon_id.in_((1, 2)))),
+        ('specific conditions by dungeon_id and battle_id',
+         session.query(SpecificCondition).filter(
+             SpecificCondition.dungeon_id.in_((1, 2)),
+             SpecificCondition.battle_id.in_((1, 2)))),
+        ('prize by drop_id, prize_type and dungeon_id',
+         session.query(Prize).filter_by(
+             drop_id=1, prize_type=1, dungeon_id=1)),
+        ('attributes by param_id',
+         session.query(AttributeAssociation).filter(
+             AttributeAssociation.param_id.in_((1, 2)))),
+        ('ability by ability_id and grade', session.query(Ability).filter_by(
+            ability_id=1, grade=1)),
+        # get_dungeons() asks for the dungeons of the latest content update
+        # NOW() instead of a date because a datetime can not be a literal
+        ('dungeons opened after', session.query(Dungeon).filter(
+            Dungeon.opened_at >= func.now())),
+    ]
+
+
+def explain(session, query):
+    '''
+    Return the rows (as dicts) of EXPLAIN for a query.
+    '''
+    statement = query.statement.compile(
+        dialect=session.bind.dialect, compile_kwargs={'literal_binds': True})
+    result = session.execute(text('EXPLAIN {}'.format(statement)))
+    keys = result.keys()
+    return [dict(zip(keys, row)) for row in result]
+
+
+def find_full_scans():
+    '''
+    EXPLAIN every hot query (See get_hot_queries()).
+
+    Returns a list of 2-tuples (name, EXPLAIN row) for every table a hot query
+    reads with a full scan (type ALL) instead of an index.
+    '''
+    ret = []
+    # Not session_scope() because a failing EXPLAIN must not look like a pass
+    session = create_session()
+    try:
+        for name, query in get_hot_queries(session):
+            for row in explain(session, query):
+                if row.get('type') == 'ALL':
+                    ret.append((name, row))
+    finally:
+        session.close()
+    return ret
+
+
+def create_missing_indexes():
+    '''
+    Create the indexes declared on the models that an existing database is
+    missing. BetterBase.metadata.create_all() only creates them with a new
+    table.
+
+    Returns the names of the created indexes.
+    '''
+    inspector = inspect(engine)
+    created = []
+    for table in BetterBase.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                logging.info('Creating index {} on {}'.format(
+                    index.name, table.name))
+                try:
+                    index.create(engine)
+                except IntegrityError as e:
+                    # Leave the old index alone until the duplicates are gone
+                    logging.error('Unable to create unique index {}: {}'.format(
+                        index.name, e.orig))
+                    continue
+                created.append(index.name)
+            old_name = REPLACED_INDEXES.get(index.name)
+            if old_name in existing:
+                logging.info('Dropping index {} on {}'.format(
+                    old_name, table.name))
+                engine.execute(text('DROP INDEX {} ON {}'.format(
+                    old_name, table.name)))
+    return created
+
+
+def main(argv=None):
+    '''
+    Bring an existing database up to date with the models and check that
+    the hot queries use their indexes.
+
+    python -m models.migrate [--explain]
+    '''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--explain', action='store_true',
+                        help='Only report hot queries that do a full scan')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if not args.explain:
+        make_tables()
+        created = create_missing_indexes()
+        logging.info('Created {} index(es)'.format(len(created)))
+    full_scans = find_full_scans()
+    for name, row in full_scans:
+        logging.warning('Full scan of {} for {}'.format(row.get('table'), name))
+    return 1 if args.explain and full_scans else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+
+### EOF ###
@@ -1,9 +1,7 @@
 from __future__ import absolute_import
 
-import csv
 import json
 import logging
-import os
 import sys
 import time
 import traceback
@@ -21,19 +19,36 @@ from sqlalchemy.orm import sessionmaker, load_only, relationship, backref,\
 
 from .base import BetterBase, session_scope, create_session, default_encode,\
     make_tables
+from .cache import object_cache, evict_ids, sync_evictions
+from .compress import COMPRESS_MIN_SIZE, get_gzip
 from .ability import Ability, AbilityCost
-from .battle import Battle
+from .battle import Battle, enemy_table
+from .bulk import chunks, load_existing, get_insert_row, insert_new
 from .character import Character, CharacterEquip, CharacterAbility
 from .condition import Condition, SpecificCondition
 from .drop import Drop, DropAssociation
 from .dungeon import Dungeon, DUNGEON_TYPE, get_content_dates, get_dungeons
-from .enemy import Enemy, Attribute, AttributeAssociation
-from .log import Log
+from .enemy import Enemy, Attribute, AttributeAssociation, get_weakness_matrix
+from .log import Log, LOG_PAGE_SIZE, get_logs
+from .matrix import get_ability_matrix
 from .material import Material
 from .prize import Prize
+from .projection import load_fields_by_id
 from .quest import Quest, import_quests
 from .relic import Relic
-from .world import World, get_active_events
+from .search import SearchDirectory, get_search_candidates,\
+    register_search_ids
+from .seen import SeenPayload
+from .snapshot import get_category, get_snapshot, get_snapshot_gzip,\
+    rebuild_on_import
+from .ssb import SSBMastery, check_ssb
+from .version import get_data_version
+from .world import World, get_active_events, get_realms
+from .nav import get_nav, get_nav_content_dates, get_nav_active_events,\
+    get_nav_realms, invalidate_nav
+
+
+import_quests = rebuild_on_import('quest')(import_quests)
 
 
 # TODO 2015-05-19
@@ -61,18 +76,6 @@ class About(object):
 ### END CLASS DEFINITIONS ###
 
 
-def get_realms():
-    """Get an iterable of 2-tuples (series_id, name) of Realms."""
-    r = ()
-    with session_scope() as session:
-        realms = session.query(World)\
-                        .options(load_only(World.series_id, World.name))\
-                        .filter(World.world_type == 1).all()
-        session.expunge_all()
-    r = [(w.series_id, w.name) for w in realms]
-    return [(200001, 'Core')] + sorted(r) + [(150001, 'FFT')]
-
-
 def get_load_data(data, filepath):
     """Get a dictionary of data or load the dictionary from a JSON file."""
     if data is None or not isinstance(data, dict):
@@ -94,6 +97,7 @@ def byteify(input):
         return input
 
 
+@rebuild_on_import()
 def import_battle_list(data=None, filepath=''):
     """/dff/world/battles"""
     logging.debug('{}(filepath="{}") start'.format(
@@ -115,6 +119,8 @@ def import_battle_list(data=None, filepath=''):
                 new_battle = Battle(**battle)
                 session.add(new_battle)
                 session.commit()
+                evict_ids(new_battle.id, new_battle.dungeon_id)
+                register_search_ids(session, new_battle)
                 # This will output None for the dungeon name :(
                 new_log = Log(log=u'Create Battle({})'.format(new_battle))
                 session.add(new_log)
@@ -124,122 +130,134 @@ def import_battle_list(data=None, filepath=''):
     return success
 
 
+@rebuild_on_import('world', 'dungeon')
 def import_world(data=None, filepath='', ask=False):
-    """/dff/world/dungeons"""
+    """/dff/world/dungeons
+
+    Everything the payload refers to is looked up with a few IN queries up
+    front. New specific conditions and prizes are written with multi-row
+    INSERTs and everything with one commit.
+    """
     logging.debug('{}(filepath="{}") start'.format(
         sys._getframe().f_code.co_name, filepath))
-    if data is None or not isinstance(data, dict):
-        if not filepath:
-            raise ValueError('One kwarg of data or filepath is required.')
-        with open(filepath) as infile:
-            data = json.load(infile)
+    data = get_load_data(data, filepath)
+
+    world = data['world']
+    dungeons = data.get('dungeons', [])
+    dungeon_ids = [dungeon['id'] for dungeon in dungeons]
 
     success = False
     with session_scope() as session:
-        world = data['world']
         new_world = session.query(World).filter_by(id=world['id']).first()
+        old_dungeons = load_existing(session, Dungeon.id, dungeon_ids)
+        drops = load_existing(session, Drop.id, (
+            prize['id'] for dungeon in dungeons
+            for prizes_list in dungeon['prizes'].values()
+            for prize in prizes_list))
+        conditions = set()
+        prizes = set()
+        for chunk in chunks(dungeon_ids):
+            conditions.update(session.query(
+                SpecificCondition.dungeon_id, SpecificCondition.battle_id,
+                SpecificCondition.title)\
+                .filter(SpecificCondition.dungeon_id.in_(chunk)))
+            prizes.update(session.query(
+                Prize.dungeon_id, Prize.drop_id, Prize.prize_type)\
+                .filter(Prize.dungeon_id.in_(chunk)))
+
+        # Create the world and dungeons first so the dungeons know their
+        # world when we log them
+        new_objects = []
         if new_world is None:
             new_world = World(**world)
             session.add(new_world)
-            session.commit()
-            new_log = Log(log=u'Create World({})'.format(new_world))
-            session.add(new_log)
-        for dungeon in data.get('dungeons', []):
-            captures = dungeon['captures']
-            prizes = dungeon['prizes']
-            new_dungeon = session.query(Dungeon).filter_by(
-                id=dungeon['id']).first()
-            if new_dungeon is None:
+            new_objects.append(new_world)
+        for dungeon in dungeons:
+            if dungeon['id'] not in old_dungeons:
                 new_dungeon = Dungeon(**dungeon)
                 session.add(new_dungeon)
-                session.commit()
-                new_log = Log(log=u'Create Dungeon({})'.format(new_dungeon))
-                session.add(new_log)
+                new_objects.append(new_dungeon)
+                old_dungeons[dungeon['id']] = new_dungeon
+        if new_objects:
+            session.flush()
+            register_search_ids(session, *new_objects)
+
+        new_conditions = []
+        new_prizes = []
+        evicted = set()
+        if new_world in new_objects:
+            evicted.add(new_world.id)
+            session.add(Log(log=u'Create World({})'.format(new_world)))
+        for dungeon in dungeons:
+            new_dungeon = old_dungeons[dungeon['id']]
+            if new_dungeon in new_objects:
+                evicted.update((new_dungeon.id, new_dungeon.world_id))
+                session.add(Log(log=u'Create Dungeon({})'.format(new_dungeon)))
             # Added with 2015-06-07 patch
             total_stamina = dungeon.get('total_stamina', 0)
             if new_dungeon.total_stamina == 0 and total_stamina != 0:
                 new_dungeon.total_stamina = total_stamina
-                new_log = Log(
+                evicted.add(new_dungeon.id)
+                session.add(Log(
                     log='Update {}({}).total_stamina from 0 to {}'.format(
                         type(new_dungeon).__name__, new_dungeon,
                         new_dungeon.total_stamina
                     )
-                )
-                session.add(new_log)
-                session.commit()
-#            '''
-            for capture in captures:
-                # We want to create the Condition() when we import_world()
-                # However we do not want to overwrite or duplicate an old
-                # Condition()
-                # But we also want to have the Condition.code_name and
-                # Condition.condition_id
-                # NOTE 2015-06-07
-                # There is now a Condition.battle_specific_score_id
+                ))
+            # We want to create the SpecificCondition() when we
+            # import_world() but we are unable to associate it with the
+            # Battle() which does not exist yet on the first run.
+            # NOTE 2015-06-07
+            # There is now a Condition.battle_specific_score_id
+            for capture in dungeon['captures']:
                 for specific in capture['sp_scores']:
-                    # So first get what is given
-                    battle_id = specific['battle_id']
-                    title = specific['title']
-                    #print (title)
-                    #print (type(title))
-                    old_condition = session.query(SpecificCondition).filter(
-                        SpecificCondition.battle_id == battle_id,
-                        SpecificCondition.dungeon_id == new_dungeon.id,
-                        SpecificCondition.title == title).first()
-                    if old_condition is not None:
+                    key = (new_dungeon.id, specific['battle_id'],
+                           specific['title'])
+                    if key in conditions:
                         continue
+                    conditions.add(key)
                     new_condition = SpecificCondition(
                         dungeon_id=new_dungeon.id, **specific)
-                    #print (u'{}'.format(new_condition))
-                    new_log = Log(log=u'Create {}({})'.format(
-                        type(new_condition).__name__,
-                        new_condition))
-                    session.add_all((new_condition, new_log))
-                    #session.add(new_condition)
-                    session.commit()
-                    #old_battle = session.query(Battle).filter(
-                    #    Battle.id == battle_id).first()
-                    # But we actually are unable to associate the Condition()
-                    # if the Battle() does not exist yet.
-                    # It will not on the first run of import_world()
-                    #if old_battle is None:
-                    #    continue
-                    # So I am commenting this feature out
-#            '''
-            for prize_type, prizes_list in prizes.items():
+                    new_conditions.append(get_insert_row(new_condition))
+                    evicted.update((new_dungeon.id, specific['battle_id']))
+                    session.add(Log(log=u'Create {}({})'.format(
+                        type(new_condition).__name__, new_condition)))
+            for prize_type, prizes_list in dungeon['prizes'].items():
                 for prize in prizes_list:
                     id = prize['id']
-                    name = prize['name']
-                    drop = session.query(Drop).filter_by(
-                        id=id).first()
-                    if drop is None:
-                        drop = Drop(id=id, name=name)
-                    prize['prize_type'] = prize_type
-                    old_prize = session.query(Prize).filter_by(
-                        drop_id=id, prize_type=prize_type,
-                        dungeon=new_dungeon).first()
-                    if old_prize is not None:
+                    key = (new_dungeon.id, id, int(prize_type))
+                    if key in prizes:
                         continue
-                    prize['drop_id'] = id
-                    new_prize = Prize(**prize)
-                    new_prize.dungeon = new_dungeon
-                    new_prize.drop = drop
-                    session.add(new_prize)
-                    session.commit()
-                    try:
-                        new_log = Log(
-                            log=u'Create Prize({}) from Dungeon({})'.format(
-                                new_prize, new_dungeon))
-                        session.add(new_log)
-                        session.commit()
-                    except (UnicodeEncodeError, ):
-                        logging.critical('UnicodeEncodeError')
+                    prizes.add(key)
+                    if id not in drops:
+                        drops[id] = Drop(id=id, name=prize['name'])
+                        session.add(drops[id])
+                    new_prize = Prize(**dict(
+                        prize, drop_id=id, prize_type=int(prize_type),
+                        dungeon_id=new_dungeon.id))
+                    new_prizes.append(get_insert_row(new_prize))
+                    evicted.add(new_dungeon.id)
+                    session.add(Log(
+                        log=u'Create Prize({}) from Dungeon({})'.format(
+                            new_prize, new_dungeon)))
+
+        # The new drops first
+        session.flush()
+        insert_new(session, SpecificCondition.__table__, new_conditions,
+                   'dungeon_id')
+        insert_new(session, Prize.__table__, new_prizes, 'dungeon_id')
+        session.commit()
+        # Only once the new world and dungeons are visible to other sessions
+        if new_objects:
+            invalidate_nav()
+        evict_ids(*evicted)
         success = True
     logging.debug('{}(filepath="{}") end'.format(
         sys._getframe().f_code.co_name, filepath))
     return success
 
 
+@rebuild_on_import()
 def import_win_battle(data=None, filepath=''):
     """/dff/battle/win
     /dff/event/wday/9/win_battle
@@ -291,6 +309,7 @@ def import_win_battle(data=None, filepath=''):
                 #session.commit()
             if old_condition not in battle.conditions:
                 battle.conditions.append(old_condition)
+                evict_ids(battle.id)
                 new_log = Log(log=u'Add Condition({}) to Battle({})'.format(
                     old_condition, battle))
                 session.add(new_log)
@@ -301,137 +320,169 @@ def import_win_battle(data=None, filepath=''):
     return success
 
 
+@rebuild_on_import('enemy')
 def import_battle(data=None, filepath=''):
-    """get_battle_init_data"""
+    """get_battle_init_data
+
+    Everything the payload refers to is looked up with a few IN queries up
+    front and everything new is written with one commit. Enemies are keyed
+    by (param_id, lv) so new ones do not need an id until the end.
+    """
     logging.debug('{}(filepath="{}") start'.format(
         sys._getframe().f_code.co_name, filepath))
     data = get_load_data(data, filepath)
 
+    battle = data['battle']
+    battle_id = battle['battle_id']
+    # (enemy, child, params) in payload order
+    children = []
+    for round in battle['rounds']:
+        for enemy in round['enemy']:
+            for e in enemy['children']:
+                params = e['params']
+                if isinstance(params, dict):
+                    params = (params,)
+                children.append((enemy, e, params))
+    param_ids = set(p['id'] for enemy, e, params in children for p in params)
+
     success = False
     with session_scope() as session:
-        battle = data['battle']
-        battle_id = battle['battle_id']
-        for round in battle['rounds']:
-            for enemy in round['enemy']:
-                for e in enemy['children']:
-                    new_drops = []
-                    for drop in e['drop_item_list']:
-                        # Get/Create Drop()
-                        id = drop.get('item_id')
-                        if id is not None:
-                            new_drop = session.query(Drop).filter_by(
-                                id=id).first()
-                            if new_drop is None:
-                                name = get_name_by_id(id)
-                                if name == id:
-                                    name = None
-                                new_drop = Drop(id=id, name=name)
-                            new_drops.append(new_drop)
-                    # Get/Create Enemy()
-                    enemy_id = e['enemy_id']
-                    params = e['params']
-                    if isinstance(params, dict):
-                        params = (params,)
-                    for p in params:
-                        param_id = p['id']
-                        lv = p['lv']
-                        # Ex bosses may have the same level as their Elite
-                        # but have different stats
-                        new_enemy = session.query(Enemy).filter_by(
-                            param_id=param_id,
-                            lv=lv,
-                        ).first()
-                        if new_enemy is None:
-                            event = battle.get('event')
-                            if isinstance(event, dict):
-                                e['event_id'] = event.get('event_id')
-                                e['event_type'] = event.get('event_type')
-                            e['is_sp_enemy'] = enemy['is_sp_enemy']
-                            e['params'] = p
-                            new_enemy = Enemy(**e)
-                            new_log = Log(
-                                log=u'Create Enemy({})'.format(new_enemy))
-                            session.add_all((new_enemy, new_log))
-                            session.commit()
-                        # Get/Create/Associate Attribute()
-                        for attribute in p['def_attributes']:
-                            attribute = {k:int(v) for k, v in attribute.items()}
-                            new_attribute = session.query(Attribute).filter_by(
-                                **attribute).first()
-                            if new_attribute is None:
-                                new_attribute = Attribute(**attribute)
-                                new_log = Log(log='Create Attribute({})'.format(
-                                    new_attribute))
-                                session.add_all((new_attribute, new_log))
-                                session.commit()
-                            #if new_attribute not in new_enemy.attributes:
-                            association = session.query(AttributeAssociation)\
-                                .filter(
-                                    AttributeAssociation.attribute_id == new_attribute.id,
-                                    AttributeAssociation.param_id == new_enemy.param_id
-                                ).first()
-                            if association is None:
-                                association = AttributeAssociation(
-                                    attribute_id=new_attribute.id,
-                                    param_id=new_enemy.param_id)
-                                session.add(association)
-                                session.commit()
-                                # Ugh, this outputs None for the association
-                                new_log = Log(
-                                    log='Create AttributeAssociation({})'\
-                                    .format(association))
-                                session.add(new_log)
-                                session.commit()
-                                #new_enemy.attributes.append(new_attribute)
-                                #new_log = Log(
-                                #    log='Add Attribute({}) to Enemy({})'.format(
-                                #        new_attribute, new_enemy))
-                                #session.add(new_log)
-                        # Get Battle() (or fail)
-                        old_battle = session.query(Battle).filter_by(
-                            id=battle_id).first()
-                        if old_battle is None:
-                            logging.warning(
-                                u'We are missing a battle object for {}'\
-                                .format(new_enemy))
-                            # This may occur if we skip import_battle_list()
-                            continue
-                        # Associate Drop()
-                        for new_drop in new_drops:
-                            # See if we have a DropAssociation already
-                            drop_association = session.query(
-                                DropAssociation).filter_by(
-                                    enemy_id=new_enemy.id,
-                                    drop_id=new_drop.id,
-                                    battle_id=old_battle.id,
-                                ).first()
-                            if drop_association is None or\
-                               drop_association.battle_id != old_battle.id:
-                                # We do not have a DropAssociation or
-                                # the DropAssociation is different
-                                # so make a new one
-                                drop_association = DropAssociation(
-                                    enemy_id=new_enemy.id,
-                                    drop_id=new_drop.id,
-                                    battle_id=old_battle.id,
-                                )
-                                session.add(new_drop)
-                                session.add(drop_association)
-                                session.commit()
-                                new_log = Log(
-                                    log=u'Create DropAssociation({})'.format(
-                                        drop_association))
-                                session.add(new_log)
-                        # Associate Enemy() with Battle()
-                        if old_battle not in new_enemy.battles:
-                            new_enemy.battles.append(old_battle)
-                            new_log = Log(
-                                log=u'Add Enemy({}) to Battle({})'.format(
-                                    new_enemy, old_battle))
-                            session.add(new_log)
-                        session.commit()
-                        # TODO 2015-05-10
-                        # Improve this nesting indentation.
+        drops = load_existing(session, Drop.id, (
+            drop.get('item_id') for enemy, e, params in children
+            for drop in e['drop_item_list']))
+        # Ex bosses may have the same level as their Elite
+        # but have different stats
+        enemies = load_existing(session, Enemy.param_id, param_ids,
+                                key=lambda obj: (obj.param_id, obj.lv))
+        # There are only a few dozen attributes
+        attributes = dict(((a.attribute_id, a.factor), a)
+                          for a in session.query(Attribute))
+        associations = set()
+        for chunk in chunks(param_ids):
+            associations.update(session.query(
+                Attribute.attribute_id, Attribute.factor,
+                AttributeAssociation.param_id)\
+                .join(AttributeAssociation.attribute)\
+                .filter(AttributeAssociation.param_id.in_(chunk)))
+        old_battle = session.query(Battle).filter_by(id=battle_id).first()
+        drop_associations = set(session.query(
+            Enemy.param_id, Enemy.lv, DropAssociation.drop_id)\
+            .join(DropAssociation.enemy)\
+            .filter(DropAssociation.battle_id == battle_id))
+        battle_enemies = set(session.query(Enemy.param_id, Enemy.lv)\
+            .join(enemy_table, enemy_table.c.enemy_id == Enemy.id)\
+            .filter(enemy_table.c.battle_id == battle_id))
+
+        new_enemies = []
+        # Rows of the association tables as (enemy or attribute, ...)
+        # They are inserted once the new enemies and attributes have ids
+        new_associations = []
+        new_drop_associations = []
+        new_battle_enemies = []
+        evicted = set()
+        for enemy, e, params in children:
+            new_drops = []
+            for drop in e['drop_item_list']:
+                # Get/Create Drop()
+                id = drop.get('item_id')
+                if id is not None:
+                    new_drop = drops.get(id)
+                    if new_drop is None:
+                        name = get_name_by_id(id)
+                        if name == id:
+                            name = None
+                        new_drop = drops[id] = Drop(id=id, name=name)
+                    new_drops.append(new_drop)
+            # Get/Create Enemy()
+            for p in params:
+                key = (p['id'], p['lv'])
+                new_enemy = enemies.get(key)
+                if new_enemy is None:
+                    event = battle.get('event')
+                    if isinstance(event, dict):
+                        e['event_id'] = event.get('event_id')
+                        e['event_type'] = event.get('event_type')
+                    e['is_sp_enemy'] = enemy['is_sp_enemy']
+                    e['params'] = p
+                    new_enemy = enemies[key] = Enemy(**e)
+                    new_log = Log(log=u'Create Enemy({})'.format(new_enemy))
+                    session.add_all((new_enemy, new_log))
+                    new_enemies.append(new_enemy)
+                    evicted.update((new_enemy.param_id, new_enemy.enemy_id))
+                # Get/Create/Associate Attribute()
+                for attribute in p['def_attributes']:
+                    attribute = {k:int(v) for k, v in attribute.items()}
+                    key = (attribute['attribute_id'], attribute['factor'])
+                    new_attribute = attributes.get(key)
+                    if new_attribute is None:
+                        new_attribute = attributes[key] = Attribute(
+                            **attribute)
+                        new_log = Log(log='Create Attribute({})'.format(
+                            new_attribute))
+                        session.add_all((new_attribute, new_log))
+                    key += (new_enemy.param_id, )
+                    if key not in associations:
+                        associations.add(key)
+                        new_associations.append(
+                            (new_attribute, new_enemy.param_id))
+                        evicted.update((new_enemy.param_id,
+                                        new_enemy.enemy_id))
+                        # AttributeAssociation.__repr__()
+                        new_log = Log(
+                            log='Create AttributeAssociation({})'.format(
+                                new_attribute))
+                        session.add(new_log)
+                # Get Battle() (or fail)
+                if old_battle is None:
+                    logging.warning(
+                        u'We are missing a battle object for {}'.format(
+                            new_enemy))
+                    # This may occur if we skip import_battle_list()
+                    continue
+                # Associate Drop()
+                for new_drop in new_drops:
+                    key = (new_enemy.param_id, new_enemy.lv, new_drop.id)
+                    if key in drop_associations:
+                        continue
+                    drop_associations.add(key)
+                    new_drop_associations.append((new_enemy, new_drop))
+                    session.add(new_drop)
+                    evicted.update((new_drop.id, old_battle.id,
+                                    new_enemy.param_id, new_enemy.enemy_id))
+                    # DropAssociation.__repr__()
+                    new_log = Log(log=u'Create DropAssociation({})'.format(
+                        u'{} from {} in {}'.format(
+                            new_drop, new_enemy, old_battle)))
+                    session.add(new_log)
+                # Associate Enemy() with Battle()
+                key = (new_enemy.param_id, new_enemy.lv)
+                if key not in battle_enemies:
+                    battle_enemies.add(key)
+                    new_battle_enemies.append(new_enemy)
+                    evicted.update((old_battle.id, new_enemy.param_id,
+                                    new_enemy.enemy_id))
+                    new_log = Log(log=u'Add Enemy({}) to Battle({})'.format(
+                        new_enemy, old_battle))
+                    session.add(new_log)
+
+        register_search_ids(session, *new_enemies)
+        # Give the new enemies and attributes their ids
+        session.flush()
+        for table, rows in (
+            (AttributeAssociation.__table__, [
+                {'attribute_id': a.id, 'param_id': param_id}
+                for a, param_id in new_associations]),
+            (DropAssociation.__table__, [
+                {'enemy_id': e.id, 'drop_id': d.id, 'battle_id': battle_id}
+                for e, d in new_drop_associations]),
+            (enemy_table, [
+                {'enemy_id': e.id, 'battle_id': battle_id}
+                for e in new_battle_enemies]),
+        ):
+            for chunk in chunks(rows):
+                session.execute(table.insert(), chunk)
+        session.commit()
+        evict_ids(*evicted)
         success = True
     logging.debug('{}(filepath="{}") end'.format(
         sys._getframe().f_code.co_name, filepath))
@@ -451,8 +502,11 @@ def create_fix_relic(e):
             new_log = Log(log='Create Relic({})'.format(new_relic))
             session.add_all((new_relic, new_log))
             session.commit()
+            evict_ids(new_relic.equipment_id)
+            register_search_ids(session, new_relic)
         if new_relic.critical != e['critical']:
             new_relic.critical = e['critical']
+            evict_ids(new_relic.equipment_id)
             new_log = Log(log='Update {}({}).critical from 0 to {}'.format(
                 type(new_relic).__name__, new_relic, new_relic.critical))
             session.add(new_log)
@@ -460,57 +514,15 @@ def create_fix_relic(e):
         if not new_relic.image_path:
             new_relic.image_path = e['image_path']
             session.commit()
+            evict_ids(new_relic.equipment_id)
         if not new_relic.detail_image_path:
             new_relic.detail_image_path = e['detail_image_path']
             session.commit()
+            evict_ids(new_relic.equipment_id)
         success = True
     return success
 
 
-def check_ssb(stat, buddy_id, old_value, new_value):
-    """Check if the stat difference is due to the mastery of an SSB.
-
-    Requires the values to be hard-coded in a local "ssb.csv" file with
-    columns: buddy_id,name,stat,value
-
-    Returns bool.
-    """
-    filepath = os.path.join(os.environ['OPENSHIFT_DATA_DIR'], 'ssb.csv')
-    try:
-        with open(filepath) as csvfile:
-            reader = csv.DictReader(csvfile)
-            for row in reader:
-                # continue if we do not have the correct buddy_id
-                if int(row['buddy_id']) != int(buddy_id):
-                    continue
-
-                # Here we have the correct buddy_id
-                # Check if we have the correct stat
-                if not (row['stat'] == stat or
-                        'series_{}'.format(row['stat']) == stat):
-                    # return False because stat difference is not due to
-                    # this SSB mastery.
-                    # Is it possible in the future that a single character's SSB
-                    # may include a stat boost to different stats?
-                    # If so continue instead.
-                    return False
-
-                # Here we have the correct stat
-                # Check if the stat difference is correct
-                if int(row['value']) == (int(new_value) - int(old_value)):
-                    # It appears as if the stat difference is due to a
-                    # SSB mastery.
-                    logging.debug(
-                        'Stat difference due to SSB mastery for ' +
-                        '{} found and ignored.'.format(row['name'])
-                    )
-                    return True
-    except (IOError, ):  # python3 uses FileNotFoundError which is a subclass?
-        return False
-
-    return False
-
-
 def create_fix_character(c):
     success = False
 
@@ -531,6 +543,8 @@ def create_fix_character(c):
                 type(new_character).__name__, new_character))
             session.add_all((new_character, new_log))
             session.commit()
+            evict_ids(new_character.buddy_id)
+            register_search_ids(session, new_character)
 
         # Compare and update stats for balance patches.
         c['defense'] = c['def']
@@ -544,6 +558,7 @@ def create_fix_character(c):
                 if check_ssb(key, c['buddy_id'], old_value, new_value):
                     continue
                 new_character.__setattr__(key, new_value)
+                evict_ids(new_character.buddy_id)
                 new_log = Log(log='Update {}({}).{} from {} to {}'.format(
                     type(new_character).__name__, new_character,
                     key, old_value, new_value)
@@ -567,6 +582,7 @@ def create_fix_character(c):
                 continue
             ec['buddy_id'] = new_character.buddy_id
             ce = CharacterEquip(**ec)
+            evict_ids(new_character.buddy_id)
             new_log = Log(
                 log='Add {}({}) to {}({})'.format(
                     type(ce).__name__, ce,
@@ -591,6 +607,7 @@ def create_fix_character(c):
                 if ca.rarity < int(ac['rarity']):
                     old_rarity = ca.rarity
                     ca.rarity = ac['rarity']
+                    evict_ids(new_character.buddy_id)
                     new_log = Log(
                         log='Update {} {}({}).rarity from {} to {}'.format(
                             new_character.name,
@@ -602,6 +619,7 @@ def create_fix_character(c):
                 continue
             ac['buddy_id'] = new_character.buddy_id
             ca = CharacterAbility(**ac)
+            evict_ids(new_character.buddy_id)
             new_log = Log(
                 log='Add {}({}) to {}({})'.format(
                     type(ca).__name__, ca,
@@ -612,6 +630,7 @@ def create_fix_character(c):
     return success
 
 
+@rebuild_on_import('relic', 'material', 'character')
 def import_party(data=None, filepath=''):
     """/dff/party/list"""
     logging.debug('{}(filepath="{}") start'.format(
@@ -633,6 +652,8 @@ def import_party(data=None, filepath=''):
             new_log = Log(log='Create Material({})'.format(new_material))
             session.add_all((new_material, new_log))
             session.commit()
+            evict_ids(new_material.id)
+            register_search_ids(session, new_material)
 
         buddies = data.get('buddies', ())
         for c in buddies:
@@ -653,6 +674,7 @@ def import_dff(data=None, filepath=''):
     return import_party(data, filepath)
 
 
+@rebuild_on_import('ability')
 def import_recipes(data=None, filepath=''):
     """/dff/ability/get_generation_recipes
     /dff/ability/get_upgrade_recipes
@@ -684,9 +706,13 @@ def import_recipes(data=None, filepath=''):
                     new_log = Log(log='Create Ability({})'.format(new_ability))
                     session.add_all((new_ability, new_log))
                     session.commit()
+                    evict_ids(new_ability.ability_id,
+                              *a['material_id_2_num'].keys())
+                    register_search_ids(session, new_ability)
                 elif new_ability.required_gil == 32767 and\
                 new_ability.required_gil < a['required_gil']:
                     new_ability.required_gil = a['required_gil']
+                    evict_ids(new_ability.ability_id)
                     new_log = Log(
                         log='Update Ability({}).required_gil to {}'.format(
                             new_ability, new_ability.required_gil
@@ -700,6 +726,7 @@ def import_recipes(data=None, filepath=''):
     return success
 
 
+@rebuild_on_import('relic')
 def import_enhance_evolve(data=None, filepath=''):
     """/dff/equipment/enhance
     /dff/equipment/evolve
@@ -718,6 +745,7 @@ def import_enhance_evolve(data=None, filepath=''):
     return success
 
 
+@rebuild_on_import('character')
 def import_grow(data=None, filepath=''):
     """/dff/grow_egg/use"""
     if data is None or not isinstance(data, dict):
@@ -740,6 +768,23 @@ def get_by_name(name, all=False):
 
 
 def get_by_id(id, all=False, enemy=False):
+    """Get an object (or a list of all similar objects) by its search_id.
+
+    Results are kept in models.cache.object_cache until an importer (in any
+    process) touches the id or the entry expires.
+    """
+    sync_evictions()
+    key = (int(id), bool(all), bool(enemy))
+    r = object_cache.get(key)
+    if r is not None:
+        return r
+    r = load_by_id(id, all=all, enemy=enemy)
+    if r:
+        object_cache.set(key, r)
+    return r
+
+
+def load_by_id(id, all=False, enemy=False):
     r = None
     if enemy:
         with session_scope() as session:
@@ -759,24 +804,17 @@ def get_by_id(id, all=False, enemy=False):
         return r
 
     with session_scope() as session:
-        for m, c, o in (
-            (Material, Material.id, ('id', )),
-            (World, World.id, ('id', )),
-            (Dungeon, Dungeon.id, ('id', )),
-            (Ability, Ability.ability_id, ('name', )),
-            (Relic, Relic.equipment_id, ('level', 'rarity')),
-            (Battle, Battle.id, ('id', )),
-            (Character, Character.buddy_id, ('level', )),
-            (Quest, Quest.id, ('id', )),
-            (Enemy, Enemy.param_id, ('lv', )),
-        ):
+        # Ask the SearchDirectory which model this is instead of trying them all
+        for m, c, o in get_search_candidates(session, id):
             q = session.query(m)
             q = q.filter(c == id)
             for i in o:
                 q = q.order_by(i)
             # joinedload('*') is slow
             #q = q.options(joinedload('*'))
-            if m != World:
+            if m.main_load_options is not None:
+                q = q.options(*m.main_load_options)
+            elif m != World:
                 q = q.options(subqueryload('*'))
             # lazyload('*') is the default and does not work the way I want
             #q = q.options(lazyload('*'))
@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+
+import calendar
+import logging
+import os
+import time
+
+import arrow
+
+from sqlalchemy import func
+
+from .base import session_scope
+from .dungeon import get_content_dates
+from .world import World, get_active_events, get_realms
+
+
+NAV_STAMP_PATH = os.path.join(
+    os.environ.get('OPENSHIFT_DATA_DIR', '/tmp'), 'nav_stamp')
+
+# Refresh at least this often (in seconds) even if nothing seems to change
+NAV_MAX_AGE = 3600
+
+_nav = {
+    'expires': 0,
+    'stamp': None,
+}
+
+
+def get_next_event_change(now=None):
+    '''
+    Return the unix timestamp of the next time an event opens or closes or
+    None if there is nothing scheduled.
+    '''
+    if now is None:
+        now = arrow.now()
+    changes = []
+    with session_scope() as session:
+        for column in (World.opened_at, World.kept_out_at):
+            change = session.query(func.min(column))\
+                            .filter(World.world_type == 2)\
+                            .filter(column > now).scalar()
+            if change is not None:
+                changes.append(calendar.timegm(change.utctimetuple()))
+    if not changes:
+        return None
+    return min(changes)
+
+
+def get_nav_stamp():
+    try:
+        return os.stat(NAV_STAMP_PATH).st_mtime
+    except OSError:
+        return None
+
+
+def invalidate_nav():
+    '''
+    Make every process refresh its navigation metadata.
+    import_world() calls this when it creates a World or Dungeon.
+    '''
+    try:
+        with open(NAV_STAMP_PATH, 'a'):
+            os.utime(NAV_STAMP_PATH, None)
+    except (IOError, OSError) as e:
+        logging.warning('Unable to touch {}: {}'.format(NAV_STAMP_PATH, e))
+    _nav['expires'] = 0
+
+
+def get_nav():
+    '''
+    Return a dict of the metadata every page shows in its navigation bar.
+
+    This is only queried again when an event opens or closes, when
+    import_world() adds something or after NAV_MAX_AGE seconds.
+    '''
+    now = time.time()
+    stamp = get_nav_stamp()
+    if now < _nav['expires'] and stamp == _nav['stamp']:
+        return _nav
+
+    next_change = get_next_event_change()
+    expires = now + NAV_MAX_AGE
+    if next_change is not None:
+        expires = min(expires, next_change)
+    _nav.update({
+        'content_dates': get_content_dates(),
+        'active_events': get_active_events(),
+        'realms': get_realms(),
+        'expires': expires,
+        'stamp': stamp,
+    })
+    return _nav
+
+
+def get_nav_content_dates():
+    return get_nav()['content_dates']
+
+
+def get_nav_active_events():
+    return get_nav()['active_events']
+
+
+def get_nav_realms():
+    return get_nav()['realms']
+
+
+### EOF ###
@@ -1,6 +1,6 @@
 from __future__ import absolute_import
 
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 from sqlalchemy.orm import relationship, backref
 from sqlalchemy.dialects.mysql import TINYINT, SMALLINT, BIGINT
 
@@ -20,6 +20,11 @@ PRIZE_TYPE = {
 
 class Prize(BetterBase):
     __tablename__ = 'prize'
+    __table_args__ = (
+        # import_world() relies on this to skip prizes we already have
+        Index('uq_prize_drop_id_prize_type_dungeon_id',
+              'drop_id', 'prize_type', 'dungeon_id', unique=True),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(length=32), nullable=False)
     prize_type = Column(TINYINT, nullable=False)
@@ -0,0 +1,113 @@
+from __future__ import absolute_import
+
+from sqlalchemy.types import DateTime
+
+from .base import session_scope, encode_datetime
+from .enemy import Enemy
+from .search import SEARCH_MODELS, get_search_candidates
+
+
+# The column search_id comes from per model (See SEARCH_MODELS)
+SEARCH_COLUMNS = dict((m, c) for m, c, o in SEARCH_MODELS)
+
+# The frontend formatters read these fields alongside another one
+# (See super_formatter() and cell_styler() in base.js)
+COMPANION_FIELDS = {
+    'max_hp': ('defense', ),
+    'image_path': ('name', ),
+}
+
+
+def get_fields(model, fields):
+    '''
+    Return a list of 3-tuples (name, column, encoder) for the field names of
+    a model. id and search_id are always included if the model has them.
+
+    Raise ValueError for a field which is not a column of the model.
+    '''
+    table_columns = model.__table__.columns
+    names = []
+    for name in ('id', ) + tuple(fields):
+        companions = COMPANION_FIELDS.get(name, ())
+        if name.startswith('series_'):
+            companions += ('series_id', )
+        for i in (name, ) + companions:
+            if i not in names and (i in table_columns or i == name != 'id'):
+                names.append(i)
+
+    ret = []
+    for name in names:
+        if name == 'search_id':
+            continue
+        if name not in table_columns:
+            raise ValueError('Unknown field "{}"'.format(name))
+        column = getattr(model, name)
+        encoder = None
+        type_ = table_columns[name].type
+        if isinstance(getattr(type_, 'impl', type_), DateTime):
+            encoder = encode_datetime
+        ret.append((name, column, encoder))
+
+    search_column = SEARCH_COLUMNS.get(model)
+    if search_column is not None:
+        ret.append(('search_id', search_column, None))
+    return ret
+
+
+def query_fields(session, fields):
+    '''
+    Return a 2-tuple (query, serialize) where query selects only these
+    fields (from get_fields()) as plain rows without the identity map and
+    serialize turns a row into a dict.
+    '''
+    names = tuple(name for name, column, encoder in fields)
+    encoders = tuple((i, encoder) for i, (name, column, encoder)
+                     in enumerate(fields) if encoder is not None)
+
+    def serialize(row):
+        if encoders:
+            row = list(row)
+            for i, encode in encoders:
+                row[i] = encode(row[i])
+        return dict(zip(names, row))
+
+    q = session.query(*(column for name, column, encoder in fields))
+    return q, serialize
+
+
+def load_fields_by_id(id, fields, all=False, enemy=False):
+    '''
+    Return the dicts (of only these fields) of the objects get_by_id() would
+    return, or None if there are none.
+
+    Raise ValueError for an unknown field.
+    '''
+    if enemy:
+        candidates = ((Enemy, Enemy.enemy_id, ('lv', )), )
+    else:
+        with session_scope() as session:
+            candidates = tuple(get_search_candidates(session, id))
+    # Validate outside of session_scope() which would swallow the ValueError
+    candidates = [(get_fields(m, fields), m, c, o) for m, c, o in candidates]
+
+    ret = None
+    with session_scope() as session:
+        for f, m, c, o in candidates:
+            q, serialize = query_fields(session, f)
+            q = q.filter(c == id)
+            for i in o:
+                q = q.order_by(getattr(m, i))
+            if all:
+                rows = q.all()
+                if rows:
+                    ret = [serialize(row) for row in rows]
+                    break
+                continue
+            row = q.first()
+            if row is not None:
+                ret = serialize(row)
+                break
+    return ret
+
+
+### EOF ###
@@ -9,6 +9,7 @@ from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.mysql import TINYINT
 
 from .base import BetterBase, session_scope
+from .cache import evict_ids
 from .drop import Drop
 from .log import Log
 from .prize import Prize
@@ -111,6 +112,9 @@ def import_quests(data=None, filepath=''):
         with open(filepath) as infile:
             data = json.load(infile)
 
+    # Imported here because models.search imports this module
+    from .search import register_search_ids
+
     if data.get('special_quest_prizes'):
         logging.critical('There is a special quest prize!')
 
@@ -126,6 +130,8 @@ def import_quests(data=None, filepath=''):
                     type(new_quest).__name__, new_quest))
                 session.add_all((new_quest, new_log))
                 session.commit()
+                evict_ids(new_quest.id)
+                register_search_ids(session, new_quest)
             for prize in prizes:
                 id = prize['id']
                 name = prize['name']
@@ -152,6 +158,7 @@ def import_quests(data=None, filepath=''):
                 #session.add(new_log)
                 session.add_all((new_prize, new_log))
                 session.commit()
+                evict_ids(new_quest.id)
         success = True
     logging.debug('{}(filepath="{}") end'.format(
         sys._getframe().f_code.co_name, filepath))
@@ -2,16 +2,19 @@ from __future__ import absolute_import
 
 import sys
 
-from sqlalchemy import Column, Integer, String, Boolean
+from sqlalchemy import Column, Integer, String, Boolean, Index
 from sqlalchemy.dialects.mysql import TINYINT, SMALLINT
-from sqlalchemy.orm import subqueryload
 
 from .base import BetterBase, session_scope
-from .drop import DropAssociation
+from .drop import get_drop_locations, get_locations_expiry
 
 
 class Relic(BetterBase):
     __tablename__ = 'relic'
+    __table_args__ = (
+        Index('ix_relic_equipment_id_level_rarity',
+              'equipment_id', 'level', 'rarity'),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     equipment_id = Column(Integer)
     name = Column(String(length=64), nullable=False)
@@ -121,17 +124,15 @@ class Relic(BetterBase):
                 self.soul_strike_id))
 
         # This is repeated in Material.main_panels
-        # This queries drop_table, enemy, world, dungeon, battle
-        # TODO 2015-05-11
-        # Filter out (expired?) events
+        # This queries drop_table, enemy, world, dungeon, battle at once
         drop_locations = []
-        with session_scope() as session:
-            drops = session.query(DropAssociation).filter_by(
-                drop_id=self.search_id).options(subqueryload('enemy')).all()
-            for drop in drops:
-                drop_locations.append(
-                    '<a href="/{}">{}</a>'.format(
-                        drop.enemy.search_id, str(drop)))
+        locations = get_drop_locations(self.search_id, exclude_expired=True)
+        for enemy, battle, dungeon, world in locations:
+            drop_locations.append(
+                '<a href="/{}">{} from {} in {}</a>'.format(
+                    enemy.search_id, self.name, enemy, battle))
+        # Leave out the next event to close once it does
+        self._main_panels_expire_at = get_locations_expiry(locations)
 
         self._main_panels = (
             {
@@ -143,7 +144,7 @@ class Relic(BetterBase):
                 'title': 'Drop Locations',
                 'items': drop_locations,
                 'footer': 'These locations are not all inclusive and the drop ra\
-tes may vary.',
+tes may vary.<br>Expired events are not shown.',
             },
         )
 
@@ -0,0 +1,163 @@
+from __future__ import absolute_import
+
+import argparse
+import logging
+
+from sqlalchemy import Column, String
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects.mysql import BIGINT
+
+from .base import BetterBase, session_scope, make_tables
+from .bulk import load_existing
+from .ability import Ability
+from .battle import Battle
+from .character import Character
+from .dungeon import Dungeon
+from .enemy import Enemy
+from .material import Material
+from .quest import Quest
+from .relic import Relic
+from .world import World
+
+
+# model, search column, order_by
+# The order matters because some models share a search_id
+# (See Enemy.search_id) and the first model wins.
+SEARCH_MODELS = (
+    (Material, Material.id, ('id', )),
+    (World, World.id, ('id', )),
+    (Dungeon, Dungeon.id, ('id', )),
+    (Ability, Ability.ability_id, ('name', )),
+    (Relic, Relic.equipment_id, ('level', 'rarity')),
+    (Battle, Battle.id, ('id', )),
+    (Character, Character.buddy_id, ('level', )),
+    (Quest, Quest.id, ('id', )),
+    (Enemy, Enemy.param_id, ('lv', )),
+)
+SEARCH_PRIORITY = dict(
+    (m.__name__, i) for i, (m, c, o) in enumerate(SEARCH_MODELS))
+
+# Until the search_directory table has been backfilled get_by_id() has to try
+# every model
+_directory_ready = False
+
+
+class SearchDirectory(BetterBase):
+    '''
+    Which model a search_id belongs to so get_by_id() does not have to try
+    every model.
+    '''
+    __tablename__ = 'search_directory'
+    id = Column(BIGINT, primary_key=True, autoincrement=False)
+    model = Column(String(length=16), nullable=False)
+
+    search_id = None
+
+    def __repr__(self):
+        return '{} -> {}'.format(self.id, self.model)
+
+
+def get_search_model(name):
+    '''
+    Return the 3-tuple (model, search column, order_by) for a model name.
+    '''
+    return SEARCH_MODELS[SEARCH_PRIORITY[name]]
+
+
+def register_search_ids(session, *objs):
+    '''
+    Add new objects to the SearchDirectory unless their search_id already
+    belongs to a model with a higher priority.
+    Importers call this for every object they create.
+
+    Pass every new object at once; this is one query however many there are.
+    '''
+    names = {}
+    for obj in objs:
+        name = type(obj).__name__
+        search_id = obj.search_id
+        if search_id is None:
+            continue
+        if search_id not in names or\
+           SEARCH_PRIORITY[name] < SEARCH_PRIORITY[names[search_id]]:
+            names[search_id] = name
+    entries = load_existing(session, SearchDirectory.id, names)
+    for search_id, name in names.items():
+        entry = entries.get(search_id)
+        if entry is None:
+            session.add(SearchDirectory(id=search_id, model=name))
+        elif SEARCH_PRIORITY[name] < SEARCH_PRIORITY[entry.model]:
+            entry.model = name
+
+
+def get_search_candidates(session, search_id):
+    '''
+    Return an iterable of 3-tuples (model, search column, order_by) that
+    search_id may belong to.
+
+    This is a single indexed query and an unknown search_id returns nothing.
+    '''
+    global _directory_ready
+    try:
+        entry = session.query(SearchDirectory.model)\
+                       .filter(SearchDirectory.id == search_id).first()
+        if entry is not None:
+            _directory_ready = True
+            return (get_search_model(entry.model), )
+        if not _directory_ready:
+            _directory_ready = session.query(
+                session.query(SearchDirectory).exists()).scalar()
+    except SQLAlchemyError as e:
+        logging.warning('Unable to use the search_directory: {}'.format(e))
+    if _directory_ready:
+        return ()
+    return SEARCH_MODELS
+
+
+def backfill_search_directory():
+    '''
+    Add every existing search_id to the SearchDirectory.
+
+    Returns the number of entries added or changed.
+    '''
+    directory = {}
+    for m, c, o in SEARCH_MODELS:
+        with session_scope() as session:
+            for (search_id, ) in session.query(c).distinct():
+                if search_id is not None:
+                    directory.setdefault(search_id, m.__name__)
+
+    changed = 0
+    with session_scope() as session:
+        existing = dict(session.query(SearchDirectory.id,
+                                      SearchDirectory.model))
+        for search_id, name in directory.items():
+            model = existing.get(search_id)
+            if model == name:
+                continue
+            session.merge(SearchDirectory(id=search_id, model=name))
+            changed += 1
+        session.commit()
+    return changed
+
+
+def main(argv=None):
+    '''
+    Create and backfill the search_directory table.
+
+    python -m models.search
+    '''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    make_tables()
+    logging.info('Added or changed {} search_ids'.format(
+        backfill_search_directory()))
+
+
+if __name__ == '__main__':
+    main()
+
+
+### EOF ###
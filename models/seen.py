@@ -0,0 +1,92 @@
+from __future__ import absolute_import
+
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import Column, String
+from sqlalchemy.types import TIMESTAMP
+
+from .base import BetterBase, session_scope
+
+
+# Payloads are imported again once this long has passed since we last saw
+# them so a fix to an importer eventually reaches every row
+SEEN_TTL = 24 * 3600
+
+
+class SeenPayload(BetterBase):
+    '''
+    A hash of a /post payload (or of the entities in it) that was imported.
+    '''
+    __tablename__ = 'seen_payload'
+    id = Column(String(length=40), primary_key=True)
+    action = Column(String(length=32), nullable=False)
+    seen_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=False,
+                     index=True)
+
+    search_id = None
+
+    def __repr__(self):
+        return '{} {}'.format(self.action, self.id)
+
+
+def canonical_hash(obj):
+    '''
+    Return the SHA-1 (hex) of obj as JSON with sorted keys so the same
+    content always has the same hash however a client ordered it.
+    '''
+    body = json.dumps(obj, sort_keys=True, separators=(',',':'))
+    return hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+def get_cutoff(ttl=SEEN_TTL):
+    return datetime.utcnow() - timedelta(seconds=ttl)
+
+
+def is_seen(hashes, ttl=SEEN_TTL):
+    '''
+    Return True if any of hashes was imported in the last ttl seconds.
+
+    This is one primary key lookup; if the database is unavailable we say
+    no and let the importer decide.
+    '''
+    seen = False
+    with session_scope() as session:
+        seen = session.query(SeenPayload.id)\
+                      .filter(SeenPayload.id.in_(hashes),
+                              SeenPayload.seen_at >= get_cutoff(ttl))\
+                      .first() is not None
+    return seen
+
+
+def mark_seen(action, hashes):
+    '''
+    Remember that a payload with these hashes was imported.
+    '''
+    now = datetime.utcnow()
+    with session_scope() as session:
+        for h in set(hashes):
+            session.merge(SeenPayload(id=h, action=action, seen_at=now))
+        session.commit()
+
+
+def expire_seen(ttl=SEEN_TTL):
+    '''
+    Forget the hashes we have not seen in ttl seconds.
+
+    Returns the number of hashes removed.
+    '''
+    count = 0
+    with session_scope() as session:
+        count = session.query(SeenPayload)\
+                       .filter(SeenPayload.seen_at < get_cutoff(ttl))\
+                       .delete(synchronize_session=False)
+        session.commit()
+    if count:
+        logging.info('Forgot {} seen payload(s)'.format(count))
+    return count
+
+
+### EOF ###
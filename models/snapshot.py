@@ -0,0 +1,494 @@
+from __future__ import absolute_import
+
+import argparse
+import functools
+import hashlib
+import json
+import logging
+import os
+
+from sqlalchemy import tuple_, func
+
+from .base import session_scope, default_encode
+from .cache import LRUCache
+from .compress import COMPRESS_LEVEL_SNAPSHOT, gzip_bytes
+from .ability import Ability
+from .character import Character
+from .dungeon import Dungeon
+from .enemy import Enemy
+from .log import Log
+from .material import Material
+from .projection import get_fields, query_fields
+from .quest import Quest
+from .relic import Relic
+from .version import get_data_version, get_last_log, update_data_version
+from .world import World
+
+
+SNAPSHOT_DIR = os.path.join(
+    os.environ.get('OPENSHIFT_DATA_DIR', '/tmp'), 'snapshot')
+
+# Keep at most this many snapshots in the memory of each process
+# Every snapshot is also on disk so we do not lose anything by dropping them
+MAX_MEMORY_SNAPSHOTS = 64
+
+# category, model, order_by, group_by, ignore_rarity, limit, filter
+CATEGORIES = (
+    (('material', 'materials'),
+     Material, Material.id, Material.id,
+     False, None, None),
+    (('ability', 'abilities'),
+     Ability, Ability.name, Ability.name,
+     False, None, None),
+    (('enemy', 'enemies'),
+     Enemy, Enemy.name, Enemy.enemy_id,
+     True, None, None),
+     #'name', True, None, None),
+     #'enemy_id', True, None, None),
+     #'param_id', True, None, None),
+     # TODO 2015-05-18
+     # Filter out blank names (or group such that the non-blanks win)
+    (('relic', 'relics'),
+     Relic, Relic.name, Relic.name,
+     False, None, None),
+    (('world', 'worlds'),
+     World, World.id, World.id,
+     True, None, None),
+    (('dungeon', 'dungeons'),
+     Dungeon, Dungeon.id, Dungeon.id,
+     True, None, Dungeon.world_id),
+    # TODO 2015-05-07
+    # Enhance server-side pagination for Log
+    # request.GET.get('offset', 0)
+    # request.GET.get('limit', 25)
+    (('log', 'logs'),
+     Log, Log.timestamp.desc(), Log.id,
+     True, 100, None),
+    (('character', 'characters'),
+     Character, Character.name, Character.buddy_id,
+     True, None, Character.level),
+    (('quest', 'quests'),
+     Quest, Quest.id, Quest.id,
+     True, None, None),
+)
+
+# {filepath: (mtime, body)}
+_snapshots = {}
+
+# Snapshots of ad-hoc fields keyed by
+# (data version, category, rarity, filter, fields)
+# There are too many combinations of fields to keep them on disk; only the
+# fields of the table page (See get_table_fields()) are real snapshots.
+_projections = LRUCache(max_size=128, ttl=3600)
+
+
+def get_category(category):
+    '''
+    Return the CATEGORIES row for a category name (or alias) or None.
+    '''
+    category = category.lower()
+    for row in CATEGORIES:
+        if category in row[0]:
+            return row
+    return None
+
+
+def build_snapshot(category, rarity='all', filter=None, fields=None):
+    '''
+    Query and serialize a category (table) into a JSON string.
+
+    If fields is given only those columns (and id and search_id) are
+    selected and serialized, skipping the ORM entirely.
+    Returns None if there are no results.
+    Raises ValueError for an unknown field.
+    '''
+    row = get_category(category)
+    if row is None:
+        return None
+    c, m, o, g, r, l, f = row
+    if r:
+        rarity = 'all'
+
+    if fields:
+        # Validate outside of session_scope() which would swallow the error
+        fields = get_fields(m, fields)
+
+    ret = None
+    with session_scope() as session:
+        if fields:
+            q, serialize = query_fields(session, fields)
+        else:
+            q = session.query(m)
+        q = q.order_by(o).group_by(g).limit(l)
+        if rarity != 'all':
+            # Some tables do not have a rarity column
+            q = q.filter_by(rarity=rarity)
+        if filter is not None and f is not None:
+            # Filter Character by level
+            if 'character' in c:
+                q = q.filter(f <= filter)
+            else:
+                q = q.filter(f == filter)
+        elif 'character' in c:
+            # If we are not filtering Character by level
+            # Then we want to return one row per buddy_id corresponding
+            # to the highest level
+            t = tuple_(Character.buddy_id, Character.level)
+            sq = session.query(Character.buddy_id, func.max(Character.level))\
+                        .group_by(Character.buddy_id)
+            q = q.filter(t.in_(sq))
+        elif 'enemy' in c:
+            # We want to ensure that the "main" param_id is returned
+            #q = q.filter(Enemy.name != '')
+            # This fails for "Sinspawn Gui" (4100101)
+
+            # This fails for "Angler Whelk" (4060291)
+            t = tuple_(Enemy.enemy_id, Enemy.param_id)
+            sq = session.query(Enemy.enemy_id, func.min(Enemy.param_id))\
+                        .group_by(Enemy.enemy_id)
+            q = q.filter(t.in_(sq))
+        q = q.all()
+        if q:
+            ret = json.dumps([serialize(row) for row in q] if fields else
+                             m.dicts(q),
+                             default=default_encode, separators=(',',':'))
+    return ret
+
+
+def get_table_fields(row):
+    '''
+    Return the sorted field names the table page of a CATEGORIES row asks
+    for (its model's frontend_columns, See home() in ffrkapp.py) or None.
+
+    These are kept on disk like the full snapshot.
+    '''
+    columns = getattr(row[1], 'frontend_columns', None)
+    if not isinstance(columns, tuple):
+        # The BetterBase property
+        return None
+    return tuple(sorted(set(c for c, t in columns)))
+
+
+def normalize_args(row, rarity='all', filter=None):
+    '''
+    Return the 2-tuple (rarity, filter) a CATEGORIES row actually uses so
+    equivalent requests (ie: filter=1 and filter=01) share one snapshot.
+
+    Raises ValueError for a rarity or filter which is not an integer.
+    '''
+    c, m, o, g, r, l, f = row
+    if r or rarity is None or str(rarity).lower() == 'all':
+        rarity = 'all'
+    else:
+        try:
+            rarity = int(rarity)
+        except (TypeError, ValueError):
+            raise ValueError('Bad rarity "{}"'.format(rarity))
+    if f is None or filter is None or filter == '':
+        filter = None
+    else:
+        try:
+            filter = int(filter)
+        except (TypeError, ValueError):
+            raise ValueError('Bad filter "{}"'.format(filter))
+    return rarity, filter
+
+
+def is_known(category, rarity='all', filter=None):
+    '''
+    Return True if the (normalized) rarity and filter of a category are
+    values that exist in its table.
+
+    Snapshots are only kept for these so requests for made up values do not
+    fill the disk.
+    '''
+    c, m, o, g, r, l, f = get_category(category)
+    ret = False
+    with session_scope() as session:
+        q = session.query(m)
+        if rarity != 'all':
+            q = q.filter_by(rarity=rarity)
+        if filter is None:
+            ret = session.query(q.exists()).scalar()
+        elif 'character' in c:
+            # The same comparison as build_snapshot() but only up to the
+            # highest level so made up levels are still not kept
+            ret = session.query(q.filter(f <= filter).exists()).scalar()\
+                and session.query(q.filter(f >= filter).exists()).scalar()
+        else:
+            ret = session.query(q.filter(f == filter).exists()).scalar()
+    return ret
+
+
+def get_snapshot_path(category, rarity='all', filter=None, fields=None):
+    '''
+    Return the filepath of the snapshot for these arguments or None if the
+    category is unknown.
+
+    Raises ValueError for a bad rarity or filter (See normalize_args()).
+    '''
+    row = get_category(category)
+    if row is None:
+        return None
+    c = row[0]
+    rarity, filter = normalize_args(row, rarity, filter)
+    key = u'{}|{}|{}'.format(c[0], rarity, filter)
+    if fields:
+        key = u'{}|{}'.format(key, ','.join(sorted(set(fields))))
+    return os.path.join(SNAPSHOT_DIR, '{}-{}.json'.format(
+        c[0], hashlib.sha1(key.encode('utf-8')).hexdigest()))
+
+
+def write_snapshot(filepath, body, version=None):
+    '''
+    Atomically write a snapshot to disk and return its mtime.
+
+    version is the data version the snapshot was built from. If an import
+    changed it meanwhile the snapshot may be stale and invalidate() may have
+    already run, so it is not written (or removed again) and None is
+    returned.
+    '''
+    if version is not None and get_data_version()[0] != version:
+        return None
+    if not os.path.isdir(SNAPSHOT_DIR):
+        os.makedirs(SNAPSHOT_DIR)
+    tmppath = '{}.{}.tmp'.format(filepath, os.getpid())
+    mode = 'wb' if isinstance(body, bytes) else 'w'
+    with open(tmppath, mode) as outfile:
+        outfile.write(body)
+    os.rename(tmppath, filepath)
+    mtime = os.stat(filepath).st_mtime
+    if version is not None and get_data_version()[0] != version:
+        # The import may have invalidated before our rename
+        try:
+            os.remove(filepath)
+        except OSError:
+            pass
+        return None
+    return mtime
+
+
+def get_snapshot(category, rarity='all', filter=None, fields=None):
+    '''
+    Return the JSON string for a category (table) from memory, from disk,
+    or by building it as a last resort.
+
+    The fields of the table page are a snapshot of their own; any other
+    fields are a projection (See get_projection()).
+    Returns None if the category is unknown or there are no results.
+    Raises ValueError for an unknown field (See build_snapshot()) or a bad
+    rarity or filter (See normalize_args()).
+    '''
+    row = get_category(category)
+    if row is None:
+        return None
+    if fields:
+        fields = tuple(sorted(set(fields)))
+        if fields != get_table_fields(row):
+            return get_projection(category, rarity, filter, fields)
+
+    filepath = get_snapshot_path(category, rarity, filter, fields)
+    rarity, filter = normalize_args(row, rarity, filter)
+
+    try:
+        mtime = os.stat(filepath).st_mtime
+    except OSError:
+        mtime = None
+    if mtime is not None:
+        cached = _snapshots.get(filepath)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+        try:
+            with open(filepath) as infile:
+                body = infile.read()
+        except (IOError, OSError):
+            # Another process invalidated this snapshot between calls
+            pass
+        else:
+            remember_snapshot(filepath, mtime, body)
+            return body
+
+    version = get_data_version()[0]
+    body = build_snapshot(category, rarity, filter, fields)
+    if body is None:
+        return None
+    if (rarity, filter) != ('all', None) and\
+       not is_known(category, rarity, filter):
+        return body
+    try:
+        mtime = write_snapshot(filepath, body, version)
+    except (IOError, OSError) as e:
+        # Without the file other processes can not invalidate our copy so do
+        # not keep it in memory either
+        logging.warning('Unable to write snapshot {}: {}'.format(filepath, e))
+    else:
+        if mtime is not None:
+            remember_snapshot(filepath, mtime, body)
+    return body
+
+
+def get_projection(category, rarity='all', filter=None, fields=()):
+    '''
+    Return the JSON string of only some (ad-hoc) fields of a category
+    (table).
+
+    These are kept in memory once per data version.
+    '''
+    row = get_category(category)
+    if row is None:
+        return None
+    c = row[0]
+    rarity, filter = normalize_args(row, rarity, filter)
+    fields = tuple(sorted(set(fields)))
+    key = (get_data_version()[0], c[0], rarity, filter, fields)
+    body = _projections.get(key)
+    if body is None:
+        body = build_snapshot(category, rarity, filter, fields)
+        if body is not None and key[0] is not None:
+            _projections.set(key, body)
+    return body
+
+
+def get_snapshot_gzip(category, rarity='all', filter=None, fields=None):
+    '''
+    Return the gzipped JSON string for a category (table).
+
+    The compressed copy lives next to the snapshot (with a .gz suffix) so it
+    is compressed once per import instead of once per request.
+    Returns None if the category is unknown, there are no results or the
+    fields are a projection (See get_snapshot()).
+    '''
+    row = get_category(category)
+    if row is None:
+        return None
+    if fields:
+        fields = tuple(sorted(set(fields)))
+        if fields != get_table_fields(row):
+            return None
+    version = get_data_version()[0]
+    body = get_snapshot(category, rarity, filter, fields)
+    if body is None:
+        return None
+    filepath = get_snapshot_path(category, rarity, filter, fields)
+    gzpath = '{}.gz'.format(filepath)
+    try:
+        mtime = os.stat(filepath).st_mtime
+    except OSError:
+        # Not kept on disk (See get_snapshot()) so neither is this
+        return gzip_bytes(body, COMPRESS_LEVEL_SNAPSHOT)
+    try:
+        gzmtime = os.stat(gzpath).st_mtime
+    except OSError:
+        gzmtime = None
+    if gzmtime is not None and gzmtime >= mtime:
+        cached = _snapshots.get(gzpath)
+        if cached is not None and cached[0] == gzmtime:
+            return cached[1]
+        try:
+            with open(gzpath, 'rb') as infile:
+                gzbody = infile.read()
+        except (IOError, OSError):
+            pass
+        else:
+            remember_snapshot(gzpath, gzmtime, gzbody)
+            return gzbody
+
+    gzbody = gzip_bytes(body, COMPRESS_LEVEL_SNAPSHOT)
+    try:
+        gzmtime = write_snapshot(gzpath, gzbody, version)
+    except (IOError, OSError) as e:
+        logging.warning('Unable to write snapshot {}: {}'.format(gzpath, e))
+    else:
+        if gzmtime is not None:
+            remember_snapshot(gzpath, gzmtime, gzbody)
+    return gzbody
+
+
+def remember_snapshot(filepath, mtime, body):
+    if len(_snapshots) >= MAX_MEMORY_SNAPSHOTS:
+        _snapshots.clear()
+    _snapshots[filepath] = (mtime, body)
+
+
+def invalidate(*categories):
+    '''
+    Remove the snapshots (and their compressed copies) of these categories
+    (or all categories) so they are rebuilt on the next request.
+    '''
+    if not categories:
+        categories = [row[0][0] for row in CATEGORIES]
+    prefixes = tuple('{}-'.format(get_category(c)[0][0]) for c in categories)
+    try:
+        filenames = os.listdir(SNAPSHOT_DIR)
+    except OSError:
+        filenames = ()
+    for filename in filenames:
+        if filename.startswith(prefixes):
+            try:
+                os.remove(os.path.join(SNAPSHOT_DIR, filename))
+            except OSError:
+                pass
+    for filepath in list(_snapshots):
+        if os.path.basename(filepath).startswith(prefixes):
+            del _snapshots[filepath]
+    _projections.evict(lambda key: '{}-'.format(key[1]) in prefixes)
+    logging.debug('Invalidated snapshots for {}'.format(', '.join(categories)))
+
+
+def rebuild(*categories):
+    '''
+    Invalidate and rebuild the unfiltered snapshots of these categories
+    (or all categories).
+    '''
+    if not categories:
+        categories = [row[0][0] for row in CATEGORIES]
+    invalidate(*categories)
+    for category in categories:
+        body = get_snapshot(category)
+        logging.info('Rebuilt {} snapshot ({} bytes)'.format(
+            category, len(body) if body is not None else 0))
+
+
+def rebuild_on_import(*categories):
+    '''
+    Decorate an importer so that the snapshots of these categories (and the
+    log) are invalidated and the data version is updated when it writes new
+    rows.
+    '''
+    categories = categories + ('log', )
+
+    def decorator(importer):
+        @functools.wraps(importer)
+        def wrapper(*args, **kwargs):
+            before = get_last_log()[0]
+            ret = importer(*args, **kwargs)
+            if update_data_version()[0] != before:
+                invalidate(*categories)
+            return ret
+        return wrapper
+    return decorator
+
+
+def main(argv=None):
+    '''
+    Rebuild snapshots from the command line.
+
+    python -m models.snapshot [category ...]
+    '''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('categories', nargs='*',
+                        help='Categories to rebuild (default: all)')
+    args = parser.parse_args(argv)
+    for category in args.categories:
+        if get_category(category) is None:
+            parser.error('Unknown category "{}"'.format(category))
+
+    logging.basicConfig(level=logging.INFO)
+    rebuild(*args.categories)
+
+
+if __name__ == '__main__':
+    main()
+
+
+### EOF ###
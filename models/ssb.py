@@ -0,0 +1,180 @@
+from __future__ import absolute_import
+
+import argparse
+import csv
+import logging
+import os
+import time
+
+from sqlalchemy import Column, Integer, String
+from sqlalchemy.dialects.mysql import SMALLINT
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from .base import BetterBase, create_session, session_scope
+
+
+SSB_PATH = os.path.join(os.environ.get('OPENSHIFT_DATA_DIR', '/tmp'),
+                        'ssb.csv')
+
+# Read the database again at least this often (in seconds); ssb.csv is read
+# again as soon as it changes
+SSB_MAX_AGE = 3600
+
+_ssb = {
+    'expires': 0,
+    'mtime': None,
+    'table': {},
+}
+
+
+class SSBMastery(BetterBase):
+    '''
+    A stat boost from the mastery of a Super Soul Break.
+
+    The same rows as ssb.csv for when there is no file on disk
+    (See python -m models.ssb).
+    '''
+    __tablename__ = 'ssb_mastery'
+    buddy_id = Column(Integer, primary_key=True, autoincrement=False)
+    stat = Column(String(length=16), primary_key=True)
+    value = Column(SMALLINT, primary_key=True, autoincrement=False)
+    name = Column(String(length=64), nullable=False, default='')
+
+    search_id = None
+
+    def __repr__(self):
+        return '{} {} +{}'.format(self.name, self.stat, self.value)
+
+
+def read_csv(filepath=None):
+    '''
+    Return a list of 4-tuples (buddy_id, stat, value, name) of a CSV file
+    with the columns buddy_id,name,stat,value.
+    '''
+    if filepath is None:
+        filepath = SSB_PATH
+    ret = []
+    try:
+        with open(filepath) as csvfile:
+            for row in csv.DictReader(csvfile):
+                try:
+                    ret.append((int(row['buddy_id']), row['stat'],
+                                int(row['value']), row['name']))
+                except (KeyError, TypeError, ValueError) as e:
+                    logging.warning('Skipped {} in {}: {}'.format(
+                        row, filepath, e))
+    except (IOError, OSError):
+        pass
+    return ret
+
+
+def read_db():
+    '''
+    Return a list of 4-tuples (buddy_id, stat, value, name) of SSBMastery.
+
+    A database without the ssb_mastery table (See models.migrate) has none.
+    '''
+    ret = []
+    # Not session_scope() which logs a traceback for the missing table
+    session = create_session()
+    try:
+        ret = [tuple(row) for row in session.query(
+            SSBMastery.buddy_id, SSBMastery.stat, SSBMastery.value,
+            SSBMastery.name)]
+    except (OperationalError, ProgrammingError) as e:
+        logging.debug('No SSB masteries in the database: {}'.format(e))
+    finally:
+        session.close()
+    return ret
+
+
+def get_mtime():
+    try:
+        return os.stat(SSB_PATH).st_mtime
+    except OSError:
+        return None
+
+
+def get_ssb_table():
+    '''
+    Return a dict {(buddy_id, stat): {value: name}} of every SSB mastery.
+
+    This is only read again when ssb.csv changes or after SSB_MAX_AGE
+    seconds.
+    '''
+    now = time.time()
+    mtime = get_mtime()
+    if now < _ssb['expires'] and mtime == _ssb['mtime']:
+        return _ssb['table']
+
+    table = {}
+    for buddy_id, stat, value, name in read_db() + read_csv():
+        table.setdefault((buddy_id, stat), {})[value] = name
+    _ssb.update(expires=now + SSB_MAX_AGE, mtime=mtime, table=table)
+    return table
+
+
+def check_ssb(stat, buddy_id, old_value, new_value):
+    '''
+    Check if the stat difference is due to the mastery of an SSB.
+
+    The masteries come from ssb.csv (See get_ssb_table()) with columns:
+    buddy_id,name,stat,value
+    A stat of the CSV also matches its series_ stat.
+
+    Returns bool.
+    '''
+    table = get_ssb_table()
+    if not table:
+        return False
+    stats = [stat]
+    if stat.startswith('series_'):
+        stats.append(stat[len('series_'):])
+    difference = int(new_value) - int(old_value)
+    for s in stats:
+        name = table.get((int(buddy_id), s), {}).get(difference)
+        if name is not None:
+            logging.debug(
+                'Stat difference due to SSB mastery for ' +
+                '{} found and ignored.'.format(name)
+            )
+            return True
+    return False
+
+
+def store(filepath=None):
+    '''
+    Copy the rows of a CSV file (default: ssb.csv) to SSBMastery.
+
+    Returns the number of rows.
+    '''
+    rows = read_csv(filepath)
+    with session_scope() as session:
+        for buddy_id, stat, value, name in rows:
+            session.merge(SSBMastery(
+                buddy_id=buddy_id, stat=stat, value=value, name=name))
+        session.commit()
+    _ssb['expires'] = 0
+    return len(rows)
+
+
+def main(argv=None):
+    '''
+    Store the SSB masteries of a CSV file in the database.
+
+    python -m models.ssb [CSV]
+    '''
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('filepath', nargs='?', default=SSB_PATH,
+                        help='CSV file (default: {})'.format(SSB_PATH))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    logging.info('Stored {} SSB mastery row(s)'.format(store(args.filepath)))
+
+
+if __name__ == '__main__':
+    main()
+
+
+### EOF ###
@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+
+import calendar
+import logging
+import os
+
+from .base import session_scope
+from .log import Log
+
+
+VERSION_PATH = os.path.join(
+    os.environ.get('OPENSHIFT_DATA_DIR', '/tmp'), 'data_version')
+
+# (mtime, (version, last_modified))
+_version = (None, (None, None))
+
+
+def get_last_log():
+    '''
+    Return a 2-tuple (Log.id, Log.timestamp as a unix timestamp) of the newest
+    Log or (None, None).
+
+    Every importer writes a Log per new row so this is our data version.
+    '''
+    last = (None, None)
+    with session_scope() as session:
+        log = session.query(Log.id, Log.timestamp)\
+                     .order_by(Log.id.desc()).first()
+        if log is not None:
+            last = (log.id, calendar.timegm(log.timestamp.utctimetuple()))
+    return last
+
+
+def update_data_version():
+    '''
+    Store the data version on disk so every process sees the same one.
+
+    Returns the 2-tuple (version, last_modified).
+    '''
+    global _version
+    last = get_last_log()
+    if last[0] is None:
+        return last
+    tmppath = '{}.{}.tmp'.format(VERSION_PATH, os.getpid())
+    try:
+        with open(tmppath, 'w') as outfile:
+            outfile.write('{} {}'.format(*last))
+        os.rename(tmppath, VERSION_PATH)
+        _version = (os.stat(VERSION_PATH).st_mtime, last)
+    except (IOError, OSError) as e:
+        logging.warning('Unable to write {}: {}'.format(VERSION_PATH, e))
+    return last
+
+
+def get_data_version():
+    '''
+    Return a 2-tuple (version, last_modified) where version is the newest
+    Log.id and last_modified is its unix timestamp.
+
+    This only stats a file unless the data changed since the last call.
+    '''
+    global _version
+    try:
+        mtime = os.stat(VERSION_PATH).st_mtime
+    except OSError:
+        return update_data_version()
+    if _version[0] == mtime:
+        return _version[1]
+    try:
+        with open(VERSION_PATH) as infile:
+            version, last_modified = (int(i) for i in infile.read().split())
+    except (IOError, OSError, ValueError):
+        return update_data_version()
+    _version = (mtime, (version, last_modified))
+    return _version[1]
+
+
+### EOF ###
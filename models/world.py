@@ -5,7 +5,7 @@ import arrow
 from sqlalchemy import Column, Integer, String
 from sqlalchemy_utils import ArrowType
 from sqlalchemy.dialects.mysql import TINYINT, SMALLINT
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, load_only
 
 from .base import BetterBase, session_scope, STRFTIME
 
@@ -189,4 +189,16 @@ def get_active_events(now=None):
     return events
 
 
+def get_realms():
+    """Get an iterable of 2-tuples (series_id, name) of Realms."""
+    r = ()
+    with session_scope() as session:
+        realms = session.query(World)\
+                        .options(load_only(World.series_id, World.name))\
+                        .filter(World.world_type == 1).all()
+        session.expunge_all()
+    r = [(w.series_id, w.name) for w in realms]
+    return [(200001, 'Core')] + sorted(r) + [(150001, 'FFT')]
+
+
 ### EOF ###
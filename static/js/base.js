@@ -18,27 +18,9 @@ var series_map = {
 };
 
 
-function get_name_from_id(array, id) {
-    var ret;
-    $.each(array, function (i, o) {
-        if (o["id"] == id) {
-            ret = o["name"];
-            return ret;
-        }
-    });
-    return ret;
-}
-
 function init_abilities(u, t) {
     $.getJSON(u, function (d) {
         data = d;
-        ability_costs = {}
-        $.each(data["ability_costs"], function(i, o) {
-            var ac = ability_costs[o["ability_id"]] || [];
-            ac.push(String(o["material_id"]));
-            ability_costs[o["ability_id"]] = ac;
-        });
-
         change_rarity(current_rarity, t);
     })
         .success(function() {
@@ -57,66 +39,48 @@ function init_abilities(u, t) {
 function change_rarity(r, t) {
     current_rarity = r;
 
+    // The server already worked out which abilities use each pair of
+    // materials (see models.matrix.build_ability_matrix())
+    var grid = data["grids"][current_rarity] || {"materials": [], "cells": []};
+    var fields = [];
+
     columns = [{
         "field": "alt",
         "title": "",
     }];
-    abilities = {};
     abilities_rows = [];
 
-    // Get column names (material_name) and the correct fields by
-    // material_id according to current_rarity
-    $.each(data["materials"], function(i, material) {
-        // If the material does not match our current_rarity continue
-        if (current_rarity !== material["rarity"])
-            return;
-
+    // Get column names (material_name) and fields (material_id)
+    $.each(grid["materials"], function(i, m) {
+        var material = data["materials"][m];
+        fields.push(String(material[0]));
         columns.push({
-            "field": material["id"],
-            "title": material["name"],
-            "footerFormatter": material["name"],
+            "field": material[0],
+            "title": material[1],
+            "footerFormatter": material[1],
         });
-        abilities[material["id"]] = [];
     });
 
-    // Map the abilities to the correct column
-    $.each(data["abilities"], function(i, ability) {
-        // If the ability does not match our current_rarity continue
-        if (current_rarity !== ability["rarity"])
-            return;
-
-        var ability_id = ability["id"];
-        $.each(ability_costs[ability_id], function(j, material_id) {
-            // Some 4* abilities require 5* materials
-            // ie: Phoenix and Major Fire Orb
-            // In that case material_id will not be in abilities
-            if ($.inArray(material_id, Object.keys(abilities)) === -1)
-                return;
-            abilities[material_id].push(ability_id);
+    $.each(grid["materials"], function(i, m) {
+        var row = {"alt": data["materials"][m][1]};
+        $.each(fields, function(j, field) {
+            row[field] = [];
         });
+        abilities_rows.push(row);
     });
 
-    // Convert the abilities to rows
-    $.each(abilities, function(material_id1, NO) {
-        row = {"alt": get_name_from_id(data["materials"], material_id1)};
-        $.each(abilities, function(material_id2, ability_ids) {
-            // cell is abilities which use material_id1 and material_id2
-            var cell = []
-            $.each(ability_ids, function(k, ability_id) {
-                var ac = ability_costs[ability_id];
-                if ($.inArray(material_id1, ac) != -1 && $.inArray(material_id2, ac) != -1)
-                    cell.push(get_name_from_id(data["abilities"], ability_id));
-            });
-            row[material_id2] = cell;
+    // cell = [row, column, [ability index, ]] and only one half of the
+    // (symmetric) grid is sent
+    $.each(grid["cells"], function(i, cell) {
+        var names = $.map(cell[2], function(a) {
+            return data["abilities"][a][0];
         });
-        abilities_rows.push(row);
+        abilities_rows[cell[0]][fields[cell[1]]] = names;
+        abilities_rows[cell[1]][fields[cell[0]]] = names;
     });
 
     // columns = [{field: material_id, title: material_name}, ]
-    // abilities = {material_id1: [ability_names, ], }
     // abilities_rows = [{alt: material_name, material_id1: [], material_id2: []}, ]
-    //console.log(abilities);
-    //console.log(abilities_rows);
 
     if (!t.startsWith("#"))
         t = "#" + t;
@@ -247,6 +211,34 @@ function lerp(l, h, m) {
 }
 
 
+// Server side (keyset) pagination state for url('json_logs')
+var keyset = {
+    offset: null,
+    search: null,
+    last_id: null,
+};
+
+
+function keyset_query_params(params) {
+    // Send the last id of the current page when moving forward by exactly
+    //  one page so the server does not have to skip over offset rows.
+    if (keyset.last_id !== null && params.search == keyset.search &&
+        params.offset == keyset.offset + params.limit) {
+        params.before_id = keyset.last_id;
+    }
+    keyset.offset = params.offset;
+    keyset.search = params.search;
+    return params;
+}
+
+
+function keyset_response_handler(res) {
+    var rows = res["rows"] || [];
+    keyset.last_id = rows.length ? rows[rows.length - 1]["id"] : null;
+    return res;
+}
+
+
 function inspect_formatter(value, row, index) {
     if ("search_id" in row) {
         return '<a href="/' + get_value(row, "search_id") + '"><span class="glyphicon glyphicon-zoom-in" aria-hidden="true"></span><span class="sr-only">Inspect</span></a>';
@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""Time the hot paths against the live database.
+
+python tests/benchmark.py [benchmark ...]
+
+These are not tests (nose does not collect this file).
+import_world writes (and then deletes) a fixture world, so it only runs with
+FFRK_BENCHMARK_SCRATCH=1 to confirm the configured database is a scratch copy.
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import event, func
+
+import models.models as models
+from models.base import default_encode, engine
+from models.battle import enemy_table
+from models.enemy import load_attributes
+from models.version import get_last_log
+
+
+def best_of(func, repeat=5):
+    """Return the best time (in seconds) of repeat calls of func."""
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def report(name, before, after):
+    print('{:<32} {:>9.4f}s {:>9.4f}s {:>7.2f}x'.format(
+        name, before, after, before / after if after else float('inf')))
+
+
+def count_queries(func):
+    """Return the number of statements func sends to the database."""
+    statements = []
+    listener = lambda *args: statements.append(args[2])
+    event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        func()
+    finally:
+        event.remove(engine, 'before_cursor_execute', listener)
+    return len(statements)
+
+
+def legacy_dict(obj):
+    """BetterBase.dict() before the serializers were compiled."""
+    ret = dict((c, getattr(obj, c)) for c in obj.columns)
+    if obj.search_id is not None:
+        ret['search_id'] = obj.search_id
+    for k, v in obj.additional_columns:
+        ret[k] = v
+    return ret
+
+
+def bench_serializers():
+    """Serialize the full enemy and relic tables."""
+    for model in (models.Enemy, models.Relic):
+        with models.session_scope() as session:
+            objs = session.query(model).all()
+            session.expunge_all()
+        before = best_of(lambda: json.dumps(
+            [legacy_dict(o) for o in objs],
+            default=default_encode, separators=(',',':')))
+        after = best_of(lambda: json.dumps(
+            model.dicts(objs),
+            default=default_encode, separators=(',',':')))
+        report('{} ({} rows)'.format(model.__name__, len(objs)),
+               before, after)
+
+
+def battle_payload(battle_id):
+    """Rebuild a get_battle_init_data payload from what we stored."""
+    with models.session_scope() as session:
+        battle = session.query(models.Battle).get(battle_id)
+        enemies = list(battle.enemies)
+        drops = {}
+        for association in battle.drops:
+            drops.setdefault(association.enemy_id, []).append(
+                {'item_id': association.drop_id})
+        session.expunge_all()
+    attributes = load_attributes(e.param_id for e in enemies)
+    children = []
+    for e in enemies:
+        params = dict((c, getattr(e, c)) for c in e.columns
+                      if c not in ('id', 'enemy_id', 'name', 'breed_id',
+                                   'size', 'is_sp_enemy', 'event_id',
+                                   'event_type', 'param_id', 'defense'))
+        params.update({
+            'id': e.param_id,
+            'def': e.defense,
+            'def_attributes': [
+                {'attribute_id': str(aa.attribute.attribute_id),
+                 'factor': str(aa.attribute.factor)}
+                for aa in attributes.get(e.param_id, ())],
+        })
+        children.append({
+            'enemy_id': e.enemy_id,
+            'disp_name': e.name,
+            'breed_id': e.breed_id,
+            'size': e.size,
+            'params': [params],
+            'drop_item_list': drops.get(e.id, []) + [{'num': 1}],
+        })
+    return {'battle': {'battle_id': battle_id, 'rounds': [
+        {'enemy': [{'is_sp_enemy': 0, 'children': children}]}]}}
+
+
+def legacy_import_battle(data):
+    """The lookups models.import_battle() did before it was set based.
+
+    With a payload that is already in the database (which is what clients
+    send most of the time) it never wrote anything so this is all it did.
+    """
+    with models.session_scope() as session:
+        battle_id = data['battle']['battle_id']
+        for round in data['battle']['rounds']:
+            for enemy in round['enemy']:
+                for e in enemy['children']:
+                    drops = [session.query(models.Drop).filter_by(
+                                 id=drop['item_id']).first()
+                             for drop in e['drop_item_list']
+                             if drop.get('item_id') is not None]
+                    for p in e['params']:
+                        new_enemy = session.query(models.Enemy).filter_by(
+                            param_id=p['id'], lv=p['lv']).first()
+                        for attribute in p['def_attributes']:
+                            attribute = dict(
+                                (k, int(v)) for k, v in attribute.items())
+                            new_attribute = session.query(models.Attribute)\
+                                                   .filter_by(**attribute)\
+                                                   .first()
+                            session.query(models.AttributeAssociation).filter(
+                                models.AttributeAssociation.attribute_id ==
+                                new_attribute.id,
+                                models.AttributeAssociation.param_id ==
+                                new_enemy.param_id).first()
+                        old_battle = session.query(models.Battle).filter_by(
+                            id=battle_id).first()
+                        for drop in drops:
+                            session.query(models.DropAssociation).filter_by(
+                                enemy_id=new_enemy.id, drop_id=drop.id,
+                                battle_id=old_battle.id).first()
+                        old_battle in new_enemy.battles
+                        session.commit()
+    return True
+
+
+def bench_import_battle():
+    """Re-import the battles with the most enemies (nothing is written)."""
+    with models.session_scope() as session:
+        battle_ids = [b for (b, ) in session.query(enemy_table.c.battle_id)
+                      .group_by(enemy_table.c.battle_id)
+                      .order_by(func.count().desc()).limit(20)]
+    payloads = [battle_payload(b) for b in battle_ids]
+    # Undecorated so the snapshots are left alone
+    import_battle = models.import_battle.__wrapped__
+    before_queries = count_queries(
+        lambda: [legacy_import_battle(p) for p in payloads])
+    after_queries = count_queries(
+        lambda: [import_battle(data=p) for p in payloads])
+    before = best_of(lambda: [legacy_import_battle(p) for p in payloads])
+    after = best_of(lambda: [import_battle(data=p) for p in payloads])
+    report('import_battle ({} battles)'.format(len(payloads)), before, after)
+    print('{:<32} {:>10} {:>10}'.format(
+        '  queries', before_queries, after_queries))
+
+
+# Far above any real world id so the fixture never meets real data
+BENCH_WORLD_ID = 9999001
+# Every name and title of the fixture (and so every Log it writes) has this
+BENCH_NAME = 'ffrk-bottle benchmark fixture'
+
+
+def world_payload(world_id=BENCH_WORLD_ID, dungeons=30, prizes=8):
+    """Build a /dff/world/dungeons fixture with new ids but real drops."""
+    with models.session_scope() as session:
+        drops = [(i, name) for i, name in session.query(
+            models.Drop.id, models.Drop.name).limit(prizes)]
+    world = {'id': world_id, 'name': BENCH_NAME, 'series_id': 100001,
+             'opened_at': 1420070400, 'closed_at': 2145938400,
+             'kept_out_at': 2145938400, 'type': 2}
+    ret = []
+    for d in range(dungeons):
+        dungeon_id = world_id * 100 + d
+        ret.append({
+            'id': dungeon_id, 'world_id': world_id, 'series_id': 100001,
+            'name': '{} {}'.format(BENCH_NAME, d), 'type': 1,
+            'challenge_level': d + 1, 'total_stamina': 10,
+            'background_image_path': '', 'prologue_image_path': '',
+            'epilogue_image_path': '', 'prologue': '', 'epilogue': '',
+            'opened_at': 1420070400, 'closed_at': 2145938400,
+            'captures': [{'sp_scores': [
+                {'battle_id': dungeon_id * 10 + b, 'title': BENCH_NAME}
+                for b in range(3)]}],
+            'prizes': dict((str(prize_type), [
+                {'id': i, 'name': name or str(i), 'num': 1,
+                 'type_name': 'MATERIAL', 'image_path': ''}
+                for i, name in drops]) for prize_type in (1, 2, 3)),
+        })
+    return {'world': world, 'dungeons': ret}
+
+
+def count_world_rows(data):
+    """Return the number of rows import_world() writes for a new world."""
+    return 1 + sum(
+        1 + sum(len(c['sp_scores']) for c in dungeon['captures']) +
+        sum(len(p) for p in dungeon['prizes'].values())
+        for dungeon in data['dungeons'])
+
+
+def delete_world(data, last_log_id):
+    """Remove everything import_world() wrote for a fixture.
+
+    Only the fixture's own rows go: the Log rows written after last_log_id
+    that name it, and the world only if it is still the fixture.
+    """
+    world_id = data['world']['id']
+    dungeon_ids = [dungeon['id'] for dungeon in data['dungeons']]
+    with models.session_scope() as session:
+        world = session.query(models.World).get(world_id)
+        if world is not None and world.name != BENCH_NAME:
+            raise SystemExit('World {} is not the benchmark fixture'.format(
+                world_id))
+        session.query(models.Prize).filter(
+            models.Prize.dungeon_id.in_(dungeon_ids))\
+            .delete(synchronize_session=False)
+        session.query(models.SpecificCondition).filter(
+            models.SpecificCondition.dungeon_id.in_(dungeon_ids))\
+            .delete(synchronize_session=False)
+        session.query(models.Dungeon).filter(
+            models.Dungeon.id.in_(dungeon_ids))\
+            .delete(synchronize_session=False)
+        session.query(models.World).filter(models.World.id == world_id)\
+            .delete(synchronize_session=False)
+        session.query(models.SearchDirectory).filter(
+            models.SearchDirectory.id.in_(dungeon_ids + [world_id]))\
+            .delete(synchronize_session=False)
+        session.query(models.Log).filter(
+            models.Log.id > last_log_id,
+            models.Log.log.contains(BENCH_NAME))\
+            .delete(synchronize_session=False)
+        session.commit()
+
+
+def legacy_import_world(data):
+    """models.import_world() before it was set based (without the logs).
+
+    It looked up every dungeon, condition, drop and prize on its own and
+    committed after almost every row.
+    """
+    with models.session_scope() as session:
+        world = data['world']
+        new_world = session.query(models.World).filter_by(
+            id=world['id']).first()
+        if new_world is None:
+            new_world = models.World(**world)
+            session.add(new_world)
+            session.commit()
+            models.register_search_ids(session, new_world)
+        for dungeon in data['dungeons']:
+            new_dungeon = session.query(models.Dungeon).filter_by(
+                id=dungeon['id']).first()
+            if new_dungeon is None:
+                new_dungeon = models.Dungeon(**dungeon)
+                session.add(new_dungeon)
+                session.commit()
+                models.register_search_ids(session, new_dungeon)
+            for capture in dungeon['captures']:
+                for specific in capture['sp_scores']:
+                    if session.query(models.SpecificCondition).filter(
+                        models.SpecificCondition.battle_id ==
+                        specific['battle_id'],
+                        models.SpecificCondition.dungeon_id == new_dungeon.id,
+                        models.SpecificCondition.title == specific['title'])\
+                        .first() is not None:
+                        continue
+                    session.add(models.SpecificCondition(
+                        dungeon_id=new_dungeon.id, **specific))
+                    session.commit()
+            for prize_type, prizes_list in dungeon['prizes'].items():
+                for prize in prizes_list:
+                    drop = session.query(models.Drop).filter_by(
+                        id=prize['id']).first()
+                    if session.query(models.Prize).filter_by(
+                        drop_id=prize['id'], prize_type=prize_type,
+                        dungeon=new_dungeon).first() is not None:
+                        continue
+                    new_prize = models.Prize(**dict(
+                        prize, prize_type=prize_type, drop_id=prize['id']))
+                    new_prize.dungeon = new_dungeon
+                    new_prize.drop = drop
+                    session.add(new_prize)
+                    session.commit()
+    return True
+
+
+def bench_import_world():
+    """Import a new world fixture (which is removed again after each run)."""
+    if not os.environ.get('FFRK_BENCHMARK_SCRATCH'):
+        print('import_world skipped: set FFRK_BENCHMARK_SCRATCH=1 to write '
+              'to the configured (scratch) database')
+        return
+    data = world_payload()
+    rows = count_world_rows(data)
+    # Undecorated so the snapshots are left alone
+    import_world = models.import_world.__wrapped__
+
+    def run(func):
+        times = []
+        queries = 0
+        for i in range(3):
+            last_log_id = get_last_log()[0] or 0
+            start = time.time()
+            queries = count_queries(lambda: func(data=json.loads(
+                json.dumps(data))))
+            times.append(time.time() - start)
+            delete_world(data, last_log_id)
+        return min(times), queries
+
+    delete_world(data, get_last_log()[0] or 0)
+    before, before_queries = run(legacy_import_world)
+    after, after_queries = run(import_world)
+    report('import_world ({} rows)'.format(rows), before, after)
+    print('{:<32} {:>10.0f} {:>10.0f}'.format(
+        '  rows/s', rows / before, rows / after))
+    print('{:<32} {:>10} {:>10}'.format(
+        '  queries', before_queries, after_queries))
+
+
+BENCHMARKS = {
+    'serializers': bench_serializers,
+    'import_battle': bench_import_battle,
+    'import_world': bench_import_world,
+}
+
+
+def main(argv=None):
+    names = (argv if argv is not None else sys.argv[1:]) or sorted(BENCHMARKS)
+    print('{:<32} {:>10} {:>10} {:>8}'.format(
+        'benchmark', 'before', 'after', 'speedup'))
+    for name in names:
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main()
+
+
+### EOF ###
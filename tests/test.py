@@ -1,13 +1,22 @@
+import gzip
+import os
+import tempfile
+
 from webtest import TestApp, AppError
-from sqlalchemy import inspect
+from sqlalchemy import event, inspect
 from nose.tools import raises, assert_raises
 
+import assets
 import ffrkapp
 import models.models as models
+from models import archive, backfill, ingest, snapshot, ssb
 
 from models.base import engine
 from models.battle import enemy_table
 from models.condition import condition_table
+from models.drop import get_drop_locations
+from models.log import LOG_BUFFER
+from models.migrate import get_hot_queries, explain
 
 
 class TestModels():
@@ -46,6 +55,126 @@ class TestModels():
         assert self.session.query(models.CharacterEquip).first()
         assert self.session.query(models.CharacterAbility).first()
         assert self.session.query(models.Quest).first()
+        assert self.session.query(models.SearchDirectory).first()
+
+    def test_character_additional_columns(self):
+        characters = self.session.query(models.Character).limit(10).all()
+        models.Character.load_additional_columns(characters)
+        for c in characters:
+            assert c._equips is not None
+            assert c._abilities is not None
+        assert any(c.get_equips() for c in characters)
+
+    def test_drop_locations(self):
+        # Major Power Orb
+        locations = get_drop_locations(40000002)
+        assert locations
+        enemy, battle, dungeon, world = locations[0]
+        assert battle.dungeon is dungeon
+        assert dungeon.world is world
+        assert len(get_drop_locations(40000002, exclude_expired=True)) <=\
+            len(locations)
+
+    def test_main_panels_expire(self):
+        # Panels showing an event are rebuilt once it closes
+        material = self.session.query(models.Material).first()
+        panels = material.main_panels
+        assert material.main_panels is panels
+        material._main_panels_expire_at = 0
+        assert material.main_panels is not panels
+
+    def test_log_buffer(self):
+        # New logs wait for the commit instead of being flushed
+        self.session.add_all((models.Log(log='test'), models.Log(log='test')))
+        self.session.flush()
+        assert len(self.session.info[LOG_BUFFER]) == 2
+        self.session.rollback()
+        assert LOG_BUFFER not in self.session.info
+
+    def test_archive(self):
+        archive_dir, segment_size = archive.ARCHIVE_DIR, archive.SEGMENT_SIZE
+        archive.ARCHIVE_DIR = tempfile.mkdtemp()
+        # Every payload after the first starts a new segment
+        archive.SEGMENT_SIZE = 1
+        try:
+            for i in range(3):
+                archive.append('win_battle', {'battle_id': i}, str(i), i)
+            archive.append('/dff/world/battles', {'battles': []}, '3', 3)
+            # The active segment is older than a day too
+            assert archive.compact() == 4
+            assert len(archive.load_index()) == 4
+            records = [r for f, r in archive.iter_records()]
+            assert [r['ticket'] for r in records] == ['0', '1', '2', '3']
+            records = [r for f, r in archive.iter_records(
+                actions=['win_battle'], since=1)]
+            assert [r['data']['battle_id'] for r in records] == [1, 2]
+        finally:
+            archive.ARCHIVE_DIR = archive_dir
+            archive.SEGMENT_SIZE = segment_size
+
+    def test_backfill_partition(self):
+        attribute = ('attribute', (100, 1))
+        items = [
+            ('a', 0, {('id', 1), attribute}),
+            ('a', 1, {('id', 2), attribute}),
+            ('a', 2, {('id', 1)}),
+            ('a', 3, {('id', 3)}),
+        ]
+        # 1 waits for 0 to create the attribute
+        assert backfill.partition(items) == [
+            [[('a', 0), ('a', 2)], [('a', 3)]],
+            [[('a', 1)]],
+        ]
+        assert backfill.partition(items, {attribute}) == [
+            [[('a', 0), ('a', 2)], [('a', 1)], [('a', 3)]],
+        ]
+
+    def test_check_ssb(self):
+        ssb_path = ssb.SSB_PATH
+        fd, ssb.SSB_PATH = tempfile.mkstemp(suffix='.csv')
+        try:
+            with os.fdopen(fd, 'w') as outfile:
+                outfile.write('buddy_id,name,stat,value\n'
+                              '10000200,Test,atk,10\n')
+            assert models.check_ssb('series_atk', 10000200, 100, 110)
+            assert not models.check_ssb('atk', 10000200, 100, 105)
+            assert not models.check_ssb('mag', 10000200, 100, 110)
+
+            # A new file is read again
+            with open(ssb.SSB_PATH, 'a') as outfile:
+                outfile.write('10000200,Test,mag,5\n')
+            os.utime(ssb.SSB_PATH, (0, 0))
+            assert models.check_ssb('mag', 10000200, 100, 105)
+        finally:
+            os.remove(ssb.SSB_PATH)
+            ssb.SSB_PATH = ssb_path
+            ssb._ssb['expires'] = 0
+
+
+class TestQueryPlans():
+    def setUp(self):
+        self.session = models.create_session()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_declared_indexes(self):
+        # Run `python -m models.migrate` if this fails
+        inspector = inspect(engine)
+        for table in models.BetterBase.metadata.sorted_tables:
+            existing = set(i['name'] for i in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                assert index.name in existing, index.name
+
+    def test_hot_queries(self):
+        # One test per query so a regression names the query
+        for name, query in get_hot_queries(self.session):
+            yield self.check_no_full_scan, name, query
+
+    def check_no_full_scan(self, name, query):
+        for row in explain(self.session, query):
+            assert row['type'] != 'ALL', '{} scans {}'.format(
+                name, row['table'])
 
 
 class TestFFRKApp():
@@ -65,6 +194,118 @@ class TestFFRKApp():
         assert resp2.status == '200 OK'
         assert resp2.content_type == 'application/json'
 
+    def test_json_snapshot(self):
+        resp = self.app.get('{}?category=enemy'.format(self.url('json')))
+        assert resp.status == '200 OK'
+        assert snapshot.get_snapshot_path('enemies') in\
+            snapshot._snapshots
+
+        resp2 = self.app.get('{}?category=enemies'.format(self.url('json')))
+        assert resp2.body == resp.body
+
+        self.app.get('{}?category=404'.format(self.url('json')), status=404)
+
+        # Equivalent filters share a snapshot and junk is refused
+        assert snapshot.get_snapshot_path('dungeon', filter='1') ==\
+            snapshot.get_snapshot_path('dungeon', filter=' 01')
+        self.app.get('{}?category=dungeon&filter=nope'.format(
+            self.url('json')), status=400)
+
+    def test_json_snapshot_gzip(self):
+        body = snapshot.get_snapshot('enemy')
+        assert gzip.decompress(snapshot.get_snapshot_gzip('enemy')) ==\
+            body.encode('utf-8')
+        assert os.path.exists(
+            '{}.gz'.format(snapshot.get_snapshot_path('enemy')))
+
+    def test_json_table_fields_snapshot(self):
+        # The fields of the table page are kept on disk like the snapshot
+        fields = [c for c, t in models.Enemy.frontend_columns]
+        self.app.get('{}?category=enemy&fields={}'.format(
+            self.url('json'), ','.join(fields)))
+        filepath = snapshot.get_snapshot_path('enemy', fields=fields)
+        assert os.path.exists(filepath)
+        assert snapshot.get_snapshot_gzip('enemy', fields=fields)
+        assert os.path.exists('{}.gz'.format(filepath))
+        # Any other fields are not
+        assert snapshot.get_snapshot_gzip('enemy', fields=['name']) is None
+
+    def test_json_not_modified(self):
+        resp = self.app.get('{}?category=world'.format(self.url('json')))
+        etag = resp.headers['ETag']
+        assert resp.headers['Last-Modified']
+
+        for url in (
+            '{}?category=world'.format(self.url('json')),
+            self.url('json_dungeons'),
+            self.url('json_abilities'),
+            self.url('json_id', id=207001),
+        ):
+            resp2 = self.app.get(url, headers={'If-None-Match': etag},
+                                 status=304)
+            assert resp2.headers['ETag'] == etag
+            assert not resp2.body
+
+        # The gzipped body has its own ETag and both revalidate
+        url = '{}?category=enemies'.format(self.url('json'))
+        headers = {'Accept-Encoding': 'gzip'}
+        gzip_etag = self.app.get(url, headers=headers).headers['ETag']
+        assert gzip_etag != etag and gzip_etag.endswith('-gzip"')
+        for tag in (etag, gzip_etag):
+            resp2 = self.app.get(url, headers=dict(
+                headers, **{'If-None-Match': tag}), status=304)
+            assert resp2.headers['ETag'] == tag
+
+    def test_json_logs(self):
+        resp = self.app.get('{}?limit=10'.format(self.url('json_logs')))
+        assert resp.json['total'] >= len(resp.json['rows'])
+        rows = resp.json['rows']
+        assert len(rows) <= 10
+
+        # Keyset and offset pagination return the same page
+        if len(rows) == 10:
+            url = '{}?limit=10&offset=10'.format(self.url('json_logs'))
+            by_offset = self.app.get(url)
+            by_keyset = self.app.get('{}&before_id={}'.format(
+                url, rows[-1]['id']))
+            assert by_keyset.json['rows'] == by_offset.json['rows']
+
+        self.app.get('{}?since=never'.format(self.url('json_logs')),
+                     status=400)
+
+    def test_json_abilities(self):
+        resp = self.app.get(self.url('json_abilities'))
+        abilities = resp.json['abilities']
+        for rarity, grid in resp.json['grids'].items():
+            for row, column, ability_ids in grid['cells']:
+                assert row <= column < len(grid['materials'])
+                assert all(i < len(abilities) for i in ability_ids)
+
+    def test_json_weaknesses(self):
+        resp = self.app.get(self.url('json_weaknesses'))
+        attribute_ids = [str(a['id']) for a in resp.json['attributes']]
+        assert '100' in attribute_ids
+        # Archaeosaur
+        archaeosaur = [r for r in resp.json['rows']
+                       if r['param_id'] == 4080151]
+        assert archaeosaur
+        assert set(archaeosaur[0]) & set(attribute_ids)
+
+    def test_json_fields(self):
+        url = self.url('json')
+        resp = self.app.get(url, {'category': 'enemy',
+                                  'fields': 'name,max_hp'})
+        row = resp.json[0]
+        # defense is needed to format max_hp
+        assert set(row) == {'id', 'name', 'max_hp', 'defense', 'search_id'}
+        self.app.get(url, {'category': 'enemy', 'fields': 'nope'},
+                     status=400)
+
+        # Archaeosaur
+        resp = self.app.get(self.url('json_id', id=4080151),
+                            {'fields': 'name'})
+        assert resp.json['search_id'] == 4080151
+
     def test_about_redirect(self):
         resp = self.app.get(self.url('home'))
         assert resp.status == '302 Found'
@@ -85,6 +326,16 @@ class TestFFRKApp():
                             status=404)
         assert 'File does not exist.' in resp.text
 
+    def test_static_fingerprint(self):
+        assets.build()
+        url = ffrkapp.get_url('static', filepath='js/base.min.js')
+        assert '/dist/' in url
+
+        resp = self.app.get(url)
+        assert resp.headers['Cache-Control'] ==\
+            assets.IMMUTABLE_CACHE_CONTROL
+        assert len(resp.body) < os.path.getsize('static/js/base.js')
+
     def tables(self):
         assert self.app.get('{}/?category={}'.format(self.url('home'), 'material'))
         assert self.app.get('{}/?category={}'.format(self.url('home'), 'enemy'))
@@ -132,11 +383,80 @@ class TestFFRKApp():
         masamune = self.app.get(self.url('main', iden=21003005))
         assert masamune
 
+    def test_main_battle_queries(self):
+        from models.cache import object_cache
+        object_cache.clear()
+        # Render the navigation first since it is cached separately
+        assert self.app.get(self.url('main', iden='about'))
+
+        statements = []
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            reactor5_battle = self.app.get(self.url('main', iden=507006))
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        assert reactor5_battle
+        # search_directory, battle (with dungeon and world), enemies (and
+        # their eager loads), drops and specific conditions
+        assert len(statements) <= 6, statements
+
+    def test_main_cache(self):
+        from models.cache import object_cache
+        object_cache.clear()
+        hits = object_cache.hits
+        assert self.app.get(self.url('main', iden=207001))
+        assert self.app.get(self.url('main', iden=207001))
+        assert object_cache.hits == hits + 1
+
+        # What another process evicts is evicted here too
+        from models.cache import record_evictions
+        record_evictions([207001])
+        hits = object_cache.hits
+        assert self.app.get(self.url('main', iden=207001))
+        assert object_cache.hits == hits
+
     def test_post(self):
-        pass
+        # Never import (or archive into) the real spool
+        queue_dir, archive_dir = ingest.QUEUE_DIR, archive.ARCHIVE_DIR
+        ingest.QUEUE_DIR = tempfile.mkdtemp()
+        archive.ARCHIVE_DIR = tempfile.mkdtemp()
+        try:
+            # There is no battle 0 so the worker records a failure
+            resp = self.app.post_json(self.url('post'), {
+                'action': 'win_battle', 'battle_id': 0, 'result': {}},
+                status=202)
+            ticket = resp.json['ticket']
+            status = self.app.get(resp.headers['Location']).json
+            assert status['status'] == 'queued'
+
+            ingest.drain()
+            status = self.app.get(self.url('post_status', ticket=ticket)).json
+            assert status['status'] == 'failed'
+        finally:
+            ingest.QUEUE_DIR, archive.ARCHIVE_DIR = queue_dir, archive_dir
+
+    def test_post_duplicate(self):
+        queue_dir, archive_dir = ingest.QUEUE_DIR, archive.ARCHIVE_DIR
+        ingest.QUEUE_DIR = tempfile.mkdtemp()
+        archive.ARCHIVE_DIR = tempfile.mkdtemp()
+        try:
+            # Reactor 5 battle; only the id is read since we already have it
+            data = {'action': '/dff/world/battles',
+                    'battles': [{'id': 507006}]}
+            self.app.post_json(self.url('post'), data)
+            ingest.drain()
+            resp = self.app.post_json(self.url('post'), data, status=200)
+            assert resp.json['duplicate']
+        finally:
+            ingest.QUEUE_DIR, archive.ARCHIVE_DIR = queue_dir, archive_dir
 
     def test_bad_post(self):
-        pass
+        self.app.post_json(self.url('post'), {'action': 'nope'}, status=501)
+        self.app.post_json(self.url('post'), {'action': 'win_battle'},
+                           status=501)
+        self.app.get(self.url('post_status', ticket='0'), status=404)
 
 
 ### EOF ###